@@ -1,44 +1,77 @@
-from flask import Blueprint, jsonify, request
-from models import User, Flipbook, PageView
+from flask import Blueprint, jsonify, request, current_app, Response, stream_with_context, url_for, abort
+from models import User, Flipbook, UploadSession
 from app import db
+from utils import page_sources, PAGE_IMG_SIZES
+from documents import delete_flipbook, attach_document
+from uploads import (create_upload, append_chunk, finalize_upload, discard_upload, upload_offset,
+                     purge_stale_uploads, UploadError)
+from jobs import render_queue
+from search import search_flipbook, search_account
+from rollups import flipbook_analytics
+from identity import identity_cache
+from passwords import PasswordHashBusy
+from exports import stream_page_views, parse_export_range, clamp_export_range, EXPORT_FORMATS
 from werkzeug.security import check_password_hash
 from datetime import datetime, timedelta
-from sqlalchemy import func
 from functools import wraps
+from sqlalchemy import select, or_, and_
 import jwt
 import os
+import json
+import base64
+import hashlib
 
 api = Blueprint('api', __name__)
 
+@api.errorhandler(PasswordHashBusy)
+def password_hash_busy(e):
+    response = jsonify({'error': e.description, 'code': 'AUTH_BUSY'})
+    response.status_code = 503
+    response.headers['Retry-After'] = e.retry_after
+    return response
+
 def generate_access_token(user):
     payload = {
         'user_id': user.id,
+        'username': user.username,
+        'epoch': user.auth_epoch or 0,  # must match the user's current epoch, see identity.py
         'exp': datetime.utcnow() + timedelta(minutes=15)  # Short-lived access token
     }
     return jwt.encode(payload, os.environ.get('FLASK_SECRET_KEY'), algorithm='HS256')
 
+class TokenError(Exception):
+    """A missing, expired or invalid access token, with the JSON body of its 401 response."""
+
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.body = {'error': message, 'code': code} if code else {'error': message}
+
+def decode_access_token(auth_header):
+    """Return the claims of the bearer token in an Authorization header, or raise TokenError."""
+    token = None
+    if auth_header and auth_header.startswith('Bearer '):
+        token = auth_header.split(' ')[1]
+    if not token:
+        raise TokenError('Token is missing')
+    try:
+        return jwt.decode(token, os.environ.get('FLASK_SECRET_KEY'), algorithms=['HS256'])
+    except jwt.ExpiredSignatureError:
+        raise TokenError('Token has expired', 'TOKEN_EXPIRED')
+    except jwt.InvalidTokenError:
+        raise TokenError('Invalid token')
+
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        token = None
-        auth_header = request.headers.get('Authorization')
-        
-        if auth_header and auth_header.startswith('Bearer '):
-            token = auth_header.split(' ')[1]
-            
-        if not token:
-            return jsonify({'error': 'Token is missing'}), 401
-            
         try:
-            data = jwt.decode(token, os.environ.get('FLASK_SECRET_KEY'), algorithms=['HS256'])
-            current_user = User.query.get(data['user_id'])
-            if not current_user:
-                return jsonify({'error': 'Invalid token'}), 401
-            return f(current_user, *args, **kwargs)
-        except jwt.ExpiredSignatureError:
-            return jsonify({'error': 'Token has expired', 'code': 'TOKEN_EXPIRED'}), 401
-        except jwt.InvalidTokenError:
+            data = decode_access_token(request.headers.get('Authorization'))
+        except TokenError as e:
+            return jsonify(e.body), 401
+        # Usually served from the identity cache without touching the database
+        current_user = identity_cache.authenticate(data['user_id'], data.get('epoch', 0))
+        if not current_user:
             return jsonify({'error': 'Invalid token'}), 401
+        return f(current_user, *args, **kwargs)
             
     return decorated
 
@@ -48,7 +81,7 @@ def api_login():
     if not data or 'email' not in data or 'password' not in data:
         return jsonify({'error': 'Missing email or password'}), 400
     
-    user = User.query.filter_by(email=data['email']).first()
+    user = User.find_by_email(data['email'])
     if user and user.check_password(data['password']):
         access_token = generate_access_token(user)
         refresh_token = user.generate_refresh_token()
@@ -92,8 +125,9 @@ def refresh_token():
 @api.route('/auth/logout', methods=['POST'])
 @token_required
 def api_logout(current_user):
-    current_user.revoke_refresh_token()
-    db.session.commit()
+    user = db.session.get(User, current_user.id)
+    user.revoke_refresh_token()
+    db.session.commit()  # drops the cached identity, see bump_auth_epoch
     return jsonify({'message': 'Successfully logged out'})
 
 @api.route('/auth/register', methods=['POST'])
@@ -102,7 +136,7 @@ def api_register():
     if not data or not all(k in data for k in ('username', 'email', 'password')):
         return jsonify({'error': 'Missing required fields'}), 400
     
-    if User.query.filter_by(email=data['email']).first():
+    if User.find_by_email(data['email']):
         return jsonify({'error': 'Email already registered'}), 400
     
     if User.query.filter_by(username=data['username']).first():
@@ -130,24 +164,141 @@ def api_register():
                 'email': user.email
             }
         }), 201
+    except PasswordHashBusy:
+        db.session.rollback()
+        raise
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+FLIPBOOK_PAGE_SIZE = 50
+FLIPBOOK_PAGE_SIZE_MAX = 200
+# Field name -> how to read it; the ETag covers title_encrypted, never the plaintext
+FLIPBOOK_FIELDS = {
+    'id': lambda f: f.id,
+    'title': lambda f: f.title,
+    'unique_id': lambda f: f.unique_id,
+    'created_at': lambda f: f.created_at.isoformat(),
+    'page_count': lambda f: f.page_count,
+    'status': lambda f: f.status,
+    'view_count': lambda f: f.view_count,
+}
+
+def encode_cursor(flipbook):
+    raw = json.dumps([flipbook.created_at.isoformat(), flipbook.id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+    created_at, flipbook_id = json.loads(raw)
+    return datetime.fromisoformat(created_at), int(flipbook_id)
+
+def flipbook_list_query(user_id, args):
+    """Parse ?fields=, ?limit= and ?cursor= into (fields, limit, statement); raises ValueError.
+
+    The statement fetches one row more than limit so flipbook_list_page can tell
+    whether there is a next page. Without limit and cursor every flipbook is
+    returned and limit is None, as before pagination existed.
+    """
+    fields = [name for name in args.get('fields', '').split(',') if name] or list(FLIPBOOK_FIELDS)
+    unknown = set(fields) - set(FLIPBOOK_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    stmt = select(Flipbook).where(Flipbook.user_id == user_id)
+    if 'limit' not in args and not args.get('cursor'):
+        return fields, None, stmt.order_by(Flipbook.created_at.desc(), Flipbook.id.desc())
+    try:
+        limit = int(args.get('limit', FLIPBOOK_PAGE_SIZE))
+    except ValueError:
+        limit = FLIPBOOK_PAGE_SIZE
+    limit = min(max(limit, 1), FLIPBOOK_PAGE_SIZE_MAX)
+    
+    if args.get('cursor'):
+        try:
+            created_at, flipbook_id = decode_cursor(args['cursor'])
+        except (ValueError, TypeError):
+            raise ValueError('Invalid cursor')
+        stmt = stmt.where(or_(
+            Flipbook.created_at < created_at,
+            and_(Flipbook.created_at == created_at, Flipbook.id < flipbook_id)
+        ))
+    return fields, limit, stmt.order_by(Flipbook.created_at.desc(), Flipbook.id.desc()).limit(limit + 1)
+
+def flipbook_list_page(flipbooks, fields, limit):
+    """Split the fetched rows into (page, next_cursor, etag)."""
+    next_cursor = encode_cursor(flipbooks[limit - 1]) if limit and len(flipbooks) > limit else None
+    flipbooks = flipbooks[:limit]
+    return flipbooks, next_cursor, flipbooks_etag(flipbooks, fields, next_cursor)
+
+def flipbook_list_body(flipbooks, fields, next_cursor):
+    if 'title' in fields:
+        Flipbook.title.decrypt_all(flipbooks)
+    return {
+        'flipbooks': [{name: FLIPBOOK_FIELDS[name](f) for name in fields} for f in flipbooks],
+        'next_cursor': next_cursor
+    }
+
+def flipbook_detail(flipbook):
+    """The get_flipbook response body; builds URLs, so it needs a request context."""
+    pages = page_sources(flipbook) if flipbook.is_ready else []
+    return {
+        'id': flipbook.id,
+        'title': flipbook.title,
+        'unique_id': flipbook.unique_id,
+        'created_at': flipbook.created_at.isoformat(),
+        'page_count': flipbook.page_count,
+        'status': flipbook.status,
+        'pages': [page['variants'][0]['url'] if page['variants'] else page['src'] for page in pages],
+        'page_variants': [{
+            'number': page['number'],
+            'width': page.get('width'),
+            'height': page.get('height'),
+            'tiles': page['tiles'],
+            'variants': [{
+                'name': v['name'],
+                'format': v['format'],
+                'url': v['url'],
+                'width': v['width'],
+                'height': v['height']
+            } for v in page['variants']]
+        } for page in pages]
+    }
+
+def flipbook_status(flipbook):
+    return {
+        'unique_id': flipbook.unique_id,
+        'status': flipbook.status,
+        'pages_done': flipbook.pages_done,
+        'page_count': flipbook.page_count,
+        'error': flipbook.error_message
+    }
+
+def flipbooks_etag(flipbooks, fields, next_cursor):
+    """Strong validator over exactly what the response would contain, computed without decrypting."""
+    digest = hashlib.sha256(','.join(fields).encode())
+    for f in flipbooks:
+        values = [f.title_encrypted if name == 'title' else FLIPBOOK_FIELDS[name](f) for name in fields]
+        digest.update(json.dumps(values).encode())
+    digest.update((next_cursor or '').encode())
+    return digest.hexdigest()
+
 @api.route('/flipbooks', methods=['GET'])
 @token_required
 def list_flipbooks(current_user):
-    flipbooks = Flipbook.query.filter_by(user_id=current_user.id).all()
-    return jsonify({
-        'flipbooks': [{
-            'id': f.id,
-            'title': f.title,
-            'unique_id': f.unique_id,
-            'created_at': f.created_at.isoformat(),
-            'page_count': f.page_count,
-            'view_count': len(f.views)
-        } for f in flipbooks]
-    })
+    """Newest first, paged with ?limit= and ?cursor=, trimmed with ?fields=title,status."""
+    try:
+        fields, limit, stmt = flipbook_list_query(current_user.id, request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    flipbooks, next_cursor, etag = flipbook_list_page(db.session.scalars(stmt).all(), fields, limit)
+    
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(flipbook_list_body(flipbooks, fields, next_cursor))
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 @api.route('/flipbooks/<unique_id>', methods=['GET'])
 @token_required
@@ -155,47 +306,234 @@ def get_flipbook(current_user, unique_id):
     flipbook = Flipbook.query.filter_by(unique_id=unique_id).first_or_404()
     if flipbook.user_id != current_user.id:
         return jsonify({'error': 'Unauthorized access'}), 403
-    return jsonify({
-        'id': flipbook.id,
-        'title': flipbook.title,
-        'unique_id': flipbook.unique_id,
-        'created_at': flipbook.created_at.isoformat(),
+    return jsonify(flipbook_detail(flipbook))
+
+def compact_page(page):
+    """A page as the viewer needs it, with short keys and empty fields left out."""
+    compact = {'n': page['number'], 'src': page['src']}
+    if page.get('width'):
+        compact['w'] = page['width']
+        compact['h'] = page['height']
+    if page['srcset']:
+        compact['srcset'] = page['srcset']
+    if page['sources']:
+        compact['sources'] = page['sources']
+    if page['tiles']:
+        compact['tiles'] = page['tiles']
+    thumb = next((v['url'] for v in page['variants'] if v['name'] == 'thumb' and v['format'] == 'jpeg'), None)
+    if thumb:
+        compact['thumb'] = thumb
+    return compact
+
+@api.route('/flipbooks/<unique_id>/pages', methods=['GET'])
+def page_manifest(unique_id):
+    """Compact page manifest the viewer loads pages from, public like the viewer."""
+    flipbook = Flipbook.query.filter_by(unique_id=unique_id).first_or_404()
+    if not flipbook.is_ready:
+        return jsonify({'error': 'Flipbook is not ready yet', 'status': flipbook.status}), 409
+    response = jsonify({
         'page_count': flipbook.page_count,
-        'pages': [
-            f'/static/uploads/{flipbook.filename.rsplit(".", 1)[0]}/page_{i+1}.jpg'
-            for i in range(flipbook.page_count)
-        ]
+        'sizes': PAGE_IMG_SIZES,
+        'pages': [compact_page(page) for page in page_sources(flipbook)]
     })
+    # Asset URLs carry content hashes, so the body changes exactly when a page is re-rendered
+    response.add_etag()
+    response.headers['Cache-Control'] = 'public, no-cache'
+    return response.make_conditional(request)
+
+@api.route('/flipbooks/<unique_id>', methods=['DELETE'])
+@token_required
+def delete_flipbook_api(current_user, unique_id):
+    flipbook = Flipbook.query.filter_by(unique_id=unique_id).first_or_404()
+    if flipbook.user_id != current_user.id:
+        return jsonify({'error': 'Unauthorized access'}), 403
+    try:
+        delete_flipbook(flipbook, current_app.config['UPLOAD_FOLDER'])
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+    return jsonify({'message': 'Flipbook deleted'})
+
+@api.route('/flipbooks/<unique_id>/status', methods=['GET'])
+@token_required
+def get_flipbook_status(current_user, unique_id):
+    flipbook = Flipbook.query.filter_by(unique_id=unique_id).first_or_404()
+    if flipbook.user_id != current_user.id:
+        return jsonify({'error': 'Unauthorized access'}), 403
+    return jsonify(flipbook_status(flipbook))
 
 @api.route('/analytics', methods=['GET'])
 @token_required
 def get_analytics(current_user):
-    user_flipbooks = Flipbook.query.filter_by(user_id=current_user.id).all()
-    analytics_data = {}
-    
-    for flipbook in user_flipbooks:
-        total_views = PageView.query.filter_by(flipbook_id=flipbook.id).count()
-        
-        seven_days_ago = datetime.utcnow() - timedelta(days=7)
-        daily_views = db.session.query(
-            func.date(PageView.viewed_at).label('date'),
-            func.count(PageView.id).label('count')
-        ).filter(
-            PageView.flipbook_id == flipbook.id,
-            PageView.viewed_at >= seven_days_ago
-        ).group_by(
-            func.date(PageView.viewed_at)
-        ).all()
-        
-        dates = [(seven_days_ago + timedelta(days=x)).strftime('%Y-%m-%d') for x in range(8)]
-        views_data = {date: 0 for date in dates}
-        for date, count in daily_views:
-            views_data[date.strftime('%Y-%m-%d')] = count
-            
-        analytics_data[str(flipbook.id)] = {
-            'title': flipbook.title,
-            'total_views': total_views,
-            'daily_views': views_data
-        }
+    analytics_data = {
+        str(flipbook_id): data for flipbook_id, data in flipbook_analytics(current_user.id).items()
+    }
     
     return jsonify(analytics_data)
+
+@api.route('/analytics/export', methods=['GET'])
+@token_required
+def export_page_views(current_user):
+    """Stream raw page views as NDJSON or CSV, e.g. ?from=2024-01-01&to=2024-01-31&format=csv."""
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'error': f"Unsupported format, use one of: {', '.join(EXPORT_FORMATS)}"}), 400
+    try:
+        start, end = parse_export_range(request.args.get('from'), request.args.get('to'))
+        start, end, clamped = clamp_export_range(start, end, current_app.config['RAW_VIEW_RETENTION_DAYS'])
+    except ValueError as e:
+        return jsonify({'error': f'Invalid date range: {str(e)}'}), 400
+    
+    flipbook_id = None
+    if request.args.get('flipbook'):
+        flipbook = Flipbook.query.filter_by(unique_id=request.args['flipbook']).first_or_404()
+        if flipbook.user_id != current_user.id:
+            return jsonify({'error': 'Unauthorized access'}), 403
+        flipbook_id = flipbook.id
+    
+    negotiated = 'gzip' in request.accept_encodings
+    compress = negotiated or request.args.get('gzip') == '1'
+    # Without Accept-Encoding, ?gzip=1 asks for a .gz file rather than a compressed transfer
+    gzip_file = compress and not negotiated
+    response = Response(
+        stream_with_context(stream_page_views(current_user.id, start, end, fmt, flipbook_id, compress)),
+        mimetype='application/gzip' if gzip_file else EXPORT_FORMATS[fmt]
+    )
+    filename = f'page_views.{fmt}.gz' if gzip_file else f'page_views.{fmt}'
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    if clamped:
+        # Older views were purged, tell the client where the export really starts
+        response.headers['X-Export-Start'] = start.isoformat(timespec='seconds')
+    if compress and negotiated:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+def upload_headers(upload, offset):
+    return {
+        'Upload-Offset': str(offset),
+        'Upload-Length': str(upload.upload_length),
+        'Cache-Control': 'no-store'
+    }
+
+def get_upload_or_404(current_user, upload_id):
+    upload = db.session.get(UploadSession, upload_id)
+    if upload is None or upload.user_id != current_user.id:
+        abort(404)
+    return upload
+
+@api.errorhandler(UploadError)
+def upload_error(e):
+    return jsonify({'error': str(e)}), e.status
+
+@api.route('/uploads', methods=['POST'])
+@token_required
+def create_upload_api(current_user):
+    """Start a resumable upload: {"title": ..., "length": <bytes>} or an Upload-Length header."""
+    data = request.get_json(silent=True) or {}
+    title = data.get('title') or request.headers.get('Upload-Title')
+    length = data.get('length', request.headers.get('Upload-Length'))
+    if not title or length is None:
+        return jsonify({'error': 'Missing title or length'}), 400
+    try:
+        length = int(length)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid length'}), 400
+    
+    session_folder = current_app.config['UPLOAD_SESSION_FOLDER']
+    purge_stale_uploads(session_folder, current_app.config['UPLOAD_SESSION_MAX_AGE_HOURS'])
+    upload = create_upload(current_user.id, title, length, session_folder,
+                           current_app.config['MAX_UPLOAD_MB'] * 1024 * 1024)
+    db.session.commit()
+    
+    location = url_for('api.upload_status', upload_id=upload.id)
+    response = jsonify({'id': upload.id, 'location': location, 'offset': 0, 'length': upload.upload_length})
+    response.status_code = 201
+    response.headers.update(upload_headers(upload, 0))
+    response.headers['Location'] = location
+    return response
+
+@api.route('/uploads/<upload_id>', methods=['GET'])
+@token_required
+def upload_status(current_user, upload_id):
+    """Report how many bytes arrived; HEAD works too and returns just the headers."""
+    upload = get_upload_or_404(current_user, upload_id)
+    offset = upload_offset(current_app.config['UPLOAD_SESSION_FOLDER'], upload)
+    response = jsonify({'id': upload.id, 'offset': offset, 'length': upload.upload_length})
+    response.headers.update(upload_headers(upload, offset))
+    return response
+
+@api.route('/uploads/<upload_id>', methods=['PATCH'])
+@token_required
+def upload_chunk(current_user, upload_id):
+    """Append the raw request body at the offset given in the Upload-Offset header."""
+    upload = get_upload_or_404(current_user, upload_id)
+    if request.mimetype != 'application/offset+octet-stream':
+        return jsonify({'error': 'Content-Type must be application/offset+octet-stream'}), 415
+    try:
+        offset = int(request.headers['Upload-Offset'])
+    except (KeyError, ValueError):
+        return jsonify({'error': 'Missing or invalid Upload-Offset'}), 400
+    
+    offset = append_chunk(upload, request.stream, offset, current_app.config['UPLOAD_SESSION_FOLDER'])
+    response = Response(status=204)
+    response.headers.update(upload_headers(upload, offset))
+    return response
+
+@api.route('/uploads/<upload_id>/finalize', methods=['POST'])
+@token_required
+def finalize_upload_api(current_user, upload_id):
+    """Create the flipbook from a complete upload and queue it for rendering."""
+    upload = get_upload_or_404(current_user, upload_id)
+    try:
+        document = finalize_upload(
+            upload, current_app.config['UPLOAD_SESSION_FOLDER'], current_app.config['UPLOAD_FOLDER']
+        )
+        flipbook = Flipbook()
+        flipbook.title = upload.title
+        flipbook.user_id = current_user.id
+        attach_document(flipbook, document)
+        db.session.add(flipbook)
+        db.session.commit()
+    except UploadError:
+        db.session.rollback()
+        raise
+    
+    if not flipbook.is_ready:
+        render_queue.enqueue(flipbook.id)
+    response = jsonify({
+        'id': flipbook.id,
+        'unique_id': flipbook.unique_id,
+        'status': flipbook.status,
+        'status_url': url_for('api.get_flipbook_status', unique_id=flipbook.unique_id)
+    })
+    response.status_code = 201
+    return response
+
+@api.route('/uploads/<upload_id>', methods=['DELETE'])
+@token_required
+def cancel_upload(current_user, upload_id):
+    upload = get_upload_or_404(current_user, upload_id)
+    discard_upload(upload, current_app.config['UPLOAD_SESSION_FOLDER'])
+    db.session.commit()
+    return Response(status=204)
+
+SEARCH_RESULTS_MAX = 50
+
+@api.route('/flipbooks/<unique_id>/search', methods=['GET'])
+def search_flipbook_api(unique_id):
+    """Pages of a flipbook matching ?q=, public like the viewer so it can jump to hits."""
+    flipbook = Flipbook.query.filter_by(unique_id=unique_id).first_or_404()
+    if not flipbook.is_ready:
+        return jsonify({'error': 'Flipbook is not ready yet', 'status': flipbook.status}), 409
+    query = request.args.get('q', '')
+    limit = min(max(request.args.get('limit', SEARCH_RESULTS_MAX, type=int), 1), SEARCH_RESULTS_MAX)
+    return jsonify({'query': query, 'results': search_flipbook(flipbook, query, limit)})
+
+@api.route('/search', methods=['GET'])
+@token_required
+def search_account_api(current_user):
+    """Matching pages across all of the user's flipbooks for ?q=."""
+    query = request.args.get('q', '')
+    limit = min(max(request.args.get('limit', SEARCH_RESULTS_MAX, type=int), 1), SEARCH_RESULTS_MAX)
+    return jsonify({'query': query, 'results': search_account(current_user.id, query, limit)})
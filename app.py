@@ -1,6 +1,8 @@
 import os
+import time
 import logging
 import secrets
+import threading
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
@@ -19,8 +21,15 @@ class Base(DeclarativeBase):
 db = SQLAlchemy(model_class=Base)
 login_manager = LoginManager()
 
-def create_app():
-    """Create and configure the Flask application."""
+def create_app(run_services=True):
+    """Create and configure the Flask application.
+
+    run_services=False builds the app without background workers, for
+    one-off scripts such as migrations. Otherwise the workers are started
+    by start_services() in the process that serves requests, never at import,
+    so a gunicorn --preload master does not own threads its workers lack.
+    """
+    started = time.perf_counter()
     app = Flask(__name__)
     
     # Configuration
@@ -35,7 +44,20 @@ def create_app():
     with app.app_context():
         register_blueprints(app)
         init_database(app)
+        init_storage(app)
+        init_identity_cache(app)
+        init_password_hasher(app)
+        init_metrics(app)
+        if run_services:
+            # The first request starts them, unless a gunicorn post_fork hook already did
+            app.before_request(lambda: start_services(app))
+    
+    if app.config['PRELOAD_CRYPTO']:
+        # Derive encryption keys now so forked workers inherit them
+        from encryption import encryptor
+        encryptor.warm()
     
+    logger.info(f"Application created in {time.perf_counter() - started:.3f}s")
     return app
 
 def configure_app(app):
@@ -58,7 +80,49 @@ def configure_app(app):
         },
         SQLALCHEMY_TRACK_MODIFICATIONS=False,
         MAX_CONTENT_LENGTH=16 * 1024 * 1024,  # 16MB max file size
-        LOGIN_DISABLED=False  # Enable login functionality
+        LOGIN_DISABLED=False,  # Enable login functionality
+        RENDER_WORKERS=int(os.environ.get('RENDER_WORKERS', 2)),  # 0 renders inline
+        RENDER_LEASE_SECONDS=int(os.environ.get('RENDER_LEASE_SECONDS', 300)),  # renewed by every rendered page
+        RENDER_DPI=int(os.environ.get('RENDER_DPI', 200)),
+        RENDER_THREADS=int(os.environ.get('RENDER_THREADS', 2)),  # poppler threads per window
+        RENDER_MAX_MEMORY_MB=int(os.environ.get('RENDER_MAX_MEMORY_MB', 256)),  # decoded pages per window
+        PAGE_EXTRA_FORMATS=[f for f in os.environ.get('PAGE_EXTRA_FORMATS', '').split(',') if f],  # e.g. webp,avif
+        RENDER_MODE=os.environ.get('RENDER_MODE', 'eager'),  # 'lazy' renders pages on first view
+        RENDER_CACHE_MAX_MB=int(os.environ.get('RENDER_CACHE_MAX_MB', 1024)),
+        PAGE_TILE_SIZE=int(os.environ.get('PAGE_TILE_SIZE', 256)),  # 0 disables deep-zoom tiles
+        AUTO_CREATE_SCHEMA=os.environ.get('AUTO_CREATE_SCHEMA', '').lower() == 'true',  # else run migrations.py
+        PRELOAD_CRYPTO=os.environ.get('PRELOAD_CRYPTO', '').lower() == 'true',  # for gunicorn --preload
+        VIEW_FLUSH_SIZE=int(os.environ.get('VIEW_FLUSH_SIZE', 500)),
+        VIEW_FLUSH_INTERVAL=float(os.environ.get('VIEW_FLUSH_INTERVAL', 2.0)),  # seconds
+        VIEW_BUFFER_MAX=int(os.environ.get('VIEW_BUFFER_MAX', 50000)),  # views dropped beyond this
+        RAW_VIEW_RETENTION_DAYS=int(os.environ.get('RAW_VIEW_RETENTION_DAYS', 90)),  # see rollups.py purge
+        USE_X_SENDFILE=os.environ.get('USE_X_SENDFILE', '').lower() == 'true',  # Apache/lighttpd
+        PAGE_ACCEL_REDIRECT=os.environ.get('PAGE_ACCEL_REDIRECT', ''),  # nginx internal location for uploads
+        IDENTITY_CACHE_TTL=float(os.environ.get('IDENTITY_CACHE_TTL', 30)),  # seconds a revocation may lag
+        IDENTITY_CACHE_SIZE=int(os.environ.get('IDENTITY_CACHE_SIZE', 10000)),
+        PASSWORD_HASH_METHOD=os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1'),  # werkzeug method, defaults filled in
+        PASSWORD_HASH_CONCURRENCY=int(os.environ.get('PASSWORD_HASH_CONCURRENCY', 2)),
+        PASSWORD_HASH_QUEUE_TIMEOUT=float(os.environ.get('PASSWORD_HASH_QUEUE_TIMEOUT', 5.0)),  # then 503
+        MAX_UPLOAD_MB=int(os.environ.get('MAX_UPLOAD_MB', 2048)),  # resumable uploads, sent in chunks
+        UPLOAD_SESSION_MAX_AGE_HOURS=int(os.environ.get('UPLOAD_SESSION_MAX_AGE_HOURS', 24)),
+        STORAGE_BACKEND=os.environ.get('STORAGE_BACKEND', 'local'),  # 'local' or 's3'
+        S3_BUCKET=os.environ.get('S3_BUCKET', ''),
+        S3_PREFIX=os.environ.get('S3_PREFIX', ''),
+        S3_ENDPOINT_URL=os.environ.get('S3_ENDPOINT_URL', ''),  # MinIO or another S3-compatible store
+        S3_REGION=os.environ.get('S3_REGION', ''),
+        S3_MAX_POOL_CONNECTIONS=int(os.environ.get('S3_MAX_POOL_CONNECTIONS', 32)),
+        S3_PRESIGNED_READS=os.environ.get('S3_PRESIGNED_READS', 'true').lower() == 'true',  # else proxied
+        STORAGE_UPLOAD_WORKERS=int(os.environ.get('STORAGE_UPLOAD_WORKERS', 8)),
+        METRICS_ENABLED=os.environ.get('METRICS_ENABLED', 'true').lower() == 'true',
+        METRICS_TOKEN=os.environ.get('METRICS_TOKEN', ''),  # bearer token for /metrics, not served when empty
+        METRICS_QUERY_WARN_COUNT=int(os.environ.get('METRICS_QUERY_WARN_COUNT', 50)),  # log requests above this
+        PROFILE_TOKEN=os.environ.get('PROFILE_TOKEN', ''),  # X-Profile header value that profiles a request
+        PROFILE_SAMPLE_RATE=float(os.environ.get('PROFILE_SAMPLE_RATE', 0)),  # fraction of requests profiled
+        PROFILE_DIR=os.environ.get('PROFILE_DIR', ''),  # .prof files go here, else the top calls are logged
+        ASYNC_DATABASE_URL=os.environ.get('ASYNC_DATABASE_URL', ''),  # asgi.py, derived from DATABASE_URL if empty
+        ASYNC_DB_POOL_SIZE=int(os.environ.get('ASYNC_DB_POOL_SIZE', 20)),
+        ASYNC_DB_MAX_OVERFLOW=int(os.environ.get('ASYNC_DB_MAX_OVERFLOW', 20)),
+        ASYNC_DB_POOL_TIMEOUT=float(os.environ.get('ASYNC_DB_POOL_TIMEOUT', 30))  # seconds to wait for a connection
     )
     logger.info("Application configured successfully")
 
@@ -70,6 +134,10 @@ def configure_uploads(app):
     if not os.path.exists(app.config['UPLOAD_FOLDER']):
         os.makedirs(app.config['UPLOAD_FOLDER'])
         logger.info(f"Created upload folder at {app.config['UPLOAD_FOLDER']}")
+    # Resumable uploads in progress, kept out of the static tree
+    app.config['UPLOAD_SESSION_FOLDER'] = (
+        os.environ.get('UPLOAD_SESSION_FOLDER') or os.path.join(app.instance_path, 'uploads')
+    )
 
 def configure_cors(app):
     """Configure CORS settings."""
@@ -83,11 +151,13 @@ def configure_cors(app):
                      "http://localhost:8080",  # Local development
                      "http://0.0.0.0:8080"    # Local development alternative
                  ],
-                 "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
+                 "methods": ["GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"],
                  "allow_headers": ["Content-Type", "Authorization", 
-                                "X-Requested-With", "Accept", "Origin"],
+                                "X-Requested-With", "Accept", "Origin",
+                                "Upload-Offset", "Upload-Length", "Upload-Title"],
                  "supports_credentials": True,
-                 "expose_headers": ["Content-Range", "X-Content-Range"]
+                 "expose_headers": ["Content-Range", "X-Content-Range",
+                                    "Upload-Offset", "Upload-Length", "Location"]
              }
          })
     logger.info("CORS configured for Replit domains")
@@ -119,5 +189,63 @@ def init_database(app):
     """Initialize the database."""
     # Import models here to avoid circular imports
     import models
-    db.create_all()
-    logger.info("Database initialized successfully")
+    if app.config['AUTO_CREATE_SCHEMA']:
+        db.create_all()
+        from search import ensure_search_index
+        ensure_search_index()
+        logger.info("Database initialized successfully")
+
+def init_storage(app):
+    """Select where PDFs and rendered pages are stored."""
+    from storage import storage
+    storage.init_app(app)
+
+def init_identity_cache(app):
+    """Size the in-process cache used to authenticate tokens and sessions."""
+    from identity import identity_cache
+    identity_cache.init_app(app)
+
+def init_password_hasher(app):
+    """Bound how many password hashes run at once."""
+    from passwords import password_hasher
+    password_hasher.init_app(app)
+
+def init_metrics(app):
+    """Time requests, SQL statements and renders, and serve them on /metrics."""
+    from metrics import metrics
+    from tracking import view_recorder
+    from passwords import password_hasher
+    metrics.init_app(app)
+    metrics.register_collector('view_recorder', view_recorder.stats)
+    metrics.register_collector('password_hasher', password_hasher.stats)
+
+_services_pid = None
+_services_lock = threading.Lock()
+
+def start_services(app):
+    """Start the background workers of the current process, once per process."""
+    global _services_pid
+    with _services_lock:
+        if _services_pid == os.getpid():
+            return
+        _services_pid = os.getpid()
+    with app.app_context():
+        init_page_cache(app)
+        init_render_queue(app)
+        init_view_recorder(app)
+
+def init_page_cache(app):
+    """Set up the disk cache for lazily rendered pages."""
+    from render_cache import page_cache
+    page_cache.init_app(app)
+
+def init_render_queue(app):
+    """Start the background PDF rendering workers."""
+    from jobs import render_queue
+    render_queue.init_app(app)
+    render_queue.requeue_pending()
+
+def init_view_recorder(app):
+    """Start the background writer for buffered page views."""
+    from tracking import view_recorder
+    view_recorder.init_app(app)
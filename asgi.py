@@ -0,0 +1,169 @@
+"""Asyncio serving mode for the read-heavy API endpoints.
+
+Serves the same responses as the Flask views for
+
+    GET /api/flipbooks
+    GET /api/flipbooks/<unique_id>
+    GET /api/flipbooks/<unique_id>/status
+    GET /api/analytics
+
+from a Starlette app over a pooled async engine (asyncpg for Postgres,
+aiosqlite for local SQLite), so a waiting query holds a coroutine instead of
+a worker thread. The models, JWT validation, identity cache and query builders
+are shared with api.py, so tokens, epochs and revocation behave identically.
+Everything else, including all writes, stays on the Flask app; route these
+paths to this process at the proxy. Install the extra and run:
+
+    pip install '.[async]'
+    uvicorn asgi:app --workers 2
+"""
+import contextlib
+from datetime import datetime, timedelta
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from werkzeug.exceptions import NotFound
+from werkzeug.http import parse_etags, quote_etag
+from app import create_app, logger
+from models import Flipbook
+from api import (TokenError, decode_access_token, flipbook_list_query, flipbook_list_page, flipbook_list_body,
+                 flipbook_detail, flipbook_status)
+from identity import identity_cache
+from rollups import analytics_rows_stmt, page_turns_stmt, build_analytics
+
+ANALYTICS_DAYS = 7
+# Same origins as configure_cors in app.py, which flask-cors matches as patterns
+CORS_ORIGINS = ['http://localhost:8080', 'http://0.0.0.0:8080']
+CORS_ORIGIN_REGEX = r'https://.*\.(replit\.app|repl\.co|repl\.dev)'
+
+def async_database_url(url):
+    """Map a sync DATABASE_URL to its async driver, returning (url, connect_args)."""
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend in ('postgres', 'postgresql'):
+        # asyncpg takes ssl as a connect argument instead of libpq's sslmode
+        sslmode = url.query.get('sslmode')
+        url = url.set(drivername='postgresql+asyncpg').difference_update_query(['sslmode'])
+        return url, {'ssl': sslmode} if sslmode and sslmode != 'disable' else {}
+    if backend == 'sqlite':
+        return url.set(drivername='sqlite+aiosqlite'), {}
+    return url, {}
+
+def create_async_session_factory(flask_app):
+    url, connect_args = async_database_url(
+        flask_app.config['ASYNC_DATABASE_URL'] or flask_app.config['SQLALCHEMY_DATABASE_URI']
+    )
+    options = {'pool_pre_ping': True, 'connect_args': connect_args}
+    if url.get_backend_name() != 'sqlite':
+        options.update(
+            pool_size=flask_app.config['ASYNC_DB_POOL_SIZE'],
+            max_overflow=flask_app.config['ASYNC_DB_MAX_OVERFLOW'],
+            pool_timeout=flask_app.config['ASYNC_DB_POOL_TIMEOUT'],
+            pool_recycle=300
+        )
+    engine = create_async_engine(url, **options)
+    logger.info(f"Async API using {url.drivername} with a pool of {options.get('pool_size', 'default')} connections")
+    return engine, async_sessionmaker(engine, expire_on_commit=False)
+
+def create_asgi_app(flask_app=None):
+    """Build the async API app around a Flask app, used for configuration and URL building."""
+    flask_app = flask_app or create_app(run_services=False)
+    engine, session_factory = create_async_session_factory(flask_app)
+
+    def with_request_context(request, func, *args):
+        # page_sources builds URLs with url_for, so give it the same request context Flask would
+        with flask_app.test_request_context(request.url.path, base_url=str(request.base_url)):
+            return func(*args)
+
+    def token_required(view):
+        async def decorated(request):
+            try:
+                data = decode_access_token(request.headers.get('Authorization'))
+            except TokenError as e:
+                return JSONResponse(e.body, status_code=401)
+            async with session_factory() as session:
+                current_user = await identity_cache.authenticate_async(
+                    session, data['user_id'], data.get('epoch', 0)
+                )
+                if not current_user:
+                    return JSONResponse({'error': 'Invalid token'}, status_code=401)
+                return await view(request, session, current_user)
+        return decorated
+
+    async def owned_flipbook(session, current_user, unique_id):
+        flipbook = await session.scalar(select(Flipbook).where(Flipbook.unique_id == unique_id))
+        if flipbook is None:
+            # The HTML page first_or_404 answers with in the Flask view
+            return None, Response(NotFound().get_body(), status_code=404, media_type='text/html')
+        if flipbook.user_id != current_user.id:
+            return None, JSONResponse({'error': 'Unauthorized access'}, status_code=403)
+        return flipbook, None
+
+    @token_required
+    async def list_flipbooks(request, session, current_user):
+        try:
+            fields, limit, stmt = flipbook_list_query(current_user.id, request.query_params)
+        except ValueError as e:
+            return JSONResponse({'error': str(e)}, status_code=400)
+        flipbooks, next_cursor, etag = flipbook_list_page((await session.scalars(stmt)).all(), fields, limit)
+        headers = {'ETag': quote_etag(etag), 'Cache-Control': 'private, no-cache'}
+        if parse_etags(request.headers.get('If-None-Match')).contains(etag):
+            return Response(status_code=304, headers=headers)
+        # Decrypting titles is CPU work, keep it off the event loop
+        body = await run_in_threadpool(flipbook_list_body, flipbooks, fields, next_cursor)
+        return JSONResponse(body, headers=headers)
+
+    @token_required
+    async def get_flipbook(request, session, current_user):
+        flipbook, error = await owned_flipbook(session, current_user, request.path_params['unique_id'])
+        if error:
+            return error
+        # Reads the page manifest, from disk or remote storage
+        return JSONResponse(await run_in_threadpool(with_request_context, request, flipbook_detail, flipbook))
+
+    @token_required
+    async def get_flipbook_status(request, session, current_user):
+        flipbook, error = await owned_flipbook(session, current_user, request.path_params['unique_id'])
+        if error:
+            return error
+        return JSONResponse(flipbook_status(flipbook))
+
+    @token_required
+    async def get_analytics(request, session, current_user):
+        since = datetime.utcnow() - timedelta(days=ANALYTICS_DAYS)
+        rows = (await session.execute(analytics_rows_stmt(current_user.id, since))).all()
+        flipbook_ids = list(dict.fromkeys(row[0].id for row in rows))
+        page_stats = (await session.execute(page_turns_stmt(flipbook_ids))).all() if flipbook_ids else []
+        analytics_data = await run_in_threadpool(build_analytics, rows, page_stats, since, ANALYTICS_DAYS)
+        return JSONResponse({str(flipbook_id): data for flipbook_id, data in analytics_data.items()})
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        yield
+        await engine.dispose()
+
+    return Starlette(
+        routes=[
+            Route('/api/flipbooks', list_flipbooks, methods=['GET']),
+            Route('/api/flipbooks/{unique_id}', get_flipbook, methods=['GET']),
+            Route('/api/flipbooks/{unique_id}/status', get_flipbook_status, methods=['GET']),
+            Route('/api/analytics', get_analytics, methods=['GET']),
+        ],
+        middleware=[Middleware(
+            CORSMiddleware,
+            allow_origins=CORS_ORIGINS,
+            allow_origin_regex=CORS_ORIGIN_REGEX,
+            allow_methods=['GET', 'HEAD', 'OPTIONS'],
+            allow_headers=['Content-Type', 'Authorization', 'X-Requested-With', 'Accept', 'Origin'],
+            allow_credentials=True
+        )],
+        lifespan=lifespan
+    )
+
+app = create_asgi_app()
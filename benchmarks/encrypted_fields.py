@@ -0,0 +1,59 @@
+"""Microbenchmark for EncryptedField against decrypting on every attribute read.
+
+Simulates a dashboard that renders N flipbook titles and reads each title
+several times (template, analytics loop, JSON payload).
+
+    python benchmarks/encrypted_fields.py --rows 2000 --reads 3
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('FLASK_SECRET_KEY', 'benchmark-secret')
+
+from encryption import encryptor, EncryptedField
+
+class PlainRow:
+    def __init__(self, title_encrypted):
+        self.title_encrypted = title_encrypted
+
+    @property
+    def title(self):
+        return encryptor.decrypt(self.title_encrypted)
+
+class CachedRow:
+    title = EncryptedField('title_encrypted')
+
+    def __init__(self, title_encrypted):
+        self.title_encrypted = title_encrypted
+
+def time_reads(rows, reads, prime=False):
+    start = time.perf_counter()
+    if prime:
+        CachedRow.title.decrypt_all(rows)
+    for _ in range(reads):
+        for row in rows:
+            row.title
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--reads', type=int, default=3)
+    args = parser.parse_args()
+
+    tokens = [encryptor.encrypt(f'Catalogue {i}') for i in range(args.rows)]
+    results = {
+        'decrypt per read': time_reads([PlainRow(t) for t in tokens], args.reads),
+        'EncryptedField': time_reads([CachedRow(t) for t in tokens], args.reads),
+        'EncryptedField + decrypt_all': time_reads([CachedRow(t) for t in tokens], args.reads, prime=True),
+    }
+    baseline = results['decrypt per read']
+    print(f"{args.rows} rows, {args.reads} reads per row")
+    for name, elapsed in results.items():
+        print(f"  {name:<30} {elapsed * 1000:8.1f} ms  ({baseline / elapsed:4.1f}x)")
+
+if __name__ == '__main__':
+    main()
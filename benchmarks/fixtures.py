@@ -0,0 +1,91 @@
+"""Synthetic PDFs and a seeded dataset for the benchmark suite."""
+import random
+from datetime import datetime, timedelta
+
+WORDS = ('catalogue', 'garden', 'chair', 'table', 'lamp', 'spring', 'summer', 'oak', 'linen',
+         'brass', 'sofa', 'rug', 'mirror', 'shelf', 'cabinet', 'outdoor', 'cushion', 'walnut')
+BENCH_PASSWORD = 'benchmark-password'
+BENCH_IP = '203.0.113.7'
+
+def make_pdf(path, pages, seed=0, size=(595, 842)):
+    """Write a PDF of `pages` A4 pages of seeded random text, so renders and text extraction do real work."""
+    rng = random.Random(seed)
+    page_ids = [4 + 2 * i for i in range(pages)]
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        f"<< /Type /Pages /Kids [{' '.join(f'{p} 0 R' for p in page_ids)}] /Count {pages} >>".encode(),
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+    ]
+    for number, page_id in enumerate(page_ids, start=1):
+        ops = ['BT', '/F1 14 Tf', '18 TL', f'50 {size[1] - 60} Td', f'(Page {number}) Tj T*']
+        ops += [f"({' '.join(rng.choice(WORDS) for _ in range(8))}) Tj T*" for _ in range(40)]
+        ops.append('ET')
+        stream = '\n'.join(ops).encode()
+        objects.append(
+            f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {size[0]} {size[1]}] '
+            f'/Resources << /Font << /F1 3 0 R >> >> /Contents {page_id + 1} 0 R >>'.encode()
+        )
+        objects.append(b'<< /Length %d >>\nstream\n' % len(stream) + stream + b'\nendstream')
+
+    out = bytearray(b'%PDF-1.4\n')
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b'%d 0 obj\n' % number + body + b'\nendobj\n'
+    xref_offset = len(out)
+    out += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    for offset in offsets:
+        out += b'%010d 00000 n \n' % offset
+    out += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref_offset)
+    with open(path, 'wb') as f:
+        f.write(out)
+    return path
+
+def seed_database(users=10, flipbooks_per_user=5, views=100000, pages=20, days=90, seed=0, batch_size=10000):
+    """Fill an empty schema with users, ready flipbooks and page views, then build the rollups.
+
+    Returns what the scenarios need to address the data: user ids, emails and
+    flipbook ids. Must run inside an app context.
+    """
+    from sqlalchemy import insert
+    from app import db
+    from models import User, Flipbook, PageView
+    from encryption import encryptor
+    from rollups import rebuild_rollups, reconcile_counters
+
+    rng = random.Random(seed)
+    dataset = {'users': [], 'flipbooks': []}
+    for u in range(users):
+        user = User()
+        user.username = f'bench{u}'
+        user.email = f'bench{u}@example.com'
+        user.set_password(BENCH_PASSWORD)
+        db.session.add(user)
+        db.session.flush()
+        dataset['users'].append({'id': user.id, 'email': user.email})
+        for f in range(flipbooks_per_user):
+            flipbook = Flipbook(
+                filename=f'bench-{u}-{f}.pdf', user_id=user.id, page_count=pages, pages_done=pages,
+                status=Flipbook.STATUS_READY
+            )
+            flipbook.title = f"{rng.choice(WORDS).title()} {rng.choice(WORDS)} {u}-{f}"
+            db.session.add(flipbook)
+            db.session.flush()
+            dataset['flipbooks'].append({'id': flipbook.id, 'unique_id': flipbook.unique_id, 'user_id': user.id})
+    db.session.commit()
+
+    # One ciphertext for every row, encrypting millions of IPs would dominate seeding
+    ip_token = encryptor.encrypt(BENCH_IP)
+    flipbook_ids = [f['id'] for f in dataset['flipbooks']]
+    now = datetime.utcnow()
+    for start in range(0, views, batch_size):
+        db.session.execute(insert(PageView), [{
+            'flipbook_id': rng.choice(flipbook_ids),
+            'viewed_at': now - timedelta(seconds=rng.randrange(days * 86400)),
+            'ip_address_encrypted': ip_token,
+            'page_number': rng.randint(1, pages)
+        } for _ in range(min(batch_size, views - start))])
+        db.session.commit()
+    rebuild_rollups()
+    reconcile_counters()
+    return dataset
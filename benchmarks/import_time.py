@@ -0,0 +1,65 @@
+"""Import-time report for the web and API entry points.
+
+Runs a fresh interpreter with ``-X importtime`` and lists the slowest
+modules by cumulative import time, flags heavy render dependencies that
+should only load in render workers, and times the deferred key derivation.
+
+    python benchmarks/import_time.py --top 15
+"""
+import os
+import sys
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENTRY_MODULES = 'import app, models, api, main'
+# Only render workers should ever import these
+RENDER_ONLY_MODULES = ('pdf2image', 'PIL')
+
+def run_importtime(env):
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', ENTRY_MODULES],
+        cwd=ROOT, env=env, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        sys.exit(result.stderr)
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules.append((int(cumulative_us), int(self_us), name.strip()))
+    return modules
+
+def time_key_derivation(env):
+    code = ('import time; from encryption import encryptor; '
+            's = time.perf_counter(); encryptor.warm(); print(time.perf_counter() - s)')
+    result = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=env, capture_output=True, text=True)
+    return float(result.stdout.strip()) if result.returncode == 0 else None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--top', type=int, default=15)
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.setdefault('FLASK_SECRET_KEY', 'import-time-report')
+    env.setdefault('DATABASE_URL', 'sqlite://')
+
+    modules = run_importtime(env)
+    total_us = sum(self_us for _, self_us, _ in modules)
+    print(f"Total import time for '{ENTRY_MODULES}': {total_us / 1000:.1f} ms")
+    print(f"\n{'cumulative':>12} {'self':>10}  module")
+    for cumulative_us, self_us, name in sorted(modules, reverse=True)[:args.top]:
+        print(f"{cumulative_us / 1000:10.1f}ms {self_us / 1000:8.1f}ms  {name}")
+
+    loaded = {name.split('.')[0] for _, _, name in modules}
+    leaked = [m for m in RENDER_ONLY_MODULES if m in loaded]
+    print(f"\nRender-only modules imported at boot: {', '.join(leaked) if leaked else 'none'}")
+
+    derivation = time_key_derivation(env)
+    if derivation is not None:
+        print(f"Deferred key derivation (first encrypt/decrypt): {derivation * 1000:.1f} ms")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,324 @@
+"""End-to-end benchmark suite for ingest, viewer, tracking, analytics and API paths.
+
+Seeds a database with synthetic users, flipbooks and page views (SQLite in a
+temporary directory by default, any DATABASE_URL such as a scratch Postgres
+works too), then runs every scenario in a fresh interpreter so peak RSS is
+per scenario. Reports throughput, p50/p99 latency, peak RSS and SQL queries
+per request. Results can be saved as a baseline and later runs compared
+against it; the comparison exits non-zero on regressions.
+
+    python benchmarks/suite.py --views 1000000 --save benchmarks/baseline.json
+    python benchmarks/suite.py --views 1000000 --compare benchmarks/baseline.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SCENARIOS = ('ingest', 'viewer', 'tracking', 'analytics', 'api', 'export')
+# Metrics compared against a baseline, and whether a higher value is better
+COMPARED_METRICS = {
+    'throughput': True,
+    'p50_ms': False,
+    'p99_ms': False,
+    'queries_per_request': False,
+    'peak_rss_mb': False,
+}
+
+def configure_env(workdir, database_url=None):
+    os.environ.setdefault('FLASK_SECRET_KEY', 'benchmark-secret-key')
+    os.environ['DATABASE_URL'] = database_url or os.environ.get('DATABASE_URL') or \
+        f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ['AUTO_CREATE_SCHEMA'] = 'true'
+    os.environ['RENDER_WORKERS'] = '0'
+
+def build_app(workdir, record_views=True):
+    """The app as a web worker runs it, with uploads and caches kept inside workdir."""
+    from app import create_app
+    from storage import storage
+    from render_cache import page_cache
+    from tracking import view_recorder
+    app = create_app(run_services=False)
+    app.config.update(
+        UPLOAD_FOLDER=os.path.join(workdir, 'uploads'),
+        WTF_CSRF_ENABLED=False
+    )
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    with app.app_context():
+        storage.init_app(app)
+        page_cache.init_app(app)
+        if record_views:
+            view_recorder.init_app(app)
+    return app
+
+class QueryCounter:
+    """Counts SQL statements issued from the measuring thread only, not the background view writer."""
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.thread_id = threading.get_ident()
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self._before)
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() == self.thread_id:
+            self.count += 1
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if platform.system() == 'Darwin' else 1024
+    return resource.getrusage(who).ru_maxrss * scale / (1024 * 1024)
+
+def measure_requests(app, make_request, iterations, warmup=5):
+    """Time `make_request(client, i)` and count its queries; each call must return a response."""
+    from app import db
+    with app.app_context():
+        counter = QueryCounter(db.engine)
+    client = app.test_client()
+    for i in range(warmup):
+        make_request(client, i)
+    latencies = []
+    queries = 0
+    started = time.perf_counter()
+    for i in range(iterations):
+        counter.count = 0
+        request_started = time.perf_counter()
+        response = make_request(client, i)
+        response.get_data()  # consume streamed bodies inside the timing
+        latencies.append(time.perf_counter() - request_started)
+        queries += counter.count
+        if response.status_code >= 400:
+            raise RuntimeError(f"Request failed with {response.status_code}: {response.get_data(as_text=True)[:200]}")
+    elapsed = time.perf_counter() - started
+    return {
+        'requests': iterations,
+        'seconds': round(elapsed, 3),
+        'throughput': round(iterations / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'queries_per_request': round(queries / iterations, 2),
+    }
+
+def login(client, dataset):
+    from fixtures import BENCH_PASSWORD
+    response = client.post('/login', data={'email': dataset['users'][0]['email'], 'password': BENCH_PASSWORD})
+    if response.status_code != 302:
+        raise RuntimeError('Benchmark user could not log in')
+
+def access_token(app, dataset):
+    from app import db
+    from models import User
+    from api import generate_access_token
+    with app.app_context():
+        return generate_access_token(db.session.get(User, dataset['users'][0]['id']))
+
+def scenario_ingest(workdir, dataset, args):
+    """Rasterize and extract the text of one synthetic PDF, as a render worker does."""
+    from fixtures import make_pdf
+    from utils import process_pdf, extract_page_text
+    app = build_app(workdir, record_views=False)
+    pdf_path = make_pdf(os.path.join(workdir, 'ingest.pdf'), args.pages, seed=args.seed)
+    output_dir = os.path.join(workdir, 'ingest')
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.makedirs(output_dir)
+    with app.app_context():
+        started = time.perf_counter()
+        page_count = process_pdf(
+            pdf_path, output_dir,
+            dpi=app.config['RENDER_DPI'],
+            thread_count=app.config['RENDER_THREADS'],
+            max_memory_mb=app.config['RENDER_MAX_MEMORY_MB']
+        )
+        rendered = time.perf_counter()
+        extract_page_text(pdf_path)
+        elapsed = time.perf_counter() - started
+    return {
+        'pages': page_count,
+        'seconds': round(elapsed, 3),
+        'render_seconds': round(rendered - started, 3),
+        'text_seconds': round(elapsed - (rendered - started), 3),
+        'throughput': round(page_count / elapsed, 2),  # pages per second
+        'peak_rss_children_mb': round(peak_rss_mb(resource.RUSAGE_CHILDREN), 1),
+    }
+
+def scenario_viewer(workdir, dataset, args):
+    app = build_app(workdir)
+    rng = random.Random(args.seed)
+    flipbooks = [f['unique_id'] for f in dataset['flipbooks']]
+    return measure_requests(app, lambda client, i: client.get(f'/viewer/{rng.choice(flipbooks)}'), args.requests)
+
+def scenario_tracking(workdir, dataset, args):
+    from tracking import issue_view_session, view_recorder
+    app = build_app(workdir)
+    rng = random.Random(args.seed)
+    with app.test_request_context():
+        tokens = [issue_view_session(f['id'])[1] for f in dataset['flipbooks']]
+
+    def beacon(client, i):
+        page = rng.randint(1, args.pages)
+        return client.post('/track_pages', json={
+            'session': rng.choice(tokens),
+            'page': page,
+            'events': [{'page': page, 'dwell_ms': rng.randint(500, 20000)}]
+        })
+
+    result = measure_requests(app, beacon, args.requests)
+    started = time.perf_counter()
+    view_recorder.shutdown()
+    result['drain_seconds'] = round(time.perf_counter() - started, 3)
+    result.update({f'recorder_{key}': value for key, value in view_recorder.stats().items()})
+    return result
+
+def scenario_analytics(workdir, dataset, args):
+    app = build_app(workdir)
+    client = app.test_client()
+    login(client, dataset)
+    return measure_requests(app, lambda _, i: client.get('/analytics'), args.requests)
+
+def scenario_api(workdir, dataset, args):
+    app = build_app(workdir)
+    headers = {'Authorization': f'Bearer {access_token(app, dataset)}'}
+    paths = ('/api/flipbooks', '/api/analytics')
+    return measure_requests(app, lambda client, i: client.get(paths[i % len(paths)], headers=headers), args.requests)
+
+def scenario_export(workdir, dataset, args):
+    app = build_app(workdir)
+    headers = {'Authorization': f'Bearer {access_token(app, dataset)}'}
+    rows = []
+
+    def export(client, i):
+        response = client.get('/api/analytics/export', headers=headers)
+        rows.append(response.get_data().count(b'\n'))
+        return response
+
+    result = measure_requests(app, export, max(1, args.requests // 50), warmup=1)
+    result['rows_per_export'] = rows[-1]
+    result['rows_per_second'] = round(rows[-1] * result['throughput'], 1)
+    return result
+
+def run_scenario(name, workdir, args):
+    """Child process entry point: run one scenario and print its result as JSON."""
+    configure_env(workdir, args.database_url)
+    with open(os.path.join(workdir, 'dataset.json')) as f:
+        dataset = json.load(f)
+    result = globals()[f'scenario_{name}'](workdir, dataset, args)
+    result['peak_rss_mb'] = round(peak_rss_mb(), 1)
+    print(json.dumps(result))
+
+def seed(workdir, args):
+    from fixtures import seed_database
+    app = build_app(workdir, record_views=False)
+    started = time.perf_counter()
+    with app.app_context():
+        dataset = seed_database(
+            users=args.users, flipbooks_per_user=args.flipbooks, views=args.views,
+            pages=args.pages, seed=args.seed
+        )
+    with open(os.path.join(workdir, 'dataset.json'), 'w') as f:
+        json.dump(dataset, f)
+    print(f"Seeded {args.users} users, {args.users * args.flipbooks} flipbooks and {args.views} page views "
+          f"in {time.perf_counter() - started:.1f}s")
+
+def compare(results, baseline, threshold):
+    """Print each compared metric against the baseline and return the regressions."""
+    regressions = []
+    print(f"\nCompared with baseline (threshold {threshold:.0%}):")
+    for name, metrics in results.items():
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            before = baseline.get(name, {}).get(metric)
+            after = metrics.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            regressed = -change > threshold if higher_is_better else change > threshold
+            flag = '  REGRESSION' if regressed else ''
+            print(f"  {name:<10} {metric:<20} {before:>10} -> {after:<10} {change:+.1%}{flag}")
+            if regressed:
+                regressions.append((name, metric))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma separated subset to run')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--flipbooks', type=int, default=5, help='flipbooks per user')
+    parser.add_argument('--views', type=int, default=100000, help='page view rows to seed')
+    parser.add_argument('--pages', type=int, default=20, help='pages per flipbook and per ingested PDF')
+    parser.add_argument('--requests', type=int, default=200, help='measured requests per scenario')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--database-url', help='defaults to DATABASE_URL or a SQLite file in the work directory')
+    parser.add_argument('--workdir', help='keep the seeded data here instead of a temporary directory')
+    parser.add_argument('--save', metavar='PATH', help='write the results as a baseline')
+    parser.add_argument('--compare', metavar='PATH', help='compare the results with a saved baseline')
+    parser.add_argument('--threshold', type=float, default=0.10, help='relative change counted as a regression')
+    parser.add_argument('--run-scenario', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_scenario:
+        run_scenario(args.run_scenario, args.workdir, args)
+        return
+
+    scenarios = [name for name in args.scenarios.split(',') if name]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        sys.exit(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='flipbook-bench-')
+    configure_env(workdir, args.database_url)
+    try:
+        if not os.path.exists(os.path.join(workdir, 'dataset.json')):
+            seed(workdir, args)
+        results = {}
+        for name in scenarios:
+            child = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--run-scenario', name, '--workdir', workdir] +
+                [arg for arg in sys.argv[1:] if arg != '--workdir' and not arg.startswith('--workdir=')],
+                cwd=ROOT, capture_output=True, text=True
+            )
+            if child.returncode != 0:
+                sys.exit(f"Scenario {name} failed:\n{child.stderr}")
+            results[name] = json.loads(child.stdout.strip().splitlines()[-1])
+            print(f"{name:<10} " + '  '.join(f'{key}={value}' for key, value in results[name].items()))
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'database': os.environ['DATABASE_URL'].split(':', 1)[0],
+            'users': args.users, 'flipbooks': args.flipbooks, 'views': args.views,
+            'pages': args.pages, 'requests': args.requests, 'seed': args.seed,
+        },
+        'results': results
+    }
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nSaved baseline to {args.save}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('meta', {}).get('views') != args.views:
+            print(f"Warning: baseline was seeded with {baseline['meta'].get('views')} page views, not {args.views}")
+        if compare(results, baseline['results'], args.threshold):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
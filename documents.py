@@ -0,0 +1,185 @@
+import os
+import errno
+import shutil
+import hashlib
+from sqlalchemy import update, delete, event
+from sqlalchemy.orm import Session
+from sqlalchemy.exc import IntegrityError
+from app import db, logger
+from models import (Document, Flipbook, PageView, PageTurn, FlipbookDailyStat, FlipbookHourlyStat, PageDailyStat,
+                    FlipbookPageStat, PageText)
+from utils import generate_unique_filename
+from render_cache import page_cache
+from storage import storage
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+def store_upload(file_storage, upload_folder):
+    """Stream an uploaded PDF to disk while hashing it and return its shared Document.
+
+    Identical uploads resolve to the same content-addressed <sha256>.pdf and
+    page directory, so a re-upload never stores or renders the file twice.
+    The caller commits the reference together with the new flipbook.
+    """
+    tmp_path = os.path.join(upload_folder, f'.upload-{generate_unique_filename("upload.pdf")}')
+    hasher = hashlib.sha256()
+    try:
+        with open(tmp_path, 'wb') as out:
+            while True:
+                chunk = file_storage.stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                out.write(chunk)
+        # From here on the file belongs to the transaction, see place_pending_files
+        return acquire_document(hasher.hexdigest(), tmp_path, upload_folder, discard_on_rollback=True)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def acquire_document(content_hash, pdf_path, upload_folder, discard_on_rollback=False):
+    """Take a reference on the Document for content_hash; the caller commits.
+
+    The Document row and reference are only flushed, so they commit or roll
+    back together with the caller's flipbook. pdf_path is moved into place once
+    that commit succeeds; if the transaction is rolled back instead it is left
+    for a retry, or deleted with discard_on_rollback.
+    """
+    while True:
+        document = Document.query.filter_by(content_hash=content_hash).first()
+        if document is None:
+            document = Document(content_hash=content_hash, filename=f'{content_hash}.pdf', ref_count=0)
+            try:
+                with db.session.begin_nested():
+                    db.session.add(document)
+            except IntegrityError:
+                # Another upload of the same content created it first
+                continue
+
+        result = db.session.execute(
+            update(Document)
+            .where(Document.id == document.id)
+            .values(ref_count=Document.ref_count + 1)
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount == 1:
+            break
+        # delete_flipbook dropped its last reference since the lookup, start over with a new row
+        db.session.expunge(document)
+
+    db.session.info.setdefault('pending_document_files', []).append(
+        (pdf_path, document.filename, upload_folder, discard_on_rollback)
+    )
+    return document
+
+def place_document_file(pdf_path, filename, upload_folder):
+    """Put a committed document's PDF in place, unless an identical upload already did."""
+    final_path = os.path.join(upload_folder, filename)
+    if os.path.exists(final_path):
+        os.remove(pdf_path)  # Same content, already stored
+        return
+    move_into_place(pdf_path, final_path)
+    storage.put_file(final_path, filename)
+
+@event.listens_for(Session, 'after_commit')
+def _place_committed_files(session):
+    for pdf_path, filename, upload_folder, _ in session.info.pop('pending_document_files', ()):
+        place_document_file(pdf_path, filename, upload_folder)
+
+@event.listens_for(Session, 'after_transaction_end')
+def _drop_uncommitted_files(session, transaction):
+    if transaction.parent is not None:
+        return  # a savepoint, the outer transaction may still commit
+    # Still pending at the end of the outer transaction means it did not commit
+    for pdf_path, _, _, discard in session.info.pop('pending_document_files', ()):
+        if discard and os.path.exists(pdf_path):
+            os.remove(pdf_path)
+
+def move_into_place(src_path, final_path):
+    """Atomically move a file to final_path, even from another filesystem."""
+    try:
+        os.replace(src_path, final_path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # Copy next to the target first, so readers never see a partial file
+        staged_path = f'{final_path}.{generate_unique_filename("move.tmp")}'
+        try:
+            shutil.copyfile(src_path, staged_path)
+            os.replace(staged_path, final_path)
+        finally:
+            if os.path.exists(staged_path):
+                os.remove(staged_path)
+        os.remove(src_path)
+
+def attach_document(flipbook, document):
+    """Point a new flipbook at a document, reusing its pages if they are already rendered."""
+    flipbook.document_id = document.id
+    flipbook.filename = document.filename
+    if document.rendered_at is not None:
+        flipbook.status = Flipbook.STATUS_READY
+        flipbook.page_count = document.page_count
+        flipbook.pages_done = document.page_count
+    else:
+        flipbook.status = Flipbook.STATUS_QUEUED
+
+def mark_document_rendered(document, page_count, rendered_at):
+    """Record a finished render and release every flipbook waiting on the same pages."""
+    document.page_count = page_count
+    document.rendered_at = rendered_at
+    document.rendering_by = None
+    document.render_lease_until = None
+    db.session.execute(
+        update(Flipbook)
+        .where(
+            Flipbook.document_id == document.id,
+            Flipbook.status.in_([Flipbook.STATUS_QUEUED, Flipbook.STATUS_RENDERING])
+        )
+        .values(status=Flipbook.STATUS_READY, page_count=page_count, pages_done=page_count)
+    )
+
+def delete_flipbook(flipbook, upload_folder):
+    """Delete a flipbook and drop its document reference, removing files once unreferenced."""
+    document = flipbook.document
+    orphaned = None
+    for model in (PageView, PageTurn, FlipbookDailyStat, FlipbookHourlyStat, PageDailyStat, FlipbookPageStat):
+        model.query.filter_by(flipbook_id=flipbook.id).delete()
+    db.session.delete(flipbook)
+
+    if document is None:
+        # Uploaded before deduplication, the files belong to this flipbook alone
+        orphaned = flipbook.filename
+    else:
+        db.session.execute(
+            update(Document)
+            .where(Document.id == document.id)
+            .values(ref_count=Document.ref_count - 1)
+        )
+        # Conditional, so an upload that took a reference since the decrement keeps the document
+        unreferenced = db.select(Document.id).where(Document.id == document.id, Document.ref_count <= 0)
+        db.session.execute(
+            delete(PageText)
+            .where(PageText.document_id.in_(unreferenced))
+            .execution_options(synchronize_session=False)
+        )
+        result = db.session.execute(
+            delete(Document)
+            .where(Document.id == document.id, Document.ref_count <= 0)
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount == 1:
+            orphaned = document.filename
+    db.session.commit()
+
+    if orphaned:
+        pdf_path = os.path.join(upload_folder, orphaned)
+        if os.path.exists(pdf_path):
+            os.remove(pdf_path)
+        asset_dir = orphaned.rsplit('.', 1)[0]
+        shutil.rmtree(os.path.join(upload_folder, asset_dir), ignore_errors=True)
+        if storage.remote:
+            storage.delete(orphaned)
+            storage.delete_prefix(asset_dir)
+        page_cache.discard(asset_dir)
+        logger.info(f"Removed unreferenced assets for {orphaned}")
@@ -1,17 +1,56 @@
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, MultiFernet
 import os
+import hmac
+import threading
 import base64
+import hashlib
 from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 
 class Encryptor:
+    """Field encryption keyed from FLASK_SECRET_KEY.
+
+    Keys are derived on first use so importing this module stays cheap. A
+    preloading master process (gunicorn --preload) calls warm() once so the
+    workers it forks inherit the derived keys.
+    """
+
     def __init__(self):
-        self.key = self._get_or_generate_key()
-        self.fernet = Fernet(self.key)
+        self.key = None
+        self._fernet = None
+        self._index_key = None
+        self._previous_index_keys = []
+        self._lock = threading.Lock()
+
+    def warm(self):
+        with self._lock:
+            if self._fernet is not None:
+                return
+            self.key = self._get_or_generate_key()
+            # Secrets retired by a key rotation stay readable until rows are re-encrypted
+            previous_secrets = [s for s in os.environ.get('FLASK_SECRET_KEY_PREVIOUS', '').split(',') if s]
+            self._index_key = self._derive_index_key()
+            self._previous_index_keys = [self._derive_index_key(s) for s in previous_secrets]
+            self._fernet = MultiFernet(
+                [Fernet(self.key)] + [Fernet(self._get_or_generate_key(s)) for s in previous_secrets]
+            )
 
-    def _get_or_generate_key(self):
+    @property
+    def fernet(self):
+        if self._fernet is None:
+            self.warm()
+        return self._fernet
+
+    @property
+    def index_key(self):
+        if self._fernet is None:
+            self.warm()
+        return self._index_key
+
+    def _get_or_generate_key(self, secret=None):
         # Use Flask secret key to derive encryption key
-        secret_key = os.environ.get('FLASK_SECRET_KEY').encode()
+        secret_key = (secret or os.environ.get('FLASK_SECRET_KEY')).encode()
         salt = b'pdf_flipbook_salt'  # Constant salt for consistent key derivation
         
         kdf = PBKDF2HMAC(
@@ -23,6 +62,30 @@ class Encryptor:
         key = base64.urlsafe_b64encode(kdf.derive(secret_key))
         return key
 
+    def _derive_index_key(self, secret=None):
+        # Separate key so blind index hashes reveal nothing about the Fernet key
+        hkdf = HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=b'pdf_flipbook_blind_index',
+            info=b'blind-index',
+        )
+        return hkdf.derive((secret or os.environ.get('FLASK_SECRET_KEY')).encode())
+
+    def blind_index(self, data):
+        """Deterministic keyed hash of a value, safe to store in an indexed column for equality lookups."""
+        if data is None:
+            return None
+        return hmac.new(self.index_key, data.encode(), hashlib.sha256).hexdigest()
+
+    def previous_blind_indexes(self, data):
+        """Blind indexes of a value under the retired secrets, for rows not yet rotated."""
+        if data is None:
+            return []
+        if self._fernet is None:
+            self.warm()
+        return [hmac.new(key, data.encode(), hashlib.sha256).hexdigest() for key in self._previous_index_keys]
+
     def encrypt(self, data):
         if data is None:
             return None
@@ -33,5 +96,51 @@ class Encryptor:
             return None
         return self.fernet.decrypt(encrypted_data.encode()).decode()
 
+    def rotate(self, encrypted_data):
+        """Re-encrypt a token under the current key, whichever key it was written with."""
+        if encrypted_data is None:
+            return None
+        return self.fernet.rotate(encrypted_data.encode()).decode()
+
+class EncryptedField:
+    """Plaintext view of an encrypted column, decrypted at most once per loaded instance.
+
+    The plaintext is cached on the instance together with the ciphertext it
+    came from, so a refreshed or reassigned column is decrypted again while
+    repeated reads in templates and loops cost a dict lookup.
+    """
+
+    def __init__(self, column_name):
+        self.column_name = column_name
+
+    def __set_name__(self, owner, name):
+        self.cache_name = f'_{name}_plaintext'
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        ciphertext = getattr(instance, self.column_name)
+        cached = instance.__dict__.get(self.cache_name)
+        if cached is not None and cached[0] == ciphertext:
+            return cached[1]
+        plaintext = encryptor.decrypt(ciphertext)
+        instance.__dict__[self.cache_name] = (ciphertext, plaintext)
+        return plaintext
+
+    def __set__(self, instance, value):
+        ciphertext = encryptor.encrypt(value)
+        setattr(instance, self.column_name, ciphertext)
+        instance.__dict__[self.cache_name] = (ciphertext, value)
+
+    def decrypt_all(self, instances):
+        """Decrypt a whole result set in one pass, decrypting each distinct ciphertext once."""
+        plaintexts = {}
+        for instance in instances:
+            ciphertext = getattr(instance, self.column_name)
+            if ciphertext not in plaintexts:
+                plaintexts[ciphertext] = encryptor.decrypt(ciphertext)
+            instance.__dict__[self.cache_name] = (ciphertext, plaintexts[ciphertext])
+        return instances
+
 # Global encryptor instance
 encryptor = Encryptor()
@@ -0,0 +1,110 @@
+import io
+import csv
+import json
+import zlib
+from datetime import datetime, timedelta
+from sqlalchemy import select
+from app import db
+from models import Flipbook, PageView
+
+# Rows fetched per round-trip from the server-side cursor
+EXPORT_BATCH_SIZE = 5000
+# Bytes of output collected before a chunk is sent to the client
+EXPORT_CHUNK_SIZE = 64 * 1024
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+EXPORT_COLUMNS = ['viewed_at', 'flipbook', 'page_number']
+
+def parse_export_range(start, end):
+    """Turn inclusive YYYY-MM-DD bounds into a half-open datetime range, either may be None."""
+    start = datetime.strptime(start, '%Y-%m-%d') if start else None
+    end = datetime.strptime(end, '%Y-%m-%d') + timedelta(days=1) if end else None
+    if start and end and start >= end:
+        raise ValueError('from must not be after to')
+    return start, end
+
+def clamp_export_range(start, end, retention_days):
+    """Limit a range to the raw rows the purge keeps, returning (start, end, clamped).
+
+    Views older than the retention window only survive in the rollups, so a
+    range that ends before it is rejected and one that starts before it is
+    cut short.
+    """
+    earliest = datetime.utcnow() - timedelta(days=retention_days)
+    if end and end <= earliest:
+        raise ValueError(f'raw page views are only kept for {retention_days} days')
+    if start and start >= earliest:
+        return start, end, False
+    return earliest, end, True
+
+def _export_rows(user_id, start, end, flipbook_id=None):
+    stmt = select(
+        PageView.viewed_at, Flipbook.unique_id, PageView.page_number
+    ).join(
+        Flipbook, Flipbook.id == PageView.flipbook_id
+    ).where(
+        Flipbook.user_id == user_id
+    ).order_by(PageView.id)
+    if start:
+        stmt = stmt.where(PageView.viewed_at >= start)
+    if end:
+        stmt = stmt.where(PageView.viewed_at < end)
+    if flipbook_id:
+        stmt = stmt.where(PageView.flipbook_id == flipbook_id)
+    # yield_per streams from a server-side cursor on Postgres instead of
+    # buffering the whole result set in the driver
+    result = db.session.execute(stmt.execution_options(yield_per=EXPORT_BATCH_SIZE))
+    for partition in result.partitions():
+        yield partition
+
+def _ndjson_lines(partition):
+    return ''.join(
+        json.dumps({
+            'viewed_at': viewed_at.isoformat(),
+            'flipbook': unique_id,
+            'page_number': page_number
+        }) + '\n'
+        for viewed_at, unique_id, page_number in partition
+    )
+
+def _csv_lines(partition):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerows(
+        (viewed_at.isoformat(), unique_id, page_number)
+        for viewed_at, unique_id, page_number in partition
+    )
+    return buffer.getvalue()
+
+def stream_page_views(user_id, start, end, fmt='ndjson', flipbook_id=None, compress=False):
+    """Yield encoded chunks of a user's raw page views, holding one batch in memory at a time."""
+    encode = _csv_lines if fmt == 'csv' else _ndjson_lines
+    compressor = zlib.compressobj(wbits=31) if compress else None  # wbits=31 writes a gzip container
+    pending = []
+    pending_size = 0
+
+    def emit(text):
+        data = text.encode('utf-8')
+        return compressor.compress(data) if compressor else data
+
+    try:
+        if fmt == 'csv':
+            pending.append(emit(','.join(EXPORT_COLUMNS) + '\r\n'))
+        for partition in _export_rows(user_id, start, end, flipbook_id):
+            chunk = emit(encode(partition))
+            pending.append(chunk)
+            pending_size += len(chunk)
+            if pending_size >= EXPORT_CHUNK_SIZE:
+                if compressor:
+                    pending.append(compressor.flush(zlib.Z_SYNC_FLUSH))
+                yield b''.join(pending)
+                pending = []
+                pending_size = 0
+        if compressor:
+            pending.append(compressor.flush())
+        yield b''.join(pending)
+    finally:
+        # Release the cursor and connection even if the client disconnects mid-stream
+        db.session.close()
@@ -33,7 +33,7 @@ class RegisterForm(FlaskForm):
             raise ValidationError('Username can only contain letters and numbers.')
 
     def validate_email(self, field):
-        user = User.query.filter_by(email=field.data).first()
+        user = User.find_by_email(field.data)
         if user:
             raise ValidationError('This email address is already registered.')
 
@@ -41,3 +41,6 @@ class UploadForm(FlaskForm):
     title = StringField('Title', validators=[DataRequired()])
     pdf_file = FileField('PDF File', validators=[DataRequired()])
     submit = SubmitField('Upload')
+
+class DeleteForm(FlaskForm):
+    submit = SubmitField('Delete')
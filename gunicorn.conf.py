@@ -0,0 +1,17 @@
+"""gunicorn hooks, loaded automatically when gunicorn runs from this directory.
+
+With --preload the app is created once in the master and forked. Pooled
+database connections must not be shared across the fork, and background
+threads do not survive it, so each worker drops the inherited pool and
+starts its own render workers and view writer.
+
+    gunicorn --preload -w 4 -b 0.0.0.0:8080 run:app
+"""
+
+def post_fork(server, worker):
+    from app import db, start_services
+    from run import app
+    with app.app_context():
+        # close=False leaves the master's connections alone, the worker just forgets them
+        db.engine.dispose(close=False)
+    start_services(app)
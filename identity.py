@@ -0,0 +1,112 @@
+import time
+import threading
+from collections import OrderedDict
+from flask_login import UserMixin
+from sqlalchemy import select, event
+from sqlalchemy.orm import Session
+from app import db, logger
+from models import User
+
+class Identity(UserMixin):
+    """The parts of a user that authenticated requests need, safe to share between threads."""
+
+    def __init__(self, id, username, auth_epoch):
+        self.id = id
+        self.username = username
+        self.auth_epoch = auth_epoch
+
+    def get_id(self):
+        return User.session_id_for(self.id, self.auth_epoch)
+
+class IdentityCache:
+    """In-process TTL/LRU cache of user identities and their revocation epochs.
+
+    Access tokens and login sessions carry the user's auth_epoch. A request is
+    authenticated against the cached epoch, so most requests never query the
+    database for identity. Bumping the epoch (logout, password change)
+    invalidates the entry in this process immediately and in other processes
+    once their entry expires, after at most IDENTITY_CACHE_TTL seconds.
+    """
+
+    def __init__(self):
+        self.ttl = 30
+        self.max_size = 10000
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        self.ttl = app.config['IDENTITY_CACHE_TTL']
+        self.max_size = app.config['IDENTITY_CACHE_SIZE']
+        logger.info(f"Identity cache holding {self.max_size} users for {self.ttl}s")
+
+    def get(self, user_id):
+        """Return the Identity for user_id, loading it on a miss, or None if the user does not exist."""
+        identity = self._cached(user_id)
+        if identity is None:
+            identity = self._store(user_id, db.session.execute(self._identity_stmt(user_id)).first())
+        return identity
+
+    async def get_async(self, session, user_id):
+        """get() for the async API tier, loading misses through an AsyncSession."""
+        identity = self._cached(user_id)
+        if identity is None:
+            identity = self._store(user_id, (await session.execute(self._identity_stmt(user_id))).first())
+        return identity
+
+    def authenticate(self, user_id, auth_epoch):
+        """Return the Identity if auth_epoch is still current for the user, else None."""
+        return self._check_epoch(self.get(user_id), auth_epoch)
+
+    async def authenticate_async(self, session, user_id, auth_epoch):
+        return self._check_epoch(await self.get_async(session, user_id), auth_epoch)
+
+    def _check_epoch(self, identity, auth_epoch):
+        if identity is None or identity.auth_epoch != auth_epoch:
+            return None
+        return identity
+
+    def _identity_stmt(self, user_id):
+        return select(User.id, User.username, User.auth_epoch).where(User.id == user_id)
+
+    def _cached(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        return None
+
+    def _store(self, user_id, row):
+        if row is None:
+            return None
+        identity = Identity(row.id, row.username, row.auth_epoch or 0)
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, identity)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return identity
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def invalidate_after_commit(self, session, user_id):
+        """Invalidate once the session commits; earlier, a concurrent request could cache the old epoch again."""
+        session.info.setdefault('invalidated_identities', set()).add(user_id)
+
+# Global identity cache instance
+identity_cache = IdentityCache()
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_committed(session):
+    for user_id in session.info.pop('invalidated_identities', ()):
+        identity_cache.invalidate(user_id)
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_rolled_back(session):
+    session.info.pop('invalidated_identities', None)
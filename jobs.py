@@ -0,0 +1,210 @@
+import os
+import queue
+import shutil
+import threading
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import update, or_
+from app import db, logger
+from models import Flipbook, Document
+from utils import process_pdf, prepare_pdf_lazy, extract_page_text
+from documents import mark_document_rendered
+from storage import storage
+from search import index_document
+
+class RenderQueue:
+    """Worker pool that rasterizes uploaded PDFs outside the request cycle.
+
+    The flipbook row is the source of truth for every job. Workers claim a job
+    by atomically moving it from queued to rendering, so several processes
+    sharing one database never render the same flipbook twice. Flipbooks of
+    the same content additionally share one render, owned by whichever job
+    takes the document's lease.
+    """
+
+    def __init__(self):
+        self.app = None
+        self._queue = queue.Queue()
+        self._workers = []
+
+    def init_app(self, app):
+        self.app = app
+        for i in range(app.config['RENDER_WORKERS']):
+            worker = threading.Thread(target=self._run, name=f'render-worker-{i}', daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        logger.info(f"Render queue started with {len(self._workers)} workers")
+
+    def enqueue(self, flipbook_id):
+        if not self._workers:
+            # No worker pool configured, render in the calling thread
+            render_flipbook(flipbook_id)
+            return
+        self._queue.put(flipbook_id)
+
+    def requeue_pending(self):
+        """Pick up flipbooks that were queued before this process started.
+
+        Jobs left rendering by a process that died are queued again once the
+        lease on their document has run out.
+        """
+        stale_documents = db.select(Document.id).where(
+            Document.rendered_at.is_(None),
+            or_(Document.render_lease_until.is_(None), Document.render_lease_until < datetime.utcnow())
+        )
+        stale = db.session.execute(
+            update(Flipbook)
+            .where(Flipbook.status == Flipbook.STATUS_RENDERING, Flipbook.document_id.in_(stale_documents))
+            .values(status=Flipbook.STATUS_QUEUED)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.session.commit()
+        if stale:
+            logger.warning(f"Reset {stale} render jobs abandoned by a dead worker")
+        pending = db.session.execute(
+            db.select(Flipbook.id).filter_by(status=Flipbook.STATUS_QUEUED)
+        ).scalars().all()
+        for flipbook_id in pending:
+            self.enqueue(flipbook_id)
+        if pending:
+            logger.info(f"Requeued {len(pending)} pending render jobs")
+
+    def _run(self):
+        while True:
+            flipbook_id = self._queue.get()
+            try:
+                with self.app.app_context():
+                    render_flipbook(flipbook_id)
+            except Exception as e:
+                logger.error(f"Render worker failed on flipbook {flipbook_id}: {str(e)}")
+            finally:
+                self._queue.task_done()
+
+def claim_flipbook(flipbook_id):
+    result = db.session.execute(
+        update(Flipbook)
+        .where(Flipbook.id == flipbook_id, Flipbook.status == Flipbook.STATUS_QUEUED)
+        .values(status=Flipbook.STATUS_RENDERING, pages_done=0, error_message=None)
+    )
+    db.session.commit()
+    return result.rowcount == 1
+
+def claim_document(document, flipbook_id):
+    """Take or renew the render lease on a document; False while another live job owns it."""
+    now = datetime.utcnow()
+    result = db.session.execute(
+        update(Document)
+        .where(
+            Document.id == document.id,
+            Document.rendered_at.is_(None),
+            or_(
+                Document.rendering_by.is_(None),
+                Document.rendering_by == flipbook_id,
+                Document.render_lease_until < now
+            )
+        )
+        .values(
+            rendering_by=flipbook_id,
+            render_lease_until=now + timedelta(seconds=current_app.config['RENDER_LEASE_SECONDS'])
+        )
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return result.rowcount == 1
+
+def index_page_text(document, pdf_path):
+    """Extract and index the document's text; a failure only costs search, not the render."""
+    try:
+        with db.session.begin_nested():
+            index_document(document.id, extract_page_text(pdf_path))
+    except Exception as e:
+        logger.warning(f"Could not index text of document {document.id}: {str(e)}")
+
+def render_flipbook(flipbook_id):
+    if not claim_flipbook(flipbook_id):
+        return
+
+    flipbook = db.session.get(Flipbook, flipbook_id)
+    document = flipbook.document
+    if document is not None and document.rendered_at is not None:
+        # Same content was rendered by another upload while this job waited
+        mark_document_rendered(document, document.page_count, document.rendered_at)
+        db.session.commit()
+        return
+    if document is not None and not claim_document(document, flipbook.id):
+        db.session.refresh(document)
+        if document.rendered_at is not None:
+            # The owner finished between the two checks
+            mark_document_rendered(document, document.page_count, document.rendered_at)
+        else:
+            # Another job owns the render and releases this flipbook when it succeeds or fails
+            flipbook.status = Flipbook.STATUS_QUEUED
+        db.session.commit()
+        return
+
+    output_dir = storage.path(flipbook.asset_dir)
+
+    def report_progress(pages_done, page_count):
+        flipbook.pages_done = pages_done
+        flipbook.page_count = page_count
+        if document is not None:
+            claim_document(document, flipbook.id)  # renews the lease, and commits
+        else:
+            db.session.commit()
+
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+        pdf_path = storage.ensure_local(flipbook.filename)
+        if current_app.config['RENDER_MODE'] == 'lazy':
+            page_count = prepare_pdf_lazy(
+                pdf_path,
+                output_dir,
+                progress_callback=report_progress,
+                dpi=current_app.config['RENDER_DPI'],
+                extra_formats=current_app.config['PAGE_EXTRA_FORMATS'],
+                tile_size=current_app.config['PAGE_TILE_SIZE']
+            )
+        else:
+            page_count = process_pdf(
+                pdf_path,
+                output_dir,
+                progress_callback=report_progress,
+                dpi=current_app.config['RENDER_DPI'],
+                thread_count=current_app.config['RENDER_THREADS'],
+                max_memory_mb=current_app.config['RENDER_MAX_MEMORY_MB'],
+                extra_formats=current_app.config['PAGE_EXTRA_FORMATS'],
+                tile_size=current_app.config['PAGE_TILE_SIZE']
+            )
+        if document is not None:
+            index_page_text(document, pdf_path)
+        storage.put_dir(output_dir, flipbook.asset_dir)
+        if storage.remote:
+            # Published, other nodes serve the pages from the bucket
+            shutil.rmtree(output_dir, ignore_errors=True)
+        flipbook.page_count = page_count
+        flipbook.pages_done = page_count
+        flipbook.status = Flipbook.STATUS_READY
+        if document is not None:
+            mark_document_rendered(document, page_count, datetime.utcnow())
+        db.session.commit()
+        logger.info(f"Rendered flipbook {flipbook.unique_id} ({page_count} pages)")
+    except Exception as e:
+        db.session.rollback()
+        flipbook.status = Flipbook.STATUS_FAILED
+        flipbook.error_message = str(e)
+        if document is not None:
+            # Flipbooks waiting on the same pages would otherwise stay queued
+            Flipbook.query.filter_by(
+                document_id=document.id, status=Flipbook.STATUS_QUEUED
+            ).update({'status': Flipbook.STATUS_FAILED, 'error_message': str(e)})
+            db.session.execute(
+                update(Document)
+                .where(Document.id == document.id, Document.rendering_by == flipbook.id)
+                .values(rendering_by=None, render_lease_until=None)
+                .execution_options(synchronize_session=False)
+            )
+        db.session.commit()
+        logger.error(f"Error processing PDF for flipbook {flipbook.unique_id}: {str(e)}")
+
+# Global render queue instance
+render_queue = RenderQueue()
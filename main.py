@@ -1,19 +1,28 @@
-from flask import render_template, redirect, url_for, flash, request, jsonify
+from flask import render_template, redirect, url_for, flash, request, jsonify, abort
 from flask_login import login_user, logout_user, login_required, current_user
-from werkzeug.utils import secure_filename
-from sqlalchemy import func
 from app import db, login_manager, logger
-from models import User, Flipbook, PageView
-from forms import LoginForm, RegisterForm, UploadForm
-from utils import allowed_file, process_pdf, generate_unique_filename
+from models import User, Flipbook
+from forms import LoginForm, RegisterForm, UploadForm, DeleteForm
+from utils import (allowed_file, first_page_source, render_page, load_page_manifest, find_page_variant,
+                   send_page_asset, send_stored_asset, page_is_lazy, PAGE_IMG_SIZES, PAGE_FILE_PATTERN)
+from storage import storage
+from render_cache import page_cache
+from jobs import render_queue
+from tracking import view_recorder, issue_view_session, read_view_session, parse_beacon
+from documents import store_upload, attach_document, delete_flipbook
+from rollups import flipbook_analytics
+from identity import identity_cache
+from passwords import PasswordHashBusy
+from werkzeug.security import safe_join
 import os
-from datetime import datetime, timedelta
 
 def init_routes(app):
     @login_manager.user_loader
     def load_user(id):
         try:
-            return db.session.get(User, int(id))
+            # "<id>:<auth_epoch>", sessions from before epochs hold just the id
+            user_id, _, auth_epoch = id.partition(':')
+            return identity_cache.authenticate(int(user_id), int(auth_epoch or 0))
         except Exception as e:
             logger.error(f"Error loading user: {str(e)}")
             return None
@@ -29,8 +38,9 @@ def init_routes(app):
         
         form = LoginForm()
         if form.validate_on_submit():
-            user = User.query.filter_by(email=form.email.data).first()
+            user = User.find_by_email(form.email.data)
             if user and user.check_password(form.password.data):
+                db.session.commit()  # persists a rehashed password
                 login_user(user)
                 flash('Logged in successfully.', 'success')
                 next_page = request.args.get('next')
@@ -57,6 +67,9 @@ def init_routes(app):
                 flash('Registration successful! Please login with your credentials.', 'success')
                 return redirect(url_for('login'))
                 
+            except PasswordHashBusy:
+                db.session.rollback()
+                raise
             except Exception as e:
                 db.session.rollback()
                 logger.error(f"Registration error: {str(e)}")
@@ -74,8 +87,23 @@ def init_routes(app):
     @app.route('/dashboard')
     @login_required
     def dashboard():
-        flipbooks = Flipbook.query.filter_by(user_id=current_user.id).all()
-        return render_template('dashboard.html', flipbooks=flipbooks)
+        flipbooks = Flipbook.title.decrypt_all(Flipbook.query.filter_by(user_id=current_user.id).all())
+        return render_template('dashboard.html', flipbooks=flipbooks, delete_form=DeleteForm())
+
+    @app.route('/flipbook/<unique_id>/delete', methods=['POST'])
+    @login_required
+    def delete_flipbook_view(unique_id):
+        flipbook = Flipbook.query.filter_by(unique_id=unique_id, user_id=current_user.id).first_or_404()
+        form = DeleteForm()
+        if form.validate_on_submit():
+            try:
+                delete_flipbook(flipbook, app.config['UPLOAD_FOLDER'])
+                flash('Flipbook deleted.', 'info')
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Error deleting flipbook: {str(e)}")
+                flash('An error occurred while deleting the flipbook.', 'error')
+        return redirect(url_for('dashboard'))
 
     @app.route('/upload', methods=['GET', 'POST'])
     @login_required
@@ -84,27 +112,25 @@ def init_routes(app):
         if form.validate_on_submit():
             file = form.pdf_file.data
             if file and allowed_file(file.filename):
-                filename = generate_unique_filename(secure_filename(file.filename))
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(filepath)
-                
                 try:
-                    output_dir = os.path.join(app.config['UPLOAD_FOLDER'], filename.rsplit('.', 1)[0])
-                    os.makedirs(output_dir, exist_ok=True)
-                    page_count = process_pdf(filepath, output_dir)
+                    document = store_upload(file, app.config['UPLOAD_FOLDER'])
                     
                     flipbook = Flipbook()
                     flipbook.title = form.title.data
-                    flipbook.filename = filename
                     flipbook.user_id = current_user.id
-                    flipbook.page_count = page_count
+                    attach_document(flipbook, document)
                     
                     db.session.add(flipbook)
                     db.session.commit()
-                    flash('Flipbook created successfully!', 'success')
+                    if flipbook.is_ready:
+                        flash('Flipbook created successfully!', 'success')
+                    else:
+                        render_queue.enqueue(flipbook.id)
+                        flash('Flipbook uploaded! Pages are being rendered in the background.', 'success')
                     return redirect(url_for('dashboard'))
                 except Exception as e:
-                    logger.error(f"Error processing PDF: {str(e)}")
+                    db.session.rollback()
+                    logger.error(f"Error queueing PDF: {str(e)}")
                     flash(f'Error processing PDF: {str(e)}', 'error')
             else:
                 flash('Invalid file format. Please upload a PDF file.', 'error')
@@ -114,75 +140,84 @@ def init_routes(app):
     def viewer(unique_id):
         flipbook = Flipbook.query.filter_by(unique_id=unique_id).first_or_404()
         
-        page_view = PageView()
-        page_view.flipbook_id = flipbook.id
-        page_view.ip_address = request.remote_addr
-        
-        db.session.add(page_view)
-        db.session.commit()
+        session_id, view_session = issue_view_session(flipbook.id)
+        view_recorder.record(flipbook.id, request.remote_addr, session_id)
         
-        return render_template('viewer.html', flipbook=flipbook)
+        return render_template('viewer.html', flipbook=flipbook, first_page=first_page_source(flipbook),
+                               page_sizes=PAGE_IMG_SIZES, view_session=view_session)
 
     @app.route('/embed/<unique_id>')
     def embed_viewer(unique_id):
         flipbook = Flipbook.query.filter_by(unique_id=unique_id).first_or_404()
         
-        page_view = PageView()
-        page_view.flipbook_id = flipbook.id
-        page_view.ip_address = request.remote_addr
+        session_id, view_session = issue_view_session(flipbook.id)
+        view_recorder.record(flipbook.id, request.remote_addr, session_id)
         
-        db.session.add(page_view)
-        db.session.commit()
+        return render_template('embed.html', flipbook=flipbook, first_page=first_page_source(flipbook),
+                               page_sizes=PAGE_IMG_SIZES, view_session=view_session)
+
+    def send_page_file(flipbook, page_number, relative_path):
+        # Page 1 and eagerly rendered pages live next to the PDF
+        key = f'{flipbook.asset_dir}/{relative_path}'
+        if storage.remote:
+            if not page_is_lazy(flipbook.asset_dir, page_number):
+                return send_stored_asset(key)
+        elif os.path.exists(storage.path(key)):
+            return send_stored_asset(key)
         
-        return render_template('embed.html', flipbook=flipbook)
+        entry_dir = page_cache.get(
+            flipbook.asset_dir,
+            page_number,
+            lambda target_dir: render_page(
+                storage.ensure_local(flipbook.filename), page_number, target_dir,
+                dpi=app.config['RENDER_DPI'],
+                extra_formats=app.config['PAGE_EXTRA_FORMATS'],
+                tile_size=app.config['PAGE_TILE_SIZE']
+            )
+        )
+        cached_path = os.path.join(entry_dir, relative_path)
+        if not os.path.exists(cached_path):
+            abort(404)
+        return send_page_asset(cached_path)
+
+    @app.route('/assets/<asset_dir>/<version>/<filename>')
+    def page_asset(asset_dir, version, filename):
+        # Content-addressed, so no flipbook lookup: the manifest says what exists
+        if safe_join(app.config['UPLOAD_FOLDER'], asset_dir) is None or asset_dir.startswith('.'):
+            abort(404)
+        variant = find_page_variant(load_page_manifest(asset_dir), filename)
+        if not variant or variant.get('hash') != version:
+            abort(404)
+        return send_stored_asset(f'{asset_dir}/{filename}', immutable=True)
+
+    @app.route('/pages/<unique_id>/<filename>')
+    def page_image(unique_id, filename):
+        flipbook = Flipbook.query.filter_by(unique_id=unique_id).first_or_404()
+        match = PAGE_FILE_PATTERN.fullmatch(filename)
+        if not match or not 1 <= int(match.group(1)) <= flipbook.page_count:
+            abort(404)
+        return send_page_file(flipbook, int(match.group(1)), filename)
+
+    @app.route('/tiles/<unique_id>/<int:page_number>/<int:level>/<int:col>_<int:row>.jpg')
+    def page_tile(unique_id, page_number, level, col, row):
+        flipbook = Flipbook.query.filter_by(unique_id=unique_id).first_or_404()
+        if not 1 <= page_number <= flipbook.page_count:
+            abort(404)
+        return send_page_file(flipbook, page_number, os.path.join(f'page_{page_number}_tiles', str(level), f'{col}_{row}.jpg'))
 
     @app.route('/analytics')
     @login_required
     def analytics():
-        user_flipbooks = Flipbook.query.filter_by(user_id=current_user.id).all()
-        
-        analytics_data = {}
-        for flipbook in user_flipbooks:
-            total_views = PageView.query.filter_by(flipbook_id=flipbook.id).count()
-            
-            seven_days_ago = datetime.utcnow() - timedelta(days=7)
-            daily_views = db.session.query(
-                func.date(PageView.viewed_at).label('date'),
-                func.count(PageView.id).label('count')
-            ).filter(
-                PageView.flipbook_id == flipbook.id,
-                PageView.viewed_at >= seven_days_ago
-            ).group_by(
-                func.date(PageView.viewed_at)
-            ).all()
-            
-            dates = [(seven_days_ago + timedelta(days=x)).strftime('%Y-%m-%d') for x in range(8)]
-            views_data = {date: 0 for date in dates}
-            for date, count in daily_views:
-                views_data[date.strftime('%Y-%m-%d')] = count
-                
-            analytics_data[flipbook.id] = {
-                'title': flipbook.title,
-                'total_views': total_views,
-                'daily_views': views_data
-            }
-        
+        analytics_data = flipbook_analytics(current_user.id)
         return render_template('analytics.html', analytics_data=analytics_data)
 
-    @app.route('/track_page/<unique_id>', methods=['POST'])
-    def track_page(unique_id):
-        flipbook = Flipbook.query.filter_by(unique_id=unique_id).first_or_404()
-        if request.json and 'page_number' in request.json:
-            page_number = request.json['page_number']
-            
-            if page_number is not None:
-                page_view = PageView.query.filter_by(
-                    flipbook_id=flipbook.id,
-                    ip_address=request.remote_addr
-                ).order_by(PageView.id.desc()).first()
-                
-                if page_view:
-                    page_view.page_number = page_number
-                    db.session.commit()
-        
-        return jsonify({'status': 'success'})
+    @app.route('/track_pages', methods=['POST'])
+    def track_pages():
+        # Sent with navigator.sendBeacon, which may not set a JSON content type
+        beacon = parse_beacon(request.get_json(force=True, silent=True))
+        session = read_view_session(beacon[0]) if beacon else None
+        if not session:
+            return jsonify({'error': 'Invalid beacon'}), 400
+        flipbook_id, session_id = session
+        view_recorder.record_turns(flipbook_id, session_id, beacon[1], beacon[2])
+        return '', 204
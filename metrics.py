@@ -0,0 +1,231 @@
+"""Request, SQL and render timings, exposed in the Prometheus text format on /metrics.
+
+Every request is timed per endpoint, and the SQL statements it issues are
+counted and timed through SQLAlchemy engine events, so an N+1 query
+regression shows up as a jump in flipbook_request_queries for one endpoint.
+process_pdf reports how long each render stage takes. The counters of the
+view recorder and the password hasher are exported alongside.
+
+Metrics live in process memory, so with several gunicorn workers each scrape
+sees the worker that answered it; scrape every worker or aggregate by
+instance. /metrics only exists when METRICS_TOKEN is set, and requires it. A request is profiled with cProfile when it carries
+`X-Profile: <PROFILE_TOKEN>`, or at random for PROFILE_SAMPLE_RATE of requests.
+"""
+import io
+import os
+import hmac
+import time
+import random
+import pstats
+import cProfile
+import threading
+from contextlib import contextmanager
+from flask import g, request, has_request_context, Response, abort
+from app import logger
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROFILE_HEADER = 'X-Profile'
+PROFILE_TOP_FUNCTIONS = 25
+
+class Histogram:
+    """Cumulative-bucket histogram keyed by a tuple of label values; callers hold the lock."""
+
+    def __init__(self, name, help_text, label_names, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, labels, value):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series['buckets'][i] += 1
+        series['sum'] += value
+        series['count'] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        for labels, series in sorted(self.series.items()):
+            label_text = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(self.label_names, labels))
+            prefix = f'{label_text},' if label_text else ''
+            for bound, count in zip(self.buckets, series['buckets']):
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {series["count"]}')
+            lines.append(f'{self.name}_sum{{{label_text}}} {series["sum"]:.6f}')
+            lines.append(f'{self.name}_count{{{label_text}}} {series["count"]}')
+        return lines
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Metrics:
+    """Process-wide registry of request, SQL and render stage timings."""
+
+    def __init__(self):
+        self.enabled = False
+        self.token = ''
+        self.profile_token = ''
+        self.profile_sample_rate = 0.0
+        self.profile_dir = ''
+        self.query_warn_count = 50
+        self._lock = threading.Lock()
+        self._collectors = {}
+        self._sql = {'request': [0, 0.0], 'background': [0, 0.0]}  # queries, seconds
+        self._latency = Histogram(
+            'flipbook_request_duration_seconds', 'Time to build a response, per endpoint.',
+            ('endpoint', 'method', 'status'), LATENCY_BUCKETS
+        )
+        self._queries = Histogram(
+            'flipbook_request_queries', 'SQL statements issued per request.', ('endpoint',), QUERY_COUNT_BUCKETS
+        )
+        self._query_time = Histogram(
+            'flipbook_request_query_seconds', 'Time spent in SQL per request.', ('endpoint',), LATENCY_BUCKETS
+        )
+        self._stages = Histogram(
+            'flipbook_render_stage_seconds', 'Time per PDF render step: a window of pages, a resize or one file.', ('stage',),
+            STAGE_BUCKETS
+        )
+
+    def init_app(self, app):
+        from sqlalchemy import event
+        from app import db
+        self.enabled = app.config['METRICS_ENABLED']
+        if not self.enabled:
+            return
+        self.token = app.config['METRICS_TOKEN']
+        self.profile_token = app.config['PROFILE_TOKEN']
+        self.profile_sample_rate = app.config['PROFILE_SAMPLE_RATE']
+        self.profile_dir = app.config['PROFILE_DIR']
+        self.query_warn_count = app.config['METRICS_QUERY_WARN_COUNT']
+        event.listen(db.engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(db.engine, 'after_cursor_execute', self._after_cursor_execute)
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.teardown_request(self._teardown_request)
+        if self.token:
+            app.add_url_rule('/metrics', 'metrics', self._metrics_view)
+            logger.info("Request and SQL metrics enabled on /metrics")
+        else:
+            logger.info("Request and SQL metrics enabled, set METRICS_TOKEN to serve them on /metrics")
+
+    def register_collector(self, prefix, stats):
+        """Export the numeric values of the dict returned by stats() as <prefix>_<key> gauges."""
+        self._collectors[prefix] = stats
+
+    @contextmanager
+    def stage(self, name):
+        """Time a block of render work as one observation of the given stage."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.enabled:
+                elapsed = time.perf_counter() - started
+                with self._lock:
+                    self._stages.observe((name,), elapsed)
+
+    def render(self):
+        with self._lock:
+            lines = []
+            for histogram in (self._latency, self._queries, self._query_time, self._stages):
+                lines += histogram.render()
+            lines += ['# HELP flipbook_sql_queries_total SQL statements executed.',
+                      '# TYPE flipbook_sql_queries_total counter']
+            lines += [f'flipbook_sql_queries_total{{context="{context}"}} {queries}'
+                      for context, (queries, _) in self._sql.items()]
+            lines += ['# HELP flipbook_sql_seconds_total Time spent executing SQL statements.',
+                      '# TYPE flipbook_sql_seconds_total counter']
+            lines += [f'flipbook_sql_seconds_total{{context="{context}"}} {seconds:.6f}'
+                      for context, (_, seconds) in self._sql.items()]
+        for prefix, stats in self._collectors.items():
+            for key, value in sorted(stats().items()):
+                if isinstance(value, (int, float)):
+                    lines += [f'# TYPE flipbook_{prefix}_{key} gauge', f'flipbook_{prefix}_{key} {value}']
+        return '\n'.join(lines) + '\n'
+
+    def _metrics_view(self):
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {self.token}'):
+            abort(401)
+        return Response(self.render(), mimetype='text/plain; version=0.0.4')
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info['metrics_query_started'] = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info.pop('metrics_query_started', time.perf_counter())
+        # Only requests count towards per-request numbers, not the view writer or render workers
+        in_request = has_request_context() and 'metrics_started' in g
+        if in_request:
+            g.metrics_queries += 1
+            g.metrics_query_seconds += elapsed
+        with self._lock:
+            totals = self._sql['request' if in_request else 'background']
+            totals[0] += 1
+            totals[1] += elapsed
+
+    def _start_request(self):
+        g.metrics_started = time.perf_counter()
+        g.metrics_queries = 0
+        g.metrics_query_seconds = 0.0
+        if self._should_profile():
+            g.metrics_profiler = cProfile.Profile()
+            try:
+                g.metrics_profiler.enable()
+            except ValueError:
+                g.pop('metrics_profiler')  # another profiler is already active in this thread
+
+    def _should_profile(self):
+        if self.profile_token and request.headers.get(PROFILE_HEADER) == self.profile_token:
+            return True
+        return self.profile_sample_rate > 0 and random.random() < self.profile_sample_rate
+
+    def _finish_request(self, response):
+        if 'metrics_started' not in g:
+            return response
+        response.headers.add(
+            'Server-Timing', f'db;dur={g.metrics_query_seconds * 1000:.1f};desc="{g.metrics_queries} queries"'
+        )
+        self._observe(response.status_code)
+        return response
+
+    def _teardown_request(self, exc):
+        if 'metrics_started' in g and not g.get('metrics_observed'):
+            self._observe(500)  # an unhandled exception skipped after_request
+        profiler = g.pop('metrics_profiler', None)
+        if profiler:
+            profiler.disable()
+            self._report_profile(profiler)
+
+    def _observe(self, status):
+        g.metrics_observed = True
+        elapsed = time.perf_counter() - g.metrics_started
+        # The endpoint name rather than the path keeps label cardinality bounded
+        endpoint = request.endpoint or 'unmatched'
+        with self._lock:
+            self._latency.observe((endpoint, request.method, str(status)), elapsed)
+            self._queries.observe((endpoint,), g.metrics_queries)
+            self._query_time.observe((endpoint,), g.metrics_query_seconds)
+        if g.metrics_queries > self.query_warn_count:
+            logger.warning(f"{request.method} {request.path} issued {g.metrics_queries} queries "
+                           f"({g.metrics_query_seconds * 1000:.1f}ms)")
+
+    def _report_profile(self, profiler):
+        endpoint = request.endpoint or 'unmatched'
+        if self.profile_dir:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            path = os.path.join(self.profile_dir, f'{endpoint}-{int(time.time() * 1000)}-{os.getpid()}.prof')
+            profiler.dump_stats(path)
+            logger.info(f"Profile of {request.method} {request.path} written to {path}")
+            return
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+        logger.info(f"Profile of {request.method} {request.path}:\n{output.getvalue()}")
+
+# Global metrics instance
+metrics = Metrics()
@@ -1,14 +1,67 @@
-from app import app, db
+import sys
+from app import create_app, db
 from sqlalchemy import text, exc
 
+app = create_app(run_services=False)
+
+BACKFILL_BATCH_SIZE = 500
+# What a re-run ALTER raises: ProgrammingError on Postgres, OperationalError on SQLite
+ALREADY_APPLIED = (exc.ProgrammingError, exc.OperationalError)
+
+def backfill_email_index(batch_size=BACKFILL_BATCH_SIZE):
+    """Populate user.email_index for rows written before the blind index existed."""
+    from models import User
+    last_id = 0
+    total = 0
+    while True:
+        users = User.query.filter(
+            User.email_index.is_(None), User.id > last_id
+        ).order_by(User.id).limit(batch_size).all()
+        if not users:
+            break
+        for user in users:
+            user.email_index = User.email_blind_index(user.email)
+        last_id = users[-1].id
+        total += len(users)
+        db.session.commit()
+    print(f"Backfilled email_index for {total} users")
+
+def rotate_encryption_keys(batch_size=BACKFILL_BATCH_SIZE):
+    """Re-encrypt every encrypted column under the current FLASK_SECRET_KEY.
+
+    Run after moving the old secret to FLASK_SECRET_KEY_PREVIOUS. The email
+    blind index is keyed by the secret as well, so it is recomputed too.
+    """
+    from encryption import encryptor
+    from models import User, Flipbook, PageView
+    for model, column in ((User, 'email_encrypted'), (Flipbook, 'title_encrypted'),
+                          (PageView, 'ip_address_encrypted')):
+        last_id = 0
+        total = 0
+        while True:
+            rows = model.query.filter(model.id > last_id).order_by(model.id).limit(batch_size).all()
+            if not rows:
+                break
+            for row in rows:
+                setattr(row, column, encryptor.rotate(getattr(row, column)))
+                if model is User:
+                    row.email_index = User.email_blind_index(row.email)
+            last_id = rows[-1].id
+            total += len(rows)
+            db.session.commit()
+        print(f"Rotated {column} for {total} rows")
+
 def run_migrations():
     with app.app_context():
         try:
+            # Create tables that do not exist yet, columns are added below
+            db.create_all()
+            
             # Check if email column exists before trying to rename
             try:
                 db.session.execute(text('ALTER TABLE "user" RENAME COLUMN email TO email_encrypted'))
                 print("Renamed email column to email_encrypted")
-            except exc.ProgrammingError:
+            except ALREADY_APPLIED:
                 print("email_encrypted column already exists")
                 db.session.rollback()
             
@@ -18,7 +71,7 @@ def run_migrations():
                 db.session.execute(text('UPDATE flipbook SET title_encrypted = title::TEXT'))
                 db.session.execute(text('ALTER TABLE flipbook DROP COLUMN IF EXISTS title'))
                 print("Added title_encrypted column")
-            except exc.ProgrammingError:
+            except ALREADY_APPLIED:
                 print("title_encrypted column already exists")
                 db.session.rollback()
             
@@ -27,10 +80,91 @@ def run_migrations():
                 db.session.execute(text('ALTER TABLE page_view RENAME COLUMN ip_address TO ip_address_encrypted'))
                 db.session.execute(text('ALTER TABLE page_view ALTER COLUMN ip_address_encrypted TYPE TEXT'))
                 print("Updated page_view table for encrypted IP addresses")
-            except exc.ProgrammingError:
+            except ALREADY_APPLIED:
                 print("ip_address_encrypted column already exists")
                 db.session.rollback()
             
+            # Add render status lifecycle to flipbook table, existing rows are already rendered
+            try:
+                db.session.execute(text("ALTER TABLE flipbook ADD COLUMN status VARCHAR(16) NOT NULL DEFAULT 'ready'"))
+                db.session.execute(text('ALTER TABLE flipbook ADD COLUMN pages_done INTEGER NOT NULL DEFAULT 0'))
+                db.session.execute(text('ALTER TABLE flipbook ADD COLUMN error_message TEXT'))
+                db.session.execute(text('UPDATE flipbook SET pages_done = page_count'))
+                db.session.execute(text('CREATE INDEX IF NOT EXISTS ix_flipbook_status ON flipbook (status)'))
+                print("Added flipbook render status columns")
+            except ALREADY_APPLIED:
+                print("flipbook status columns already exist")
+                db.session.rollback()
+            
+            # Link flipbooks to shared, content-addressed documents
+            try:
+                db.session.execute(text('ALTER TABLE flipbook ADD COLUMN document_id INTEGER REFERENCES document (id)'))
+                db.session.execute(text('CREATE INDEX IF NOT EXISTS ix_flipbook_document_id ON flipbook (document_id)'))
+                print("Added flipbook document_id column")
+            except ALREADY_APPLIED:
+                print("flipbook document_id column already exists")
+                db.session.rollback()
+            
+            # Blind index for email lookups, the encrypted column cannot be queried
+            try:
+                db.session.execute(text('ALTER TABLE "user" ADD COLUMN email_index VARCHAR(64)'))
+                db.session.execute(text('CREATE UNIQUE INDEX IF NOT EXISTS ix_user_email_index ON "user" (email_index)'))
+                db.session.commit()
+                print("Added user email_index column")
+            except ALREADY_APPLIED:
+                print("user email_index column already exists")
+                db.session.rollback()
+            backfill_email_index()
+            
+            # View sessions let viewer beacons update their page view by key
+            try:
+                db.session.execute(text('ALTER TABLE page_view ADD COLUMN session_id VARCHAR(32)'))
+                db.session.execute(text('CREATE UNIQUE INDEX IF NOT EXISTS ix_page_view_session_id ON page_view (session_id)'))
+                db.session.commit()
+                print("Added page_view session_id column")
+            except ALREADY_APPLIED:
+                print("page_view session_id column already exists")
+                db.session.rollback()
+            
+            # Denormalized lifetime view counter, seeded from the raw rows
+            try:
+                db.session.execute(text('ALTER TABLE flipbook ADD COLUMN view_count INTEGER NOT NULL DEFAULT 0'))
+                db.session.execute(text(
+                    'UPDATE flipbook SET view_count = '
+                    '(SELECT COUNT(*) FROM page_view WHERE page_view.flipbook_id = flipbook.id)'
+                ))
+                db.session.commit()
+                print("Added flipbook view_count column")
+            except ALREADY_APPLIED:
+                print("flipbook view_count column already exists")
+                db.session.rollback()
+            
+            # Single render owner per document, held under a renewable lease
+            try:
+                db.session.execute(text('ALTER TABLE document ADD COLUMN rendering_by INTEGER'))
+                db.session.execute(text('ALTER TABLE document ADD COLUMN render_lease_until TIMESTAMP'))
+                db.session.commit()
+                print("Added document render lease columns")
+            except ALREADY_APPLIED:
+                print("document render lease columns already exist")
+                db.session.rollback()
+            
+            db.session.execute(text('CREATE INDEX IF NOT EXISTS ix_flipbook_user_created ON flipbook (user_id, created_at, id)'))
+            
+            # Revocation epoch carried by access tokens and login sessions
+            try:
+                db.session.execute(text('ALTER TABLE "user" ADD COLUMN auth_epoch INTEGER NOT NULL DEFAULT 0'))
+                db.session.commit()
+                print("Added user auth_epoch column")
+            except ALREADY_APPLIED:
+                print("user auth_epoch column already exists")
+                db.session.rollback()
+            
+            # Full-text index over extracted page text
+            from search import ensure_search_index
+            ensure_search_index()
+            print("Full-text search index is in place")
+            
             db.session.commit()
             print("Migration completed successfully")
         except Exception as e:
@@ -40,3 +174,6 @@ def run_migrations():
 
 if __name__ == "__main__":
     run_migrations()
+    if '--rotate-keys' in sys.argv:
+        with app.app_context():
+            rotate_encryption_keys()
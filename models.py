@@ -2,31 +2,77 @@ import uuid
 from datetime import datetime, timedelta
 from app import db
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
-from encryption import encryptor
+from encryption import encryptor, EncryptedField
+from passwords import password_hasher
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), unique=True, nullable=False)
     email_encrypted = db.Column(db.Text, unique=True, nullable=False)
+    email_index = db.Column(db.String(64), unique=True, index=True)
     password_hash = db.Column(db.String(256))
     refresh_token = db.Column(db.String(256), unique=True)
     refresh_token_expiry = db.Column(db.DateTime)
+    auth_epoch = db.Column(db.Integer, nullable=False, default=0)  # bumped to revoke tokens and sessions
     flipbooks = db.relationship('Flipbook', backref='owner', lazy=True)
+    _email = EncryptedField('email_encrypted')
 
     @property
     def email(self):
-        return encryptor.decrypt(self.email_encrypted)
+        return self._email
 
     @email.setter
     def email(self, value):
-        self.email_encrypted = encryptor.encrypt(value)
+        self._email = value
+        self.email_index = User.email_blind_index(value)
+
+    @staticmethod
+    def email_blind_index(email):
+        return encryptor.blind_index(email.strip().lower()) if email else None
+
+    @classmethod
+    def find_by_email(cls, email):
+        """Look a user up by email, also under the blind index of a retired secret."""
+        index = cls.email_blind_index(email)
+        user = cls.query.filter_by(email_index=index).first()
+        if user is not None or not email:
+            return user
+        previous = encryptor.previous_blind_indexes(email.strip().lower())
+        if not previous:
+            return None
+        user = cls.query.filter(cls.email_index.in_(previous)).first()
+        if user is not None:
+            # Moves the row to the current key with the caller's next commit, e.g. the login's
+            user.email_index = index
+        return user
+
+    @staticmethod
+    def session_id_for(user_id, auth_epoch):
+        # Flask-Login stores this in the session, so bumping the epoch logs the session out
+        return f'{user_id}:{auth_epoch}'
+
+    def get_id(self):
+        return User.session_id_for(self.id, self.auth_epoch or 0)
+
+    def bump_auth_epoch(self):
+        """Invalidate every access token and login session issued so far."""
+        self.auth_epoch = (self.auth_epoch or 0) + 1
+        if self.id is not None:
+            from identity import identity_cache
+            identity_cache.invalidate_after_commit(db.session, self.id)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
+        self.bump_auth_epoch()
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        """Verify a password, upgrading its hash if the configured cost changed (caller commits)."""
+        if not self.password_hash or not password_hasher.verify(self.password_hash, password):
+            return False
+        if password_hasher.needs_rehash(self.password_hash):
+            self.password_hash = password_hasher.hash(password)
+            password_hasher.count_rehash()
+        return True
         
     def generate_refresh_token(self):
         self.refresh_token = str(uuid.uuid4())
@@ -41,8 +87,30 @@ class User(UserMixin, db.Model):
     def revoke_refresh_token(self):
         self.refresh_token = None
         self.refresh_token_expiry = None
+        self.bump_auth_epoch()
+
+class Document(db.Model):
+    """A stored PDF and its rendered pages, shared by every flipbook with the same content."""
+    id = db.Column(db.Integer, primary_key=True)
+    content_hash = db.Column(db.String(64), unique=True, nullable=False)
+    filename = db.Column(db.String(256), nullable=False)
+    page_count = db.Column(db.Integer, nullable=False, default=0)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    rendered_at = db.Column(db.DateTime)
+    rendering_by = db.Column(db.Integer)  # flipbook whose job owns the render
+    render_lease_until = db.Column(db.DateTime)  # the owner is presumed dead after this
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    flipbooks = db.relationship('Flipbook', backref='document', lazy=True)
 
 class Flipbook(db.Model):
+    STATUS_QUEUED = 'queued'
+    STATUS_RENDERING = 'rendering'
+    STATUS_READY = 'ready'
+    STATUS_FAILED = 'failed'
+
+    # Serves keyset pagination of a user's flipbooks, newest first
+    __table_args__ = (db.Index('ix_flipbook_user_created', 'user_id', 'created_at', 'id'),)
+
     id = db.Column(db.Integer, primary_key=True)
     title_encrypted = db.Column(db.Text, nullable=False)
     filename = db.Column(db.String(256), nullable=False)
@@ -50,15 +118,22 @@ class Flipbook(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     page_count = db.Column(db.Integer, nullable=False, default=0)
+    document_id = db.Column(db.Integer, db.ForeignKey('document.id'), index=True)
+    status = db.Column(db.String(16), nullable=False, default=STATUS_QUEUED, index=True)
+    pages_done = db.Column(db.Integer, nullable=False, default=0)
+    error_message = db.Column(db.Text)
+    view_count = db.Column(db.Integer, nullable=False, default=0)  # maintained by rollups.py
     views = db.relationship('PageView', backref='flipbook', lazy=True)
+    title = EncryptedField('title_encrypted')
 
     @property
-    def title(self):
-        return encryptor.decrypt(self.title_encrypted)
+    def asset_dir(self):
+        # Rendered pages live in a directory named after the stored PDF
+        return self.filename.rsplit('.', 1)[0]
 
-    @title.setter
-    def title(self, value):
-        self.title_encrypted = encryptor.encrypt(value)
+    @property
+    def is_ready(self):
+        return self.status == self.STATUS_READY
 
 class PageView(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -66,11 +141,57 @@ class PageView(db.Model):
     viewed_at = db.Column(db.DateTime, default=datetime.utcnow)
     ip_address_encrypted = db.Column(db.Text)
     page_number = db.Column(db.Integer)
+    session_id = db.Column(db.String(32), unique=True, index=True)
+    ip_address = EncryptedField('ip_address_encrypted')
 
-    @property
-    def ip_address(self):
-        return encryptor.decrypt(self.ip_address_encrypted) if self.ip_address_encrypted else None
+class PageTurn(db.Model):
+    """Time a viewer spent on one page during a view session, sent by the viewer in batches."""
+    id = db.Column(db.Integer, primary_key=True)
+    session_id = db.Column(db.String(32), nullable=False, index=True)
+    flipbook_id = db.Column(db.Integer, db.ForeignKey('flipbook.id'), nullable=False, index=True)
+    page_number = db.Column(db.Integer, nullable=False)
+    dwell_ms = db.Column(db.Integer, nullable=False, default=0)
+    turned_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class FlipbookDailyStat(db.Model):
+    """Views per flipbook per day, rolled up from the view stream by rollups.py."""
+    flipbook_id = db.Column(db.Integer, db.ForeignKey('flipbook.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    views = db.Column(db.Integer, nullable=False, default=0)
+
+class FlipbookHourlyStat(db.Model):
+    """Views per flipbook per hour, rolled up from the view stream by rollups.py."""
+    flipbook_id = db.Column(db.Integer, db.ForeignKey('flipbook.id'), primary_key=True)
+    hour = db.Column(db.DateTime, primary_key=True)
+    views = db.Column(db.Integer, nullable=False, default=0)
 
-    @ip_address.setter
-    def ip_address(self, value):
-        self.ip_address_encrypted = encryptor.encrypt(value) if value else None
+class PageDailyStat(db.Model):
+    """Page turns and dwell time per page per day, rolled up from viewer beacons by rollups.py."""
+    flipbook_id = db.Column(db.Integer, db.ForeignKey('flipbook.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    page_number = db.Column(db.Integer, primary_key=True)
+    turns = db.Column(db.Integer, nullable=False, default=0)
+    dwell_ms = db.Column(db.BigInteger, nullable=False, default=0)
+
+class FlipbookPageStat(db.Model):
+    """Lifetime page turns and dwell time per page, maintained alongside the rollups."""
+    flipbook_id = db.Column(db.Integer, db.ForeignKey('flipbook.id'), primary_key=True)
+    page_number = db.Column(db.Integer, primary_key=True)
+    turns = db.Column(db.Integer, nullable=False, default=0)
+    dwell_ms = db.Column(db.BigInteger, nullable=False, default=0)
+
+class UploadSession(db.Model):
+    """A resumable upload in progress, see uploads.py."""
+    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    title_encrypted = db.Column(db.Text, nullable=False)
+    upload_length = db.Column(db.BigInteger, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    title = EncryptedField('title_encrypted')
+
+class PageText(db.Model):
+    """Extracted text of one page of a document, indexed for full-text search by search.py."""
+    id = db.Column(db.Integer, primary_key=True)
+    document_id = db.Column(db.Integer, db.ForeignKey('document.id'), nullable=False, index=True)
+    page_number = db.Column(db.Integer, nullable=False)
+    content = db.Column(db.Text, nullable=False, default='')
@@ -0,0 +1,102 @@
+import time
+import threading
+from flask import g, has_app_context
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import generate_password_hash, check_password_hash
+from app import logger
+
+# werkzeug's default, spelled out so stored hashes can be compared against it
+DEFAULT_HASH_METHOD = 'scrypt:32768:8:1'
+
+class PasswordHashBusy(ServiceUnavailable):
+    description = 'Too many sign-ins right now, please try again in a moment.'
+
+class PasswordHasher:
+    """Runs password hashing under a per-process concurrency limit.
+
+    Hashes are deliberately CPU- and memory-hard, so a burst of logins could
+    otherwise occupy every worker. At most PASSWORD_HASH_CONCURRENCY hashes run
+    at once. Callers wait up to PASSWORD_HASH_QUEUE_TIMEOUT seconds for a slot
+    and then get a 503 (PasswordHashBusy). The time spent on each request is
+    reported in a Server-Timing header.
+
+    The limit is a semaphore in the request thread rather than a separate
+    executor: the request has to wait for the hash either way, and a handoff to
+    another thread would only add a queue and a context switch.
+    """
+
+    def __init__(self):
+        self.method = DEFAULT_HASH_METHOD
+        self.queue_timeout = 5.0
+        self._slots = threading.BoundedSemaphore(2)
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'hashes': 0,
+            'rejected': 0,
+            'rehashed': 0,
+            'wait_seconds_total': 0.0,
+            'hash_seconds_total': 0.0,
+            'hash_seconds_max': 0.0,
+        }
+
+    def init_app(self, app):
+        self.method = self.full_method(app.config['PASSWORD_HASH_METHOD'])
+        self.queue_timeout = app.config['PASSWORD_HASH_QUEUE_TIMEOUT']
+        self._slots = threading.BoundedSemaphore(app.config['PASSWORD_HASH_CONCURRENCY'])
+        app.after_request(self._add_server_timing)
+        logger.info(f"Password hashing limited to {app.config['PASSWORD_HASH_CONCURRENCY']} concurrent "
+                    f"{self.method} hashes")
+
+    @staticmethod
+    def full_method(method):
+        """Expand a method like 'scrypt' to the parameter string werkzeug stores, 'scrypt:32768:8:1'."""
+        # Hashing once is the only way to learn the defaults of the installed werkzeug
+        return generate_password_hash('', method=method).split('$', 1)[0]
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, method=self.method)
+
+    def verify(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """True if the hash was made with other parameters than the configured method."""
+        return pwhash.split('$', 1)[0] != self.method
+
+    def count_rehash(self):
+        self._count('rehashed')
+
+    def stats(self):
+        with self._stats_lock:
+            return dict(self._stats)
+
+    def _run(self, func, *args, **kwargs):
+        queued = time.perf_counter()
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            self._count('rejected')
+            raise PasswordHashBusy(retry_after=int(self.queue_timeout) or 1)
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._slots.release()
+            elapsed = time.perf_counter() - started
+            if has_app_context():
+                g.password_hash_seconds = g.get('password_hash_seconds', 0.0) + elapsed
+            with self._stats_lock:
+                self._stats['hashes'] += 1
+                self._stats['wait_seconds_total'] += started - queued
+                self._stats['hash_seconds_total'] += elapsed
+                self._stats['hash_seconds_max'] = max(self._stats['hash_seconds_max'], elapsed)
+
+    def _count(self, key):
+        with self._stats_lock:
+            self._stats[key] += 1
+
+    def _add_server_timing(self, response):
+        if 'password_hash_seconds' in g:
+            response.headers.add('Server-Timing', f"pwhash;dur={g.password_hash_seconds * 1000:.1f}")
+        return response
+
+# Global password hasher instance
+password_hasher = PasswordHasher()
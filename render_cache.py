@@ -0,0 +1,126 @@
+import os
+import fcntl
+import shutil
+import threading
+from collections import OrderedDict
+from app import logger
+
+class PageRenderCache:
+    """Size-bounded disk cache for lazily rendered pages with LRU eviction.
+
+    Each entry is one page directory holding all of its variants. Renders are
+    single-flight: a per-key lock serializes threads in this process and an
+    flock on a sidecar file serializes other processes, so concurrent requests
+    for the same page render it once and everyone else reads the result.
+    """
+
+    def __init__(self):
+        self.root = None
+        self.max_bytes = 0
+        self._entries = OrderedDict()  # (asset_dir, page_number) -> size in bytes
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def init_app(self, app):
+        self.root = os.path.join(app.config['UPLOAD_FOLDER'], '.page_cache')
+        self.max_bytes = app.config['RENDER_CACHE_MAX_MB'] * 1024 * 1024
+        os.makedirs(self.root, exist_ok=True)
+        self._load()
+        logger.info(f"Page render cache at {self.root} holds {len(self._entries)} pages")
+
+    def _entry_dir(self, key):
+        asset_dir, page_number = key
+        return os.path.join(self.root, asset_dir, str(page_number))
+
+    def _load(self):
+        # Rebuild LRU order from directory mtimes, which get() refreshes on every hit
+        found = []
+        for asset_dir in os.listdir(self.root):
+            asset_path = os.path.join(self.root, asset_dir)
+            if not os.path.isdir(asset_path):
+                continue
+            for page in os.listdir(asset_path):
+                entry_dir = os.path.join(asset_path, page)
+                if page.isdigit() and os.path.isdir(entry_dir):
+                    found.append((os.path.getmtime(entry_dir), (asset_dir, int(page)), _dir_size(entry_dir)))
+        with self._lock:
+            for _, key, size in sorted(found):
+                self._entries[key] = size
+                self._total_bytes += size
+
+    def get(self, asset_dir, page_number, render):
+        """Return the directory for a cached page, calling render(target_dir) on a miss."""
+        key = (asset_dir, page_number)
+        entry_dir = self._entry_dir(key)
+        if self._touch(key, entry_dir):
+            return entry_dir
+
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+            with open(f'{entry_dir}.lock', 'w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    if not os.path.isdir(entry_dir):
+                        tmp_dir = f'{entry_dir}.tmp-{os.getpid()}-{threading.get_ident()}'
+                        os.makedirs(tmp_dir, exist_ok=True)
+                        try:
+                            render(tmp_dir)
+                            os.replace(tmp_dir, entry_dir)
+                        finally:
+                            shutil.rmtree(tmp_dir, ignore_errors=True)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+            self._add(key, _dir_size(entry_dir))
+        with self._lock:
+            self._key_locks.pop(key, None)
+        self._evict(keep=key)
+        return entry_dir
+
+    def _touch(self, key, entry_dir):
+        if not os.path.isdir(entry_dir):
+            return False
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            else:
+                # Rendered by another process since we loaded
+                size = _dir_size(entry_dir)
+                self._entries[key] = size
+                self._total_bytes += size
+        os.utime(entry_dir)
+        return True
+
+    def _add(self, key, size):
+        with self._lock:
+            self._total_bytes += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+
+    def _evict(self, keep):
+        while True:
+            with self._lock:
+                if self._total_bytes <= self.max_bytes or len(self._entries) <= 1:
+                    return
+                key, size = next(iter(self._entries.items()))
+                if key == keep:
+                    self._entries.move_to_end(key)
+                    continue
+                del self._entries[key]
+                self._total_bytes -= size
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            logger.info(f"Evicted cached page {key[1]} of {key[0]}")
+
+    def discard(self, asset_dir):
+        """Drop every cached page of an asset directory, e.g. when its document is deleted."""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == asset_dir]:
+                self._total_bytes -= self._entries.pop(key)
+        shutil.rmtree(os.path.join(self.root, asset_dir), ignore_errors=True)
+
+def _dir_size(path):
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+# Global page render cache instance
+page_cache = PageRenderCache()
@@ -0,0 +1,283 @@
+"""Daily and hourly analytics rollups maintained from the page-view stream.
+
+The view recorder calls apply_batch() in the same transaction that inserts
+raw PageView/PageTurn rows, so the rollup tables and the lifetime counters
+(Flipbook.view_count, FlipbookPageStat) always match what has been written.
+rebuild_rollups() recomputes the rollups from raw rows for backfills,
+reconcile_counters() raises the counters to the rollups' totals and
+purge_raw_views() enforces the raw-row retention policy; all are meant to
+run as scheduled jobs:
+
+    python rollups.py rebuild --since 2024-01-01
+    python rollups.py reconcile
+    python rollups.py purge --days 90
+"""
+import argparse
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from sqlalchemy import select, insert, update, delete, func, and_, bindparam
+from flask import current_app
+from app import db, logger
+from models import Flipbook, PageView, PageTurn, FlipbookDailyStat, FlipbookHourlyStat, PageDailyStat, FlipbookPageStat
+
+PURGE_BATCH_SIZE = 10000
+REBUILD_BATCH_SIZE = 10000
+
+def hour_bucket(timestamp):
+    """The hourly rollup key of a timestamp, computed here alone so every writer produces the same value."""
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+def _dialect_insert(table):
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    else:
+        raise RuntimeError(f"Rollups need INSERT ... ON CONFLICT support, not available on {dialect}")
+    return dialect_insert(table)
+
+def _upsert_increments(model, keys, counters, rows):
+    """Add each row's counters onto the existing rollup row, creating it if needed."""
+    if not rows:
+        return
+    table = model.__table__
+    stmt = _dialect_insert(table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=keys,
+        set_={counter: table.c[counter] + stmt.excluded[counter] for counter in counters}
+    )
+    db.session.connection().execute(stmt, rows)
+
+def apply_batch(views, turns):
+    """Fold a batch of raw view and turn rows into the rollup tables."""
+    totals = Counter()
+    daily = Counter()
+    hourly = Counter()
+    for view in views:
+        viewed_at = view['viewed_at']
+        totals[view['flipbook_id']] += 1
+        daily[(view['flipbook_id'], viewed_at.date())] += 1
+        hourly[(view['flipbook_id'], hour_bucket(viewed_at))] += 1
+
+    pages = defaultdict(lambda: [0, 0])
+    lifetime_pages = defaultdict(lambda: [0, 0])
+    for turn in turns:
+        for counters in (pages[(turn['flipbook_id'], turn['turned_at'].date(), turn['page_number'])],
+                         lifetime_pages[(turn['flipbook_id'], turn['page_number'])]):
+            counters[0] += 1
+            counters[1] += turn['dwell_ms']
+
+    if totals:
+        # Relative increments, so concurrent writers never overwrite each other
+        flipbooks = Flipbook.__table__
+        db.session.connection().execute(
+            update(flipbooks)
+            .where(flipbooks.c.id == bindparam('fid'))
+            .values(view_count=flipbooks.c.view_count + bindparam('n')),
+            [{'fid': flipbook_id, 'n': n} for flipbook_id, n in totals.items()]
+        )
+
+    _upsert_increments(FlipbookDailyStat, ['flipbook_id', 'day'], ['views'], [
+        {'flipbook_id': flipbook_id, 'day': day, 'views': views}
+        for (flipbook_id, day), views in daily.items()
+    ])
+    _upsert_increments(FlipbookHourlyStat, ['flipbook_id', 'hour'], ['views'], [
+        {'flipbook_id': flipbook_id, 'hour': hour, 'views': views}
+        for (flipbook_id, hour), views in hourly.items()
+    ])
+    _upsert_increments(PageDailyStat, ['flipbook_id', 'day', 'page_number'], ['turns', 'dwell_ms'], [
+        {'flipbook_id': flipbook_id, 'day': day, 'page_number': page_number, 'turns': turns, 'dwell_ms': dwell_ms}
+        for (flipbook_id, day, page_number), (turns, dwell_ms) in pages.items()
+    ])
+    _upsert_increments(FlipbookPageStat, ['flipbook_id', 'page_number'], ['turns', 'dwell_ms'], [
+        {'flipbook_id': flipbook_id, 'page_number': page_number, 'turns': turns, 'dwell_ms': dwell_ms}
+        for (flipbook_id, page_number), (turns, dwell_ms) in lifetime_pages.items()
+    ])
+
+def analytics_rows_stmt(user_id, since):
+    """Every flipbook of a user, joined to its daily view rollups since `since`."""
+    return select(Flipbook, FlipbookDailyStat.day, FlipbookDailyStat.views).outerjoin(
+        FlipbookDailyStat, and_(
+            FlipbookDailyStat.flipbook_id == Flipbook.id,
+            FlipbookDailyStat.day >= since.date()
+        )
+    ).where(Flipbook.user_id == user_id).order_by(Flipbook.id)
+
+def page_turns_stmt(flipbook_ids):
+    return select(
+        FlipbookPageStat.flipbook_id, FlipbookPageStat.page_number, FlipbookPageStat.turns
+    ).where(
+        FlipbookPageStat.flipbook_id.in_(flipbook_ids)
+    ).order_by(FlipbookPageStat.flipbook_id, FlipbookPageStat.page_number)
+
+def flipbook_analytics(user_id, days=7):
+    """Total, per-day and per-page views for every flipbook a user owns."""
+    since = datetime.utcnow() - timedelta(days=days)
+    rows = db.session.execute(analytics_rows_stmt(user_id, since)).all()
+    flipbook_ids = list(dict.fromkeys(row[0].id for row in rows))
+    page_stats = db.session.execute(page_turns_stmt(flipbook_ids)).all() if flipbook_ids else []
+    return build_analytics(rows, page_stats, since, days)
+
+def build_analytics(rows, page_stats, since, days):
+    """Shape the results of analytics_rows_stmt and page_turns_stmt into the analytics response."""
+    dates = [(since + timedelta(days=x)).strftime('%Y-%m-%d') for x in range(days + 1)]
+    flipbooks = {}
+    analytics_data = {}
+    for flipbook, day, views in rows:
+        if flipbook.id not in analytics_data:
+            flipbooks[flipbook.id] = flipbook
+            analytics_data[flipbook.id] = {
+                'total_views': flipbook.view_count,
+                'daily_views': {date: 0 for date in dates},
+                'page_turns': {}
+            }
+        if day is not None:
+            analytics_data[flipbook.id]['daily_views'][day.strftime('%Y-%m-%d')] = views
+
+    for flipbook_id, page_number, turns in page_stats:
+        analytics_data[flipbook_id]['page_turns'][page_number] = turns
+
+    for flipbook in Flipbook.title.decrypt_all(list(flipbooks.values())):
+        analytics_data[flipbook.id] = dict(title=flipbook.title, **analytics_data[flipbook.id])
+    return analytics_data
+
+def rebuild_start(since=None):
+    """First day that can be rebuilt: `since`, but never a day the purge may have thinned out.
+
+    The first backfill, before any rollup exists, starts at the oldest raw row:
+    purges only run once rollups are in place, so the raw rows are still whole.
+    """
+    oldest = db.session.scalar(select(func.min(PageView.viewed_at)))
+    if db.session.scalar(select(FlipbookDailyStat.flipbook_id).limit(1)) is None:
+        if since:
+            return since
+        return oldest.date() if oldest is not None else datetime.utcnow().date()
+    cutoff = datetime.utcnow() - timedelta(days=current_app.config['RAW_VIEW_RETENTION_DAYS'])
+    # The purge cutoff falls mid-day, so the day it falls on may already be partial
+    start = cutoff.date() + timedelta(days=1)
+    if oldest is not None:
+        # Days before the oldest surviving row have nothing to rebuild from
+        start = max(start, oldest.date())
+    return max(since, start) if since else start
+
+def rebuild_rollups(since=None):
+    """Recompute rollups from raw rows, from the start of `since` (a date) or as far back as they reach.
+
+    Older rollups are left alone: their raw rows are gone, so they are the only
+    record. The lifetime counters are not touched, run reconcile_counters()
+    afterwards if they should follow the rebuilt rollups.
+    """
+    start_day = rebuild_start(since)
+    if since and start_day > since:
+        logger.warning(f"Raw rows before {start_day} may have been purged, keeping the existing rollups of those days")
+    start = datetime.combine(start_day, datetime.min.time())
+    view_day = func.date(PageView.viewed_at)
+    turn_day = func.date(PageTurn.turned_at)
+
+    db.session.execute(delete(FlipbookDailyStat).where(FlipbookDailyStat.day >= start.date()))
+    db.session.execute(delete(FlipbookHourlyStat).where(FlipbookHourlyStat.hour >= start))
+    db.session.execute(delete(PageDailyStat).where(PageDailyStat.day >= start.date()))
+
+    db.session.execute(insert(FlipbookDailyStat).from_select(
+        ['flipbook_id', 'day', 'views'],
+        select(PageView.flipbook_id, view_day, func.count(PageView.id))
+        .where(PageView.viewed_at >= start)
+        .group_by(PageView.flipbook_id, view_day)
+    ))
+    # Hours are bucketed in Python like apply_batch does; SQL truncation returns a string on SQLite
+    hourly = Counter()
+    views = db.session.execute(
+        select(PageView.flipbook_id, PageView.viewed_at)
+        .where(PageView.viewed_at >= start)
+        .execution_options(yield_per=REBUILD_BATCH_SIZE)
+    )
+    for flipbook_id, viewed_at in views:
+        hourly[(flipbook_id, hour_bucket(viewed_at))] += 1
+    rows = [{'flipbook_id': flipbook_id, 'hour': hour, 'views': n} for (flipbook_id, hour), n in hourly.items()]
+    for i in range(0, len(rows), REBUILD_BATCH_SIZE):
+        db.session.execute(insert(FlipbookHourlyStat), rows[i:i + REBUILD_BATCH_SIZE])
+    db.session.execute(insert(PageDailyStat).from_select(
+        ['flipbook_id', 'day', 'page_number', 'turns', 'dwell_ms'],
+        select(PageTurn.flipbook_id, turn_day, PageTurn.page_number,
+               func.count(PageTurn.id), func.sum(PageTurn.dwell_ms))
+        .where(PageTurn.turned_at >= start)
+        .group_by(PageTurn.flipbook_id, turn_day, PageTurn.page_number)
+    ))
+    db.session.commit()
+    logger.info(f"Rebuilt analytics rollups since {start_day}")
+
+def reconcile_counters():
+    """Raise the lifetime counters to what the rollups add up to, never lowering one.
+
+    The rollups outlive purged raw rows, so once rebuild_rollups() has covered
+    the full history they are the complete record. A counter above its rollups
+    holds views the rollups are missing (e.g. seeded from raw rows by the
+    migration before the first rebuild), so it is left as it is rather than
+    shrunk to a partial sum.
+    """
+    total_views = select(
+        func.coalesce(func.sum(FlipbookDailyStat.views), 0)
+    ).where(
+        FlipbookDailyStat.flipbook_id == Flipbook.id
+    ).scalar_subquery()
+    raised = db.session.execute(
+        update(Flipbook)
+        .where(total_views > Flipbook.view_count)
+        .values(view_count=total_views)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    table = FlipbookPageStat.__table__
+    stmt = _dialect_insert(table).from_select(
+        ['flipbook_id', 'page_number', 'turns', 'dwell_ms'],
+        select(PageDailyStat.flipbook_id, PageDailyStat.page_number,
+               func.sum(PageDailyStat.turns), func.sum(PageDailyStat.dwell_ms))
+        .group_by(PageDailyStat.flipbook_id, PageDailyStat.page_number)
+    )
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=['flipbook_id', 'page_number'],
+        set_={'turns': stmt.excluded.turns, 'dwell_ms': stmt.excluded.dwell_ms},
+        where=stmt.excluded.turns > table.c.turns
+    ))
+    db.session.commit()
+    logger.info(f"Reconciled flipbook view counters, raised {raised}")
+
+def purge_raw_views(retention_days, batch_size=PURGE_BATCH_SIZE):
+    """Delete raw view and turn rows older than the retention window, in batches.
+
+    Rollups keep the aggregated history, so only drill-down detail is lost.
+    """
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    for model, timestamp in ((PageView, PageView.viewed_at), (PageTurn, PageTurn.turned_at)):
+        total = 0
+        while True:
+            batch = select(model.id).where(timestamp < cutoff).limit(batch_size).scalar_subquery()
+            result = db.session.execute(
+                delete(model).where(model.id.in_(batch)).execution_options(synchronize_session=False)
+            )
+            db.session.commit()
+            total += result.rowcount
+            if result.rowcount < batch_size:
+                break
+        logger.info(f"Purged {total} {model.__tablename__} rows older than {cutoff:%Y-%m-%d}")
+
+if __name__ == '__main__':
+    from app import create_app
+
+    parser = argparse.ArgumentParser(description='Maintain analytics rollups.')
+    subcommands = parser.add_subparsers(dest='command', required=True)
+    rebuild = subcommands.add_parser('rebuild', help='recompute rollups from raw rows')
+    rebuild.add_argument('--since', type=lambda s: datetime.strptime(s, '%Y-%m-%d').date())
+    subcommands.add_parser('reconcile', help='raise view counters to the rollup totals')
+    purge = subcommands.add_parser('purge', help='delete raw rows past the retention window')
+    purge.add_argument('--days', type=int)
+    args = parser.parse_args()
+
+    app = create_app(run_services=False)
+    with app.app_context():
+        if args.command == 'rebuild':
+            rebuild_rollups(args.since)
+        elif args.command == 'reconcile':
+            reconcile_counters()
+        else:
+            purge_raw_views(args.days or app.config['RAW_VIEW_RETENTION_DAYS'])
@@ -0,0 +1,152 @@
+"""Full-text search over the extracted page text of stored documents.
+
+Text is indexed per Document, so flipbooks sharing a PDF share its index.
+On Postgres the index is a GIN expression index over to_tsvector(content).
+On SQLite, for local testing, it is an FTS5 table kept in sync with
+page_text by triggers. ensure_search_index() creates either one and is run
+by migrations.py. Documents rendered before text extraction existed are
+indexed with:
+
+    python search.py reindex
+"""
+import html
+from sqlalchemy import select, delete, insert, func, text, literal_column, table, column
+from app import db, logger
+from models import Document, Flipbook, PageText
+
+# Must be identical in the index expression and in queries for the index to be used
+SEARCH_CONFIG = 'english'
+SEARCH_QUERY_MAX_LENGTH = 200
+# Control characters that never occur in extracted text, swapped for <mark> after escaping
+_MARK_START = '\x02'
+_MARK_END = '\x03'
+_page_text_fts = table('page_text_fts', column('rowid'))
+
+def _dialect():
+    return db.session.get_bind().dialect.name
+
+def ensure_search_index():
+    """Create the full-text index for the current database, if it does not exist yet."""
+    if _dialect() == 'postgresql':
+        db.session.execute(text(
+            'CREATE INDEX IF NOT EXISTS ix_page_text_search ON page_text '
+            f"USING GIN (to_tsvector('{SEARCH_CONFIG}'::regconfig, content))"
+        ))
+    else:
+        db.session.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS page_text_fts USING fts5("
+            "content, content='page_text', content_rowid='id', tokenize='porter unicode61')"
+        ))
+        db.session.execute(text(
+            "CREATE TRIGGER IF NOT EXISTS page_text_ai AFTER INSERT ON page_text BEGIN "
+            "INSERT INTO page_text_fts (rowid, content) VALUES (new.id, new.content); END"
+        ))
+        db.session.execute(text(
+            "CREATE TRIGGER IF NOT EXISTS page_text_ad AFTER DELETE ON page_text BEGIN "
+            "INSERT INTO page_text_fts (page_text_fts, rowid, content) VALUES ('delete', old.id, old.content); END"
+        ))
+    db.session.commit()
+
+def index_document(document_id, pages):
+    """Replace the indexed text of a document with `pages`, a list of page texts; the caller commits."""
+    db.session.execute(delete(PageText).where(PageText.document_id == document_id))
+    rows = [
+        {'document_id': document_id, 'page_number': number, 'content': content.strip()}
+        for number, content in enumerate(pages, start=1)
+        if content.strip()
+    ]
+    if rows:
+        db.session.execute(insert(PageText), rows)
+    logger.info(f"Indexed text of {len(rows)} pages for document {document_id}")
+
+def _highlight(snippet):
+    return html.escape(snippet or '').replace(_MARK_START, '<mark>').replace(_MARK_END, '</mark>')
+
+def _fts5_query(query):
+    # Quote every term so user input is never parsed as FTS5 syntax
+    return ' '.join('"{}"'.format(term.replace('"', '""')) for term in query.split())
+
+def _search(query, limit, document_id=None, user_id=None):
+    query = (query or '').strip()[:SEARCH_QUERY_MAX_LENGTH]
+    if not query:
+        return []
+
+    if _dialect() == 'postgresql':
+        config = literal_column(f"'{SEARCH_CONFIG}'::regconfig")
+        vector = func.to_tsvector(config, PageText.content)
+        tsquery = func.websearch_to_tsquery(config, query)
+        stmt = select(
+            PageText.document_id,
+            PageText.page_number,
+            func.ts_headline(
+                config, PageText.content, tsquery,
+                f'StartSel={_MARK_START}, StopSel={_MARK_END}, MaxWords=20, MinWords=8'
+            ).label('snippet')
+        ).where(vector.op('@@')(tsquery)).order_by(func.ts_rank(vector, tsquery).desc(), PageText.page_number)
+    else:
+        fts = literal_column('page_text_fts')
+        stmt = select(
+            PageText.document_id,
+            PageText.page_number,
+            func.snippet(fts, 0, _MARK_START, _MARK_END, '…', 16).label('snippet')
+        ).join_from(
+            PageText, _page_text_fts, _page_text_fts.c.rowid == PageText.id
+        ).where(fts.op('MATCH')(_fts5_query(query))).order_by(func.bm25(fts), PageText.page_number)
+
+    if document_id is not None:
+        stmt = stmt.where(PageText.document_id == document_id)
+    if user_id is not None:
+        stmt = stmt.add_columns(Flipbook.id.label('flipbook_id')).join(
+            Flipbook, Flipbook.document_id == PageText.document_id
+        ).where(Flipbook.user_id == user_id, Flipbook.status == Flipbook.STATUS_READY)
+    return db.session.execute(stmt.limit(limit)).all()
+
+def search_flipbook(flipbook, query, limit=50):
+    """Pages of one flipbook matching query, best match first."""
+    if flipbook.document_id is None:
+        return []  # Uploaded before text extraction, nothing is indexed
+    return [
+        {'page_number': row.page_number, 'snippet': _highlight(row.snippet)}
+        for row in _search(query, limit, document_id=flipbook.document_id)
+    ]
+
+def search_account(user_id, query, limit=50):
+    """Matching pages across every ready flipbook a user owns, best match first."""
+    rows = _search(query, limit, user_id=user_id)
+    flipbooks = {
+        f.id: f for f in Flipbook.title.decrypt_all(
+            Flipbook.query.filter(Flipbook.id.in_(list({row.flipbook_id for row in rows}))).all()
+        )
+    } if rows else {}
+    return [{
+        'flipbook': flipbooks[row.flipbook_id].unique_id,
+        'title': flipbooks[row.flipbook_id].title,
+        'page_number': row.page_number,
+        'snippet': _highlight(row.snippet)
+    } for row in rows]
+
+def reindex_documents():
+    """Extract and index text for rendered documents that have none yet."""
+    from storage import storage
+    from utils import extract_page_text
+    indexed = select(PageText.document_id)
+    documents = Document.query.filter(
+        Document.rendered_at.isnot(None), Document.id.not_in(indexed)
+    ).order_by(Document.id).all()
+    for document in documents:
+        try:
+            index_document(document.id, extract_page_text(storage.ensure_local(document.filename)))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.warning(f"Could not index text of document {document.id}: {str(e)}")
+
+if __name__ == '__main__':
+    import sys
+    from app import create_app
+
+    app = create_app(run_services=False)
+    with app.app_context():
+        ensure_search_index()
+        if sys.argv[1:] == ['reindex']:
+            reindex_documents()
@@ -2,34 +2,188 @@ document.addEventListener('DOMContentLoaded', function() {
     const flipbook = document.getElementById('flipbook');
     let currentZoom = 1;
 
-    $(flipbook).turn({
-        width: 800,
-        height: 600,
-        autoCenter: true,
-        gradients: true,
-        acceleration: true
+    // Pages are still rendering, nothing to turn yet
+    if (!flipbook) {
+        return;
+    }
+
+    // Pages come from the page manifest. Every page gets an empty placeholder,
+    // but only pages within PAGE_WINDOW of the current one hold images, so
+    // decoded images and image requests do not grow with the document length.
+    const PAGE_WINDOW = 4;
+    const pageElements = [];
+    const loadedPages = new Set();
+    const prefetchedPages = new Set();
+    let manifest = null;
+    let bookReady = false;
+    let shownPage = 1;
+    let turnDirection = 1;
+
+    function turnBook(action, page) {
+        if (bookReady) {
+            $(flipbook).turn(action, page);
+        }
+    }
+
+    function pagePicture(page) {
+        const picture = document.createElement('picture');
+        (page.sources || []).forEach(function(source) {
+            const sourceEl = document.createElement('source');
+            sourceEl.type = source.type;
+            sourceEl.sizes = manifest.sizes;
+            sourceEl.srcset = source.srcset;
+            picture.appendChild(sourceEl);
+        });
+        const img = document.createElement('img');
+        img.decoding = 'async';
+        img.alt = `Page ${page.n}`;
+        if (page.w) {
+            img.width = page.w;
+            img.height = page.h;
+        }
+        if (page.srcset) {
+            img.sizes = manifest.sizes;
+            img.srcset = page.srcset;
+        }
+        img.src = page.src;
+        picture.appendChild(img);
+        return picture;
+    }
+
+    function updatePageWindow(current) {
+        const first = Math.max(1, current - PAGE_WINDOW);
+        const last = Math.min(manifest.page_count, current + PAGE_WINDOW);
+        loadedPages.forEach(function(number) {
+            if (number < first || number > last) {
+                pageElements[number].replaceChildren();
+                delete pageElements[number].dataset.tiles;
+                loadedPages.delete(number);
+            }
+        });
+        for (let number = first; number <= last; number++) {
+            if (loadedPages.has(number)) {
+                continue;
+            }
+            const page = manifest.pages[number - 1];
+            if (page.tiles) {
+                pageElements[number].dataset.tiles = JSON.stringify(page.tiles);
+            }
+            pageElements[number].appendChild(pagePicture(page));
+            loadedPages.add(number);
+        }
+        prefetchNextSpread(current);
+    }
+
+    // Warm the HTTP cache with the spread just beyond the window, in the direction
+    // the reader is turning, so it is ready by the time it enters the window
+    function prefetchNextSpread(current) {
+        const whenIdle = window.requestIdleCallback || function(callback) { return setTimeout(callback, 200); };
+        whenIdle(function() {
+            for (let offset = PAGE_WINDOW + 1; offset <= PAGE_WINDOW + 2; offset++) {
+                const number = current + turnDirection * offset;
+                if (number < 1 || number > manifest.page_count || prefetchedPages.has(number)) {
+                    continue;
+                }
+                prefetchedPages.add(number);
+                // A detached <picture> picks the same candidate the page will use
+                pagePicture(manifest.pages[number - 1]);
+            }
+        });
+    }
+
+    $(flipbook).bind('turning', function(event, page) {
+        turnDirection = page >= shownPage ? 1 : -1;
+        shownPage = page;
+        updatePageWindow(page);
     });
 
-    // Track page changes
-    $(flipbook).bind('turned', function(event, page) {
-        fetch(`/track_page/${window.location.pathname.split('/').pop()}`, {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json',
-            },
-            body: JSON.stringify({
-                page_number: page
-            })
+    fetch(flipbook.dataset.manifestUrl)
+        .then(function(response) {
+            if (!response.ok) {
+                throw new Error(`Page manifest request failed with ${response.status}`);
+            }
+            return response.json();
+        })
+        .then(function(data) {
+            manifest = data;
+            for (let number = 1; number <= manifest.page_count; number++) {
+                pageElements[number] = document.createElement('div');
+                pageElements[number].className = 'page';
+                flipbook.appendChild(pageElements[number]);
+            }
+            updatePageWindow(1);
+            $(flipbook).turn({
+                width: 800,
+                height: 600,
+                autoCenter: true,
+                gradients: true,
+                acceleration: true
+            });
+            bookReady = true;
+        })
+        .catch(function() {
+            flipbook.innerHTML = '<div class="alert alert-danger">The pages of this flipbook could not be loaded.</div>';
         });
+
+    // Track page turns and dwell time, batched into beacons for the view session
+    const trackUrl = flipbook.dataset.trackUrl;
+    const viewSession = flipbook.dataset.viewSession;
+    let trackedPage = 1;
+    let pageShownAt = Date.now();
+    let pendingTurns = [];
+
+    function recordDwell() {
+        const now = Date.now();
+        pendingTurns.push({ page: trackedPage, dwell_ms: now - pageShownAt });
+        pageShownAt = now;
+    }
+
+    function sendTurns() {
+        if (!pendingTurns.length || !viewSession) {
+            return;
+        }
+        const payload = JSON.stringify({ session: viewSession, page: trackedPage, events: pendingTurns });
+        pendingTurns = [];
+        if (!navigator.sendBeacon || !navigator.sendBeacon(trackUrl, new Blob([payload], { type: 'application/json' }))) {
+            fetch(trackUrl, { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: payload, keepalive: true });
+        }
+    }
+
+    $(flipbook).bind('turned', function(event, page) {
+        if (page === trackedPage) {
+            return;
+        }
+        recordDwell();
+        trackedPage = page;
+        if (pendingTurns.length >= 10) {
+            sendTurns();
+        }
+    });
+
+    setInterval(sendTurns, 15000);
+    document.addEventListener('visibilitychange', function() {
+        if (document.visibilityState === 'hidden') {
+            recordDwell();
+            sendTurns();
+        } else {
+            // Time spent in a background tab is not dwell time
+            pageShownAt = Date.now();
+        }
+    });
+    window.addEventListener('pagehide', function() {
+        if (document.visibilityState !== 'hidden') {
+            recordDwell();
+        }
+        sendTurns();
     });
 
     // Navigation controls
     document.getElementById('prev').addEventListener('click', function() {
-        $(flipbook).turn('previous');
+        turnBook('previous');
     });
 
     document.getElementById('next').addEventListener('click', function() {
-        $(flipbook).turn('next');
+        turnBook('next');
     });
 
     // Zoom controls
@@ -37,6 +191,7 @@ document.addEventListener('DOMContentLoaded', function() {
         if (currentZoom < 2) {
             currentZoom += 0.2;
             flipbook.style.transform = `scale(${currentZoom})`;
+            scheduleTileUpdate();
         }
     });
 
@@ -44,9 +199,135 @@ document.addEventListener('DOMContentLoaded', function() {
         if (currentZoom > 0.5) {
             currentZoom -= 0.2;
             flipbook.style.transform = `scale(${currentZoom})`;
+            scheduleTileUpdate();
         }
     });
 
+    // Full-text search: list the pages that mention the query and jump to them
+    const searchForm = document.getElementById('pageSearch');
+    if (searchForm) {
+        const searchInput = searchForm.querySelector('input');
+        const searchResults = searchForm.querySelector('.page-search-results');
+        searchForm.addEventListener('submit', async function(e) {
+            e.preventDefault();
+            searchResults.innerHTML = '';
+            const query = searchInput.value.trim();
+            if (!query) {
+                return;
+            }
+            const response = await fetch(`${searchForm.dataset.searchUrl}?q=${encodeURIComponent(query)}`);
+            const data = response.ok ? await response.json() : {results: []};
+            if (!data.results.length) {
+                searchResults.innerHTML = '<div class="list-group-item">No matches</div>';
+                return;
+            }
+            data.results.forEach(function(hit) {
+                const item = document.createElement('button');
+                item.type = 'button';
+                item.className = 'list-group-item list-group-item-action';
+                // Snippets are escaped by the server, <mark> is their only markup
+                item.innerHTML = `<strong>Page ${hit.page_number}</strong> ${hit.snippet}`;
+                item.addEventListener('click', function() {
+                    turnBook('page', hit.page_number);
+                    searchResults.innerHTML = '';
+                });
+                searchResults.appendChild(item);
+            });
+        });
+    }
+
+    // Deep-zoom tiles: when zoomed in, cover the visible part of each shown page
+    // with tiles from the pyramid level that matches its on-screen resolution
+    function updateTiles() {
+        flipbook.querySelectorAll('.page[data-tiles]').forEach(function(page) {
+            const img = page.querySelector('img');
+            const rect = img.getBoundingClientRect();
+            let layer = page.querySelector('.tile-layer');
+            const onScreen = rect.width > 0 && rect.right > 0 && rect.bottom > 0 &&
+                rect.left < window.innerWidth && rect.top < window.innerHeight;
+            if (currentZoom <= 1 || !onScreen) {
+                if (layer) {
+                    layer.remove();
+                }
+                return;
+            }
+
+            const tiles = JSON.parse(page.dataset.tiles);
+            // Box the image is drawn in, since the <img> uses object-fit: contain
+            const fit = Math.min(img.clientWidth / tiles.width, img.clientHeight / tiles.height);
+            const drawnWidth = tiles.width * fit;
+            const drawnHeight = tiles.height * fit;
+            const offsetX = (img.clientWidth - drawnWidth) / 2;
+            const offsetY = (img.clientHeight - drawnHeight) / 2;
+
+            // On-screen scale of the page, including the zoom transform
+            const screenScale = rect.width / img.clientWidth;
+            const devicePixels = drawnWidth * screenScale * (window.devicePixelRatio || 1);
+            const level = Math.max(0, Math.min(tiles.max_level,
+                tiles.max_level - Math.floor(Math.log2(tiles.width / devicePixels))));
+            const levelScale = Math.pow(2, tiles.max_level - level);
+            const levelWidth = Math.ceil(tiles.width / levelScale);
+            const levelHeight = Math.ceil(tiles.height / levelScale);
+            const cssPerPixel = drawnWidth / levelWidth;
+
+            if (!layer) {
+                layer = document.createElement('div');
+                layer.className = 'tile-layer';
+                page.appendChild(layer);
+            }
+            layer.style.left = `${img.offsetLeft + offsetX}px`;
+            layer.style.top = `${img.offsetTop + offsetY}px`;
+            layer.style.width = `${drawnWidth}px`;
+            layer.style.height = `${drawnHeight}px`;
+            if (layer.dataset.level !== String(level)) {
+                layer.innerHTML = '';
+                layer.dataset.level = level;
+            }
+
+            // Visible part of the drawn image, in pixels of the chosen level
+            const left = rect.left + offsetX * screenScale;
+            const top = rect.top + offsetY * screenScale;
+            const toLevel = levelWidth / (drawnWidth * screenScale);
+            const x0 = Math.max(0, (0 - left) * toLevel);
+            const y0 = Math.max(0, (0 - top) * toLevel);
+            const x1 = Math.min(levelWidth, (window.innerWidth - left) * toLevel);
+            const y1 = Math.min(levelHeight, (window.innerHeight - top) * toLevel);
+            const size = tiles.tile_size;
+
+            for (let col = Math.floor(x0 / size); col * size < x1; col++) {
+                for (let row = Math.floor(y0 / size); row * size < y1; row++) {
+                    const key = `${col}_${row}`;
+                    if (layer.querySelector(`[data-key="${key}"]`)) {
+                        continue;
+                    }
+                    const tile = document.createElement('img');
+                    tile.dataset.key = key;
+                    tile.src = `${tiles.url}/${level}/${key}.jpg`;
+                    tile.style.left = `${col * size * cssPerPixel}px`;
+                    tile.style.top = `${row * size * cssPerPixel}px`;
+                    tile.style.width = `${Math.min(size, levelWidth - col * size) * cssPerPixel}px`;
+                    tile.style.height = `${Math.min(size, levelHeight - row * size) * cssPerPixel}px`;
+                    layer.appendChild(tile);
+                }
+            }
+        });
+    }
+
+    let tileUpdatePending = false;
+    function scheduleTileUpdate() {
+        if (!tileUpdatePending) {
+            tileUpdatePending = true;
+            requestAnimationFrame(function() {
+                tileUpdatePending = false;
+                updateTiles();
+            });
+        }
+    }
+
+    $(flipbook).bind('turned', scheduleTileUpdate);
+    window.addEventListener('scroll', scheduleTileUpdate, { passive: true });
+    window.addEventListener('resize', scheduleTileUpdate);
+
     // Sharing functionality with improved clipboard API
     document.getElementById('copyShareLink').addEventListener('click', async function() {
         const shareUrl = this.getAttribute('data-share-url');
@@ -101,10 +382,13 @@ document.addEventListener('DOMContentLoaded', function() {
 
     // Keyboard navigation
     document.addEventListener('keydown', function(e) {
+        if (e.target.matches('input, textarea')) {
+            return;
+        }
         if (e.key === 'ArrowLeft') {
-            $(flipbook).turn('previous');
+            turnBook('previous');
         } else if (e.key === 'ArrowRight') {
-            $(flipbook).turn('next');
+            turnBook('next');
         }
     });
 });
@@ -0,0 +1,197 @@
+"""Where stored PDFs and rendered page assets live.
+
+Keys are paths relative to UPLOAD_FOLDER ('<hash>.pdf', '<hash>/page_1.jpg'),
+which stays the local working directory for uploads and rendering. With the
+local backend that directory is the store itself. With the S3 backend,
+finished files are published to a bucket so any node can serve or render them,
+and the local copies are only a cache.
+"""
+import os
+import uuid
+import shutil
+import mimetypes
+from concurrent.futures import ThreadPoolExecutor
+from app import logger
+
+class LocalStorage:
+    """Files stay in UPLOAD_FOLDER and are sent by the app or the front proxy."""
+
+    remote = False
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def put_file(self, local_path, key):
+        if os.path.abspath(local_path) != os.path.abspath(self.path(key)):
+            os.makedirs(os.path.dirname(self.path(key)), exist_ok=True)
+            shutil.copyfile(local_path, self.path(key))
+
+    def put_dir(self, local_dir, prefix):
+        if os.path.abspath(local_dir) != os.path.abspath(self.path(prefix)):
+            shutil.copytree(local_dir, self.path(prefix), dirs_exist_ok=True)
+
+    def fetch(self, key, local_path):
+        if os.path.abspath(local_path) != os.path.abspath(self.path(key)):
+            shutil.copyfile(self.path(key), local_path)
+
+    def url(self, key, expires_in=3600):
+        return None
+
+    def read(self, key):
+        try:
+            with open(self.path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def delete(self, key):
+        if os.path.exists(self.path(key)):
+            os.remove(self.path(key))
+
+    def delete_prefix(self, prefix):
+        shutil.rmtree(self.path(prefix), ignore_errors=True)
+
+class S3Storage:
+    """An S3-compatible bucket (AWS, MinIO, moto) behind one pooled, thread-safe client.
+
+    Large files go up as parallel multipart uploads and rendered page
+    directories are published with STORAGE_UPLOAD_WORKERS concurrent uploads.
+    Reads are redirects to presigned URLs, or are proxied through the app
+    when S3_PRESIGNED_READS is off.
+    """
+
+    remote = True
+
+    def __init__(self, app):
+        # boto3 is only needed when this backend is configured
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+        from botocore.config import Config
+        self.root = app.config['UPLOAD_FOLDER']
+        self.bucket = app.config['S3_BUCKET']
+        self.prefix = app.config['S3_PREFIX']
+        self.presigned_reads = app.config['S3_PRESIGNED_READS']
+        self.upload_workers = app.config['STORAGE_UPLOAD_WORKERS']
+        self.client = boto3.client(
+            's3',
+            endpoint_url=app.config['S3_ENDPOINT_URL'] or None,
+            region_name=app.config['S3_REGION'] or None,
+            config=Config(
+                max_pool_connections=app.config['S3_MAX_POOL_CONNECTIONS'],
+                retries={'max_attempts': 5, 'mode': 'adaptive'}
+            )
+        )
+        self.transfer_config = TransferConfig(
+            multipart_threshold=16 * 1024 * 1024,
+            multipart_chunksize=16 * 1024 * 1024,
+            max_concurrency=self.upload_workers
+        )
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def object_key(self, key):
+        return f"{self.prefix.rstrip('/')}/{key}" if self.prefix else key
+
+    def put_file(self, local_path, key, cache_control='public, max-age=86400'):
+        self.client.upload_file(
+            local_path, self.bucket, self.object_key(key),
+            ExtraArgs={
+                'ContentType': mimetypes.guess_type(local_path)[0] or 'application/octet-stream',
+                'CacheControl': cache_control
+            },
+            Config=self.transfer_config
+        )
+
+    def put_dir(self, local_dir, prefix):
+        uploads = []
+        for dirpath, _, filenames in os.walk(local_dir):
+            for filename in filenames:
+                local_path = os.path.join(dirpath, filename)
+                uploads.append((local_path, f'{prefix}/{os.path.relpath(local_path, local_dir)}'))
+        with ThreadPoolExecutor(max_workers=self.upload_workers) as executor:
+            # list() re-raises the first failed upload
+            list(executor.map(lambda upload: self.put_file(*upload), uploads))
+        logger.info(f"Published {len(uploads)} files under {prefix}")
+
+    def fetch(self, key, local_path):
+        tmp_path = f'{local_path}.{uuid.uuid4().hex}.download'
+        self.client.download_file(self.bucket, self.object_key(key), tmp_path, Config=self.transfer_config)
+        os.replace(tmp_path, local_path)
+
+    def read(self, key):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self.object_key(key))['Body'].read()
+        except self.client.exceptions.NoSuchKey:
+            return None
+
+    def open(self, key, range=None, if_none_match=None, if_modified_since=None):
+        """Fetch an object for a proxied read, passing the client's Range and conditional headers to S3.
+
+        Returns (status, get_object response): 200 or 206 with the object,
+        304 when the client's copy is current, 404 or 416 without one.
+        """
+        params = {'Bucket': self.bucket, 'Key': self.object_key(key)}
+        if range:
+            params['Range'] = range
+        if if_none_match:
+            params['IfNoneMatch'] = if_none_match
+        if if_modified_since:
+            params['IfModifiedSince'] = if_modified_since
+        try:
+            obj = self.client.get_object(**params)
+        except self.client.exceptions.NoSuchKey:
+            return 404, None
+        except self.client.exceptions.ClientError as e:
+            status = e.response['ResponseMetadata']['HTTPStatusCode']
+            if status in (304, 416):
+                return status, None
+            raise
+        return (206 if 'ContentRange' in obj else 200), obj
+
+    def url(self, key, expires_in=3600):
+        if not self.presigned_reads:
+            return None
+        return self.client.generate_presigned_url(
+            'get_object', Params={'Bucket': self.bucket, 'Key': self.object_key(key)}, ExpiresIn=expires_in
+        )
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.object_key(key))
+
+    def delete_prefix(self, prefix):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.object_key(prefix) + '/'):
+            objects = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+            if objects:
+                self.client.delete_objects(Bucket=self.bucket, Delete={'Objects': objects})
+
+class Storage:
+    """Proxy to the configured backend, so modules can import it before the app exists."""
+
+    def __init__(self):
+        self.backend = None
+
+    def init_app(self, app):
+        if app.config['STORAGE_BACKEND'] == 's3':
+            self.backend = S3Storage(app)
+            logger.info(f"Storing files in bucket {app.config['S3_BUCKET']}")
+        else:
+            self.backend = LocalStorage(app.config['UPLOAD_FOLDER'])
+
+    def ensure_local(self, key):
+        """Return a local path for key, downloading it first on remote backends."""
+        local_path = self.backend.path(key)
+        if not os.path.exists(local_path):
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            self.backend.fetch(key, local_path)
+        return local_path
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+# Global storage instance
+storage = Storage()
@@ -0,0 +1,110 @@
+"""The async API tier must answer exactly like the Flask views it stands in for.
+
+Each endpoint served by asgi.py is requested from both apps against the same
+SQLite database, and status, content type and body are compared.
+"""
+import os
+import tempfile
+from datetime import datetime, timedelta
+import pytest
+
+pytest.importorskip('flask')
+pytest.importorskip('starlette')
+pytest.importorskip('httpx')
+pytest.importorskip('aiosqlite')
+
+WORKDIR = tempfile.mkdtemp(prefix='asgi-parity-')
+os.environ.setdefault('FLASK_SECRET_KEY', 'asgi-parity-secret-key')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(WORKDIR, 'parity.db')}"
+os.environ['AUTO_CREATE_SCHEMA'] = 'true'
+os.environ['RENDER_WORKERS'] = '0'
+
+import jwt
+from starlette.testclient import TestClient
+from app import create_app, db
+from models import User, Flipbook
+from api import generate_access_token
+from rollups import apply_batch
+
+@pytest.fixture(scope='module')
+def apps():
+    from asgi import create_asgi_app
+    flask_app = create_app(run_services=False)
+    with flask_app.app_context():
+        users = []
+        for n in range(2):
+            user = User()
+            user.username = f'parity{n}'
+            user.email = f'parity{n}@example.com'
+            user.set_password('parity-password')
+            db.session.add(user)
+            users.append(user)
+        db.session.flush()
+        flipbooks = []
+        for n, status in enumerate((Flipbook.STATUS_QUEUED, Flipbook.STATUS_FAILED, Flipbook.STATUS_QUEUED)):
+            flipbook = Flipbook(filename=f'parity-{n}.pdf', user_id=users[0].id, status=status)
+            flipbook.title = f'Parity {n}'
+            db.session.add(flipbook)
+            flipbooks.append(flipbook)
+        foreign = Flipbook(filename='foreign.pdf', user_id=users[1].id)
+        foreign.title = 'Foreign'
+        db.session.add(foreign)
+        db.session.flush()
+        apply_batch([{'flipbook_id': flipbooks[0].id, 'viewed_at': datetime.utcnow()}],
+                    [{'flipbook_id': flipbooks[0].id, 'turned_at': datetime.utcnow(), 'page_number': 1, 'dwell_ms': 900}])
+        db.session.commit()
+        context = {
+            'token': generate_access_token(users[0]),
+            'expired_token': jwt.encode(
+                {'user_id': users[0].id, 'epoch': users[0].auth_epoch, 'exp': datetime.utcnow() - timedelta(minutes=1)},
+                os.environ['FLASK_SECRET_KEY'], algorithm='HS256'
+            ),
+            'flipbook': flipbooks[0].unique_id,
+            'foreign': foreign.unique_id,
+        }
+    context['flask'] = flask_app.test_client()
+    context['asgi'] = TestClient(create_asgi_app(flask_app))
+    return context
+
+def assert_same(apps, path, token=None, headers=None):
+    headers = dict(headers or {})
+    if token is not None:
+        headers['Authorization'] = f'Bearer {token}'
+    expected = apps['flask'].get(path, headers=headers)
+    actual = apps['asgi'].get(path, headers=headers)
+    assert actual.status_code == expected.status_code
+    assert actual.headers['content-type'].replace(' ', '') == expected.headers['Content-Type'].replace(' ', '')
+    if expected.is_json:
+        assert actual.json() == expected.get_json()
+    else:
+        assert actual.content == expected.data
+    return actual
+
+def test_list(apps):
+    response = assert_same(apps, '/api/flipbooks', apps['token'])
+    assert len(response.json()['flipbooks']) == 3
+    assert_same(apps, '/api/flipbooks?limit=2&fields=unique_id,status', apps['token'])
+    assert_same(apps, '/api/flipbooks?fields=nope', apps['token'])
+
+def test_list_etag(apps):
+    etag = assert_same(apps, '/api/flipbooks?limit=2', apps['token']).headers['etag']
+    assert_same(apps, '/api/flipbooks?limit=2', apps['token'], {'If-None-Match': etag})
+
+def test_detail(apps):
+    assert_same(apps, f"/api/flipbooks/{apps['flipbook']}", apps['token'])
+    assert_same(apps, f"/api/flipbooks/{apps['foreign']}", apps['token'])
+    assert_same(apps, '/api/flipbooks/does-not-exist', apps['token'])
+
+def test_status(apps):
+    assert_same(apps, f"/api/flipbooks/{apps['flipbook']}/status", apps['token'])
+    assert_same(apps, '/api/flipbooks/does-not-exist/status', apps['token'])
+
+def test_analytics(apps):
+    response = assert_same(apps, '/api/analytics', apps['token'])
+    assert sum(data['total_views'] for data in response.json().values()) == 1
+
+@pytest.mark.parametrize('token', [None, 'not-a-jwt', 'expired'])
+def test_rejected_tokens(apps, token):
+    token = apps['expired_token'] if token == 'expired' else token
+    for path in ('/api/flipbooks', f"/api/flipbooks/{apps['flipbook']}", '/api/analytics'):
+        assert assert_same(apps, path, token).status_code == 401
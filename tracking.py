@@ -0,0 +1,217 @@
+import time
+import queue
+import atexit
+import secrets
+import threading
+from datetime import datetime
+from flask import current_app
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+from sqlalchemy import insert, update, bindparam
+from app import db, logger
+from encryption import encryptor
+from models import PageView, PageTurn
+from rollups import apply_batch
+
+# Upper bounds for one beacon, anything larger is truncated
+MAX_TURNS_PER_BEACON = 200
+MAX_DWELL_MS = 30 * 60 * 1000
+# A viewer tab left open longer than this stops reporting page turns
+VIEW_SESSION_MAX_AGE = 6 * 60 * 60
+
+class ViewRecorder:
+    """Buffers page-view and page-turn events in process and writes them in bulk.
+
+    Viewer requests only append to a bounded queue. A background writer
+    encrypts and inserts events in batches once VIEW_FLUSH_SIZE events are
+    waiting or VIEW_FLUSH_INTERVAL seconds have passed, and drains the buffer
+    on interpreter shutdown. When the buffer is full new events are dropped
+    and counted rather than slowing the viewer down.
+    """
+
+    def __init__(self):
+        self.app = None
+        self._queue = None
+        self._writer = None
+        self._stopping = threading.Event()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'enqueued': 0,
+            'written': 0,
+            'dropped': 0,
+            'failed': 0,
+            'flushes': 0,
+            'flush_seconds_total': 0.0,
+            'flush_seconds_max': 0.0,
+        }
+
+    def init_app(self, app):
+        self.app = app
+        self.flush_size = app.config['VIEW_FLUSH_SIZE']
+        self.flush_interval = app.config['VIEW_FLUSH_INTERVAL']
+        self._queue = queue.Queue(maxsize=app.config['VIEW_BUFFER_MAX'])
+        self._writer = threading.Thread(target=self._run, name='view-writer', daemon=True)
+        self._writer.start()
+        atexit.register(self.shutdown)
+        logger.info(f"View recorder flushing every {self.flush_size} views or {self.flush_interval}s")
+
+    def record(self, flipbook_id, ip_address, session_id=None):
+        self._enqueue({
+            'kind': 'view',
+            'flipbook_id': flipbook_id,
+            'session_id': session_id,
+            'ip_address': ip_address,
+            'viewed_at': datetime.utcnow()
+        })
+
+    def record_turns(self, flipbook_id, session_id, page_number, turns):
+        """Queue a viewer beacon: the current page plus (page, dwell_ms) pairs."""
+        self._enqueue({
+            'kind': 'turns',
+            'flipbook_id': flipbook_id,
+            'session_id': session_id,
+            'page_number': page_number,
+            'turns': turns,
+            'turned_at': datetime.utcnow()
+        })
+
+    def _enqueue(self, event):
+        if self._writer is None:
+            # No background writer (scripts, tests), write through
+            self._flush([event])
+            return
+        try:
+            self._queue.put_nowait(event)
+            self._count('enqueued')
+        except queue.Full:
+            self._count('dropped')
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['buffered'] = self._queue.qsize() if self._queue else 0
+        return stats
+
+    def shutdown(self, timeout=10):
+        """Stop the writer and flush whatever is still buffered."""
+        if self._writer is None or self._stopping.is_set():
+            return
+        self._stopping.set()
+        self._writer.join(timeout)
+        logger.info(f"View recorder stopped: {self.stats()}")
+
+    def _count(self, key, amount=1):
+        with self._stats_lock:
+            self._stats[key] += amount
+
+    def _run(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            timeout = max(0.0, deadline - time.monotonic())
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                pass
+            stopping = self._stopping.is_set()
+            if stopping:
+                while True:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+            if batch and (len(batch) >= self.flush_size or time.monotonic() >= deadline or stopping):
+                with self.app.app_context():
+                    self._flush(batch)
+                batch = []
+            if time.monotonic() >= deadline:
+                deadline = time.monotonic() + self.flush_interval
+            if stopping:
+                return
+
+    def _flush(self, events):
+        started = time.perf_counter()
+        views = [{
+            'flipbook_id': event['flipbook_id'],
+            'session_id': event['session_id'],
+            'viewed_at': event['viewed_at'],
+            'ip_address_encrypted': encryptor.encrypt(event['ip_address'])
+        } for event in events if event['kind'] == 'view']
+        turns = []
+        current_pages = {}
+        for event in events:
+            if event['kind'] != 'turns':
+                continue
+            current_pages[event['session_id']] = event['page_number']
+            turns.extend({
+                'session_id': event['session_id'],
+                'flipbook_id': event['flipbook_id'],
+                'page_number': page_number,
+                'dwell_ms': dwell_ms,
+                'turned_at': event['turned_at']
+            } for page_number, dwell_ms in event['turns'])
+        try:
+            # Views first, so sessions opened in this batch exist for the page update
+            if views:
+                db.session.execute(insert(PageView), views)
+            if turns:
+                db.session.execute(insert(PageTurn), turns)
+            if current_pages:
+                # Core executemany: one indexed UPDATE per session in the batch
+                page_views = PageView.__table__
+                db.session.connection().execute(
+                    update(page_views)
+                    .where(page_views.c.session_id == bindparam('sid'))
+                    .values(page_number=bindparam('page')),
+                    [{'sid': sid, 'page': page} for sid, page in current_pages.items()]
+                )
+            # Same transaction, so rollups never count rows that were not written
+            apply_batch(views, turns)
+            db.session.commit()
+            self._count('written', len(events))
+        except Exception as e:
+            db.session.rollback()
+            self._count('failed', len(events))
+            logger.error(f"Failed to write {len(events)} view events: {str(e)}")
+            return
+        elapsed = time.perf_counter() - started
+        with self._stats_lock:
+            self._stats['flushes'] += 1
+            self._stats['flush_seconds_total'] += elapsed
+            self._stats['flush_seconds_max'] = max(self._stats['flush_seconds_max'], elapsed)
+
+def issue_view_session(flipbook_id):
+    """Return a new session id and the signed, opaque token handed to the viewer."""
+    session_id = secrets.token_hex(16)
+    serializer = URLSafeTimedSerializer(current_app.config['SECRET_KEY'], salt='view-session')
+    return session_id, serializer.dumps([flipbook_id, session_id])
+
+def read_view_session(token):
+    """Return (flipbook_id, session_id) for a token, or None if it was not issued by us or has expired."""
+    serializer = URLSafeTimedSerializer(current_app.config['SECRET_KEY'], salt='view-session')
+    try:
+        flipbook_id, session_id = serializer.loads(token, max_age=VIEW_SESSION_MAX_AGE)
+    except (BadSignature, TypeError, ValueError):  # SignatureExpired is a BadSignature
+        return None
+    return flipbook_id, session_id
+
+def parse_beacon(payload):
+    """Validate a viewer beacon into (token, current page, [(page, dwell_ms)]), or None."""
+    if not isinstance(payload, dict) or not isinstance(payload.get('session'), str):
+        return None
+    page_number = payload.get('page')
+    if not isinstance(page_number, int) or page_number < 1:
+        return None
+    events = payload.get('events') or []
+    if not isinstance(events, list):
+        return None
+    turns = []
+    for event in events[:MAX_TURNS_PER_BEACON]:
+        if not isinstance(event, dict):
+            continue
+        page, dwell_ms = event.get('page'), event.get('dwell_ms')
+        if isinstance(page, int) and page >= 1 and isinstance(dwell_ms, (int, float)):
+            turns.append((page, int(min(max(dwell_ms, 0), MAX_DWELL_MS))))
+    return payload['session'], page_number, turns
+
+# Global view recorder instance
+view_recorder = ViewRecorder()
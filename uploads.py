@@ -0,0 +1,142 @@
+"""Resumable, chunked PDF uploads (a subset of the tus protocol).
+
+A client creates an upload with its total length, appends chunks with PATCH
+at the offset the server reports, and finalizes it once every byte arrived.
+Chunks are streamed straight into <UPLOAD_SESSION_FOLDER>/<id>.part, so
+memory use per request is one read buffer regardless of the file size. That
+folder sits outside the statically served UPLOAD_FOLDER, so a half-uploaded
+file can never be fetched. The
+part file's size is the authoritative offset, which lets an interrupted
+chunk resume from whatever reached the disk.
+"""
+import os
+import time
+import fcntl
+import hashlib
+import threading
+from datetime import datetime, timedelta
+from app import db, logger
+from models import UploadSession
+from documents import acquire_document, UPLOAD_CHUNK_SIZE
+
+# Running SHA-256 per upload in this process, as (offset, hasher). A chunk
+# that lands on another worker drops the entry and finalize rehashes the file.
+_hashers = {}
+_hashers_lock = threading.Lock()
+
+class UploadError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def part_path(session_folder, upload):
+    return os.path.join(session_folder, f'{upload.id}.part')
+
+def upload_offset(session_folder, upload):
+    try:
+        return os.path.getsize(part_path(session_folder, upload))
+    except OSError:
+        return 0
+
+def create_upload(user_id, title, length, session_folder, max_length):
+    """Start an upload of `length` bytes; the caller commits."""
+    if length <= 0:
+        raise UploadError('Upload-Length must be a positive number of bytes')
+    if length > max_length:
+        raise UploadError(f'Upload-Length must be at most {max_length} bytes', 413)
+    upload = UploadSession(user_id=user_id, upload_length=length)
+    upload.title = title
+    db.session.add(upload)
+    db.session.flush()
+    os.makedirs(session_folder, exist_ok=True)
+    open(part_path(session_folder, upload), 'wb').close()
+    with _hashers_lock:
+        _hashers[upload.id] = (0, hashlib.sha256())
+    return upload
+
+def append_chunk(upload, stream, offset, session_folder):
+    """Append the request body at `offset` and return the new offset."""
+    path = part_path(session_folder, upload)
+    if not os.path.exists(path):
+        raise UploadError('Upload not found', 404)
+    with open(path, 'ab') as out:
+        try:
+            fcntl.flock(out, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise UploadError('Another chunk is being written to this upload', 423)
+        try:
+            current = os.fstat(out.fileno()).st_size
+            if offset != current:
+                raise UploadError(f'Upload-Offset must be {current}', 409)
+            with _hashers_lock:
+                hashed_to, hasher = _hashers.pop(upload.id, (None, None))
+            if hashed_to != current:
+                hasher = None
+
+            remaining = upload.upload_length - current
+            while remaining > 0:
+                chunk = stream.read(min(UPLOAD_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                out.write(chunk)
+                if hasher:
+                    hasher.update(chunk)
+                remaining -= len(chunk)
+            out.flush()
+            os.fsync(out.fileno())
+            current = upload.upload_length - remaining
+
+            if hasher:
+                with _hashers_lock:
+                    _hashers[upload.id] = (current, hasher)
+            if remaining == 0 and stream.read(1):
+                raise UploadError('Chunk runs past Upload-Length', 413)
+            return current
+        finally:
+            fcntl.flock(out, fcntl.LOCK_UN)
+
+def finalize_upload(upload, session_folder, upload_folder):
+    """Turn a complete upload into a shared Document and delete the session; the caller commits."""
+    path = part_path(session_folder, upload)
+    if upload_offset(session_folder, upload) != upload.upload_length:
+        raise UploadError('Upload is incomplete', 409)
+    with open(path, 'rb') as f:
+        if f.read(5) != b'%PDF-':
+            raise UploadError('Uploaded file is not a PDF', 415)
+
+    with _hashers_lock:
+        hashed_to, hasher = _hashers.pop(upload.id, (None, None))
+    if hashed_to != upload.upload_length:
+        logger.info(f"Rehashing upload {upload.id}, its chunks were spread over several workers")
+        hasher = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+                hasher.update(chunk)
+
+    # The part file is moved into place once the caller commits, and kept for a retry if it does not
+    document = acquire_document(hasher.hexdigest(), path, upload_folder)
+    db.session.delete(upload)
+    return document
+
+def discard_upload(upload, session_folder):
+    with _hashers_lock:
+        _hashers.pop(upload.id, None)
+    path = part_path(session_folder, upload)
+    if os.path.exists(path):
+        os.remove(path)
+    db.session.delete(upload)
+
+def purge_stale_uploads(session_folder, max_age_hours):
+    """Drop uploads that received no bytes for max_age_hours."""
+    cutoff = datetime.utcnow() - timedelta(hours=max_age_hours)
+    idle_since = time.time() - max_age_hours * 3600
+    purged = 0
+    for upload in UploadSession.query.filter(UploadSession.created_at < cutoff).all():
+        path = part_path(session_folder, upload)
+        if os.path.exists(path) and os.path.getmtime(path) > idle_since:
+            continue  # Old but still receiving chunks
+        discard_upload(upload, session_folder)
+        purged += 1
+    if purged:
+        db.session.commit()
+        logger.info(f"Purged {purged} abandoned uploads")
@@ -1,20 +1,460 @@
+import io
 import os
+import re
+import subprocess
+import json
+import math
+import time
 import uuid
-from pdf2image import convert_from_path
+import hashlib
+import mimetypes
+from functools import lru_cache
+from flask import url_for, current_app, send_file, redirect, request, Response, abort
 from werkzeug.utils import secure_filename
+from storage import storage
+from metrics import metrics
+
+# pdf2image and Pillow are imported inside the render functions so processes
+# that only serve the web app or the API never pay for loading them
+
+RENDER_DPI = 200
+RENDER_THREADS = 2
+RENDER_MAX_MEMORY_MB = 256
+TILE_SIZE = 256
+
+# Derivative name and target width in pixels, the full-size page_N.jpg is kept as 'original'
+PAGE_VARIANTS = (
+    ('thumb', 200),
+    ('viewer', 800),
+    ('retina', 1600),
+)
+# Each page is half of the 800px two-page spread: 400px, or half the viewport when it is narrower
+PAGE_IMG_SIZES = '(max-width: 800px) 50vw, 400px'
+MANIFEST_FILENAME = 'manifest.json'
+PAGE_FILE_PATTERN = re.compile(r'page_(\d+)(?:_[a-z]+)?\.(?:jpg|webp|avif)')
+IMAGE_FORMATS = {
+    'jpeg': ('JPEG', 'jpg', 'image/jpeg'),
+    'webp': ('WEBP', 'webp', 'image/webp'),
+    'avif': ('AVIF', 'avif', 'image/avif'),
+}
+# Versioned asset URLs never change content, unversioned ones are revalidated daily
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+PAGE_MAX_AGE = 86400
+# Seconds a manifest read from remote storage is reused
+REMOTE_MANIFEST_TTL = 300
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() == 'pdf'
 
-def process_pdf(pdf_path, output_dir):
+def get_page_sizes(pdf_path, page_count):
+    """Return the size in points of every page, keyed by page number."""
+    from pdf2image import pdfinfo_from_path
+    info = pdfinfo_from_path(pdf_path, first_page=1, last_page=page_count)
+    sizes = {}
+    for key, value in info.items():
+        key_match = re.match(r'Page\s+(\d+) size', key)
+        size_match = re.match(r'([\d.]+) x ([\d.]+)', value)
+        if key_match and size_match:
+            sizes[int(key_match.group(1))] = (float(size_match.group(1)), float(size_match.group(2)))
+    return sizes
+
+def get_pdf_info(pdf_path):
+    """Return the page count and first page size (in points) without rasterizing."""
+    from pdf2image import pdfinfo_from_path
+    info = pdfinfo_from_path(pdf_path)
+    width, height = 612.0, 792.0  # Fall back to US Letter
+    match = re.match(r'([\d.]+) x ([\d.]+)', info.get('Page size', ''))
+    if match:
+        width, height = float(match.group(1)), float(match.group(2))
+    return int(info['Pages']), (width, height)
+
+def extract_page_text(pdf_path, timeout=300):
+    """Return the text of every page, in order, using poppler's pdftotext."""
+    result = subprocess.run(
+        ['pdftotext', '-enc', 'UTF-8', pdf_path, '-'],
+        capture_output=True, check=True, timeout=timeout
+    )
+    # pdftotext ends every page with a form feed
+    pages = result.stdout.decode('utf-8', errors='replace').split('\f')
+    if pages and not pages[-1].strip():
+        pages.pop()
+    return pages
+
+def pages_per_window(page_size, dpi, max_memory_mb):
+    # A decoded RGB page costs width * height * 3 bytes at the target DPI
+    width_px = page_size[0] / 72 * dpi
+    height_px = page_size[1] / 72 * dpi
+    page_bytes = width_px * height_px * 3
+    return max(1, int(max_memory_mb * 1024 * 1024 // page_bytes))
+
+def supported_formats(formats):
+    """Filter optional output formats down to the ones this Pillow build can encode."""
+    from PIL import features
+    supported = []
+    for fmt in formats:
+        fmt = fmt.strip().lower()
+        if fmt in IMAGE_FORMATS and fmt != 'jpeg' and features.check(fmt):
+            supported.append(fmt)
+    return supported
+
+def tile_layout(page_number, width, height, tile_size=TILE_SIZE):
+    """Describe a page's deep-zoom pyramid: level max_level is full size, each level below halves it."""
+    return {
+        'dir': f'page_{page_number}_tiles',
+        'tile_size': tile_size,
+        'overlap': 0,
+        'format': 'jpg',
+        'width': width,
+        'height': height,
+        'max_level': math.ceil(math.log2(max(width, height, 2)))
+    }
+
+def generate_tiles(image, output_dir, page_number, tile_size=TILE_SIZE):
+    """Cut a page into <dir>/<level>/<col>_<row>.jpg tiles, laid out like Deep Zoom (DZI)."""
+    from PIL import Image
+    layout = tile_layout(page_number, image.width, image.height, tile_size)
+    level_image = image
+    for level in range(layout['max_level'], -1, -1):
+        level_dir = os.path.join(output_dir, layout['dir'], str(level))
+        os.makedirs(level_dir, exist_ok=True)
+        width, height = level_image.size
+        for col in range(math.ceil(width / tile_size)):
+            for row in range(math.ceil(height / tile_size)):
+                x, y = col * tile_size, row * tile_size
+                tile = level_image.crop((x, y, min(x + tile_size, width), min(y + tile_size, height)))
+                save_image(tile, os.path.join(level_dir, f'{col}_{row}.jpg'), 'JPEG', hash=False, quality=82)
+        if level > 0:
+            with metrics.stage('resize'):
+                next_image = level_image.resize(
+                    (max(1, math.ceil(width / 2)), max(1, math.ceil(height / 2))),
+                    Image.Resampling.LANCZOS
+                )
+            if level_image is not image:
+                level_image.close()
+            level_image = next_image
+    if level_image is not image:
+        level_image.close()
+    return layout
+
+def save_page_variants(image, output_dir, page_number, extra_formats=(), tile_size=None):
+    """Write the full-size page, its resized derivatives and optional tiles, returning manifest metadata."""
+    from PIL import Image
+    image = image.convert('RGB')
+    original_file = f'page_{page_number}.jpg'
+    variants = [{
+        'name': 'original',
+        'format': 'jpeg',
+        'file': original_file,
+        'hash': save_image(image, os.path.join(output_dir, original_file), 'JPEG'),
+        'width': image.width,
+        'height': image.height
+    }]
+
+    for name, width in PAGE_VARIANTS:
+        with metrics.stage('resize'):
+            derivative = image.copy()
+            # thumbnail() keeps the aspect ratio and never upscales
+            derivative.thumbnail((width, image.height), resample=Image.Resampling.LANCZOS)
+        for fmt in ('jpeg', *extra_formats):
+            pil_format, ext, _ = IMAGE_FORMATS[fmt]
+            filename = f'page_{page_number}_{name}.{ext}'
+            variants.append({
+                'name': name,
+                'format': fmt,
+                'file': filename,
+                'hash': save_image(derivative, os.path.join(output_dir, filename), pil_format, quality=82),
+                'width': derivative.width,
+                'height': derivative.height
+            })
+        derivative.close()
+
+    page = {
+        'number': page_number,
+        'width': image.width,
+        'height': image.height,
+        'variants': variants
+    }
+    if tile_size:
+        page['tiles'] = generate_tiles(image, output_dir, page_number, tile_size)
+    return page
+
+def save_image(image, path, pil_format, hash=True, **options):
+    """Encode an image in memory and write it out, timing both.
+
+    Returns a short content hash of the file, used as its cache-busting URL
+    segment, or None with hash=False for files addressed without one (tiles).
+    """
+    with metrics.stage('encode'):
+        buffer = io.BytesIO()
+        image.save(buffer, pil_format, **options)
+        data = buffer.getvalue()
+    with metrics.stage('write'):
+        with open(path, 'wb') as f:
+            f.write(data)
+    return hashlib.sha256(data).hexdigest()[:16] if hash else None
+
+def estimate_page_variants(page_number, width, height, extra_formats=(), tile_size=None):
+    """Describe the variants save_page_variants would write for a page that is not rendered yet."""
+    variants = [{
+        'name': 'original',
+        'format': 'jpeg',
+        'file': f'page_{page_number}.jpg',
+        'width': width,
+        'height': height
+    }]
+    for name, target_width in PAGE_VARIANTS:
+        scaled_width = min(width, target_width)
+        scaled_height = round(height * scaled_width / width)
+        for fmt in ('jpeg', *extra_formats):
+            variants.append({
+                'name': name,
+                'format': fmt,
+                'file': f'page_{page_number}_{name}.{IMAGE_FORMATS[fmt][1]}',
+                'width': scaled_width,
+                'height': scaled_height
+            })
+    page = {
+        'number': page_number,
+        'width': width,
+        'height': height,
+        'lazy': True,
+        'variants': variants
+    }
+    if tile_size:
+        page['tiles'] = tile_layout(page_number, width, height, tile_size)
+    return page
+
+def render_page(pdf_path, page_number, output_dir, dpi=RENDER_DPI, extra_formats=(), tile_size=None):
+    """Rasterize a single page and its derivatives into output_dir."""
+    from pdf2image import convert_from_path
+    with metrics.stage('rasterize'):
+        images = convert_from_path(pdf_path, dpi=dpi, first_page=page_number, last_page=page_number)
+    try:
+        return save_page_variants(images[0], output_dir, page_number, supported_formats(extra_formats), tile_size)
+    finally:
+        for image in images:
+            image.close()
+
+def prepare_pdf_lazy(pdf_path, output_dir, progress_callback=None, dpi=RENDER_DPI, extra_formats=(),
+                     tile_size=None):
+    """Read the page count and render only page 1, other pages are rendered on first request."""
+    try:
+        extra_formats = supported_formats(extra_formats)
+        page_count, page_size = get_pdf_info(pdf_path)
+        page_sizes = get_page_sizes(pdf_path, page_count)
+        pages = [render_page(pdf_path, 1, output_dir, dpi, extra_formats, tile_size)]
+        for page_number in range(2, page_count + 1):
+            width, height = page_sizes.get(page_number, page_size)
+            pages.append(estimate_page_variants(
+                page_number, round(width / 72 * dpi), round(height / 72 * dpi), extra_formats, tile_size
+            ))
+        write_page_manifest(output_dir, pages)
+        if progress_callback:
+            progress_callback(1, page_count)
+        return page_count
+    except Exception as e:
+        raise Exception(f"Error converting PDF: {str(e)}")
+
+def write_page_manifest(output_dir, pages):
+    manifest = {'version': 1, 'page_count': len(pages), 'pages': pages}
+    manifest_path = os.path.join(output_dir, MANIFEST_FILENAME)
+    tmp_path = f'{manifest_path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+    return manifest
+
+def load_page_manifest(asset_dir):
+    """Return the page manifest of an asset directory, or None for pages rendered before manifests."""
+    if storage.remote:
+        try:
+            return _read_remote_manifest(asset_dir, int(time.time() // REMOTE_MANIFEST_TTL))
+        except FileNotFoundError:
+            return None
+    manifest_path = storage.path(f'{asset_dir}/{MANIFEST_FILENAME}')
+    try:
+        mtime = os.path.getmtime(manifest_path)
+    except OSError:
+        return None  # Rendered before derivatives existed
+    return _read_manifest(manifest_path, mtime)
+
+@lru_cache(maxsize=256)
+def _read_manifest(manifest_path, mtime):
+    with open(manifest_path) as f:
+        return json.load(f)
+
+@lru_cache(maxsize=256)
+def _read_remote_manifest(asset_dir, ttl_bucket):
+    data = storage.read(f'{asset_dir}/{MANIFEST_FILENAME}')
+    if not data:
+        # Raised rather than returned, lru_cache does not keep exceptions and the manifest may be published soon
+        raise FileNotFoundError(f'{asset_dir}/{MANIFEST_FILENAME}')
+    return json.loads(data)
+
+def page_sources(flipbook, limit=None):
+    """Build per-page image URLs, srcsets and variant metadata for templates and the API.
+
+    limit only builds the first pages, e.g. 1 for the page a viewer preloads.
+    """
+    manifest = load_page_manifest(flipbook.asset_dir)
+
+    def asset_url(filename, version=None):
+        if version:
+            # Shared by every flipbook of the document, and cacheable forever
+            return url_for('page_asset', asset_dir=flipbook.asset_dir, version=version, filename=filename)
+        return url_for('page_image', unique_id=flipbook.unique_id, filename=filename)
+
+    if manifest is None:
+        return [{
+            'number': i,
+            'src': asset_url(f'page_{i}.jpg'),
+            'srcset': '',
+            'sources': [],
+            'variants': [],
+            'tiles': None
+        } for i in range(1, min(flipbook.page_count, limit or flipbook.page_count) + 1)]
+
+    pages = []
+    for page in manifest['pages'][:limit]:
+        variants = [dict(v, url=asset_url(v['file'], v.get('hash'))) for v in page['variants']]
+        by_format = {}
+        for v in variants:
+            if v['name'] != 'original':
+                by_format.setdefault(v['format'], []).append(f"{v['url']} {v['width']}w")
+        src = next((v['url'] for v in variants if v['name'] == 'viewer' and v['format'] == 'jpeg'),
+                   variants[0]['url'])
+        tiles = None
+        if 'tiles' in page:
+            # Base URL, the client appends /<level>/<col>_<row>.jpg
+            tile_url = url_for('page_tile', unique_id=flipbook.unique_id, page_number=page['number'],
+                               level=0, col=0, row=0)
+            tiles = dict(page['tiles'], url=tile_url.rsplit('/', 2)[0])
+        pages.append({
+            'number': page['number'],
+            'width': page['width'],
+            'height': page['height'],
+            'tiles': tiles,
+            'src': src,
+            'srcset': ', '.join(by_format.get('jpeg', [])),
+            # <source> entries for optional formats, the <img> srcset covers JPEG
+            'sources': [{'type': IMAGE_FORMATS[fmt][2], 'srcset': ', '.join(entries)}
+                        for fmt, entries in by_format.items() if fmt != 'jpeg'],
+            'variants': variants
+        })
+    return pages
+
+def first_page_source(flipbook):
+    """The first page of a ready flipbook, for the viewer to preload, or None."""
+    if not flipbook.is_ready:
+        return None
+    return next(iter(page_sources(flipbook, limit=1)), None)
+
+def find_page_variant(manifest, filename):
+    """Return the manifest entry for a rendered page file, or None."""
+    match = PAGE_FILE_PATTERN.fullmatch(filename)
+    if not manifest or not match:
+        return None
+    page_number = int(match.group(1))
+    if not 1 <= page_number <= len(manifest['pages']):
+        return None
+    return next((v for v in manifest['pages'][page_number - 1]['variants'] if v['file'] == filename), None)
+
+def send_page_asset(path, immutable=False):
+    """Send a rendered page file with validators and range support, or hand it to the front proxy.
+
+    With PAGE_ACCEL_REDIRECT set, nginx serves the bytes from an internal
+    location mapped to UPLOAD_FOLDER. With USE_X_SENDFILE, send_file emits an
+    X-Sendfile header for Apache or lighttpd instead of streaming the file.
+    """
+    max_age = IMMUTABLE_MAX_AGE if immutable else PAGE_MAX_AGE
+    accel_prefix = current_app.config['PAGE_ACCEL_REDIRECT']
+    if accel_prefix:
+        relative_path = os.path.relpath(path, current_app.config['UPLOAD_FOLDER'])
+        response = current_app.response_class(mimetype=mimetypes.guess_type(path)[0])
+        response.headers['X-Accel-Redirect'] = f"{accel_prefix.rstrip('/')}/{relative_path}"
+        response.cache_control.max_age = max_age
+    else:
+        response = send_file(path, max_age=max_age, conditional=True, etag=True)
+    response.cache_control.public = True
+    if immutable:
+        response.cache_control.immutable = True
+    return response
+
+def send_stored_asset(key, immutable=False):
+    """Send a stored page file: locally, as a redirect to a presigned URL, or proxied from remote storage."""
+    if not storage.remote:
+        return send_page_asset(storage.path(key), immutable)
+    url = storage.url(key)
+    if url:
+        response = redirect(url)
+        # Reuse the redirect for a while, but never past the presigned URL's expiry
+        response.cache_control.max_age = 600
+        response.cache_control.private = True
+        return response
+    # Like send_file(conditional=True) locally: ranges and revalidation are answered by S3
+    status, obj = storage.open(
+        key,
+        range=request.headers.get('Range'),
+        if_none_match=request.headers.get('If-None-Match'),
+        if_modified_since=request.if_modified_since
+    )
+    if status in (404, 416):
+        abort(status)
+    if obj is None:
+        response = Response(status=304)
+    else:
+        response = Response(obj['Body'].iter_chunks(64 * 1024), status=status, mimetype=obj['ContentType'])
+        response.content_length = obj['ContentLength']
+        if status == 206:
+            response.headers['Content-Range'] = obj['ContentRange']
+        response.headers['ETag'] = obj['ETag']  # already quoted by S3
+        response.last_modified = obj['LastModified']
+    response.accept_ranges = 'bytes'
+    response.cache_control.max_age = IMMUTABLE_MAX_AGE if immutable else PAGE_MAX_AGE
+    response.cache_control.public = True
+    if immutable:
+        response.cache_control.immutable = True
+    return response
+
+def page_is_lazy(asset_dir, page_number):
+    """True if the page was never rendered into the asset directory and comes from the render cache."""
+    manifest = load_page_manifest(asset_dir)
+    if not manifest or not 1 <= page_number <= len(manifest['pages']):
+        return False
+    return manifest['pages'][page_number - 1].get('lazy', False)
+
+def process_pdf(pdf_path, output_dir, progress_callback=None, dpi=RENDER_DPI,
+                thread_count=RENDER_THREADS, max_memory_mb=RENDER_MAX_MEMORY_MB,
+                extra_formats=(), tile_size=None):
+    """Rasterize a PDF into page images and derivatives, one bounded window of pages at a time.
+
+    Only the pages of the current window are held as decoded images, so peak
+    memory depends on max_memory_mb rather than on the document length.
+    """
+    from pdf2image import convert_from_path
     try:
-        images = convert_from_path(pdf_path)
-        image_files = []
-        for i, image in enumerate(images):
-            image_path = os.path.join(output_dir, f'page_{i + 1}.jpg')
-            image.save(image_path, 'JPEG')
-            image_files.append(image_path)
-        return len(images)  # Return page count instead of image_files
+        extra_formats = supported_formats(extra_formats)
+        page_count, page_size = get_pdf_info(pdf_path)
+        window = pages_per_window(page_size, dpi, max_memory_mb)
+        pages = []
+        for first_page in range(1, page_count + 1, window):
+            last_page = min(first_page + window - 1, page_count)
+            with metrics.stage('rasterize'):
+                images = convert_from_path(
+                    pdf_path,
+                    dpi=dpi,
+                    first_page=first_page,
+                    last_page=last_page,
+                    thread_count=min(thread_count, last_page - first_page + 1)
+                )
+            for page_number, image in enumerate(images, start=first_page):
+                pages.append(save_page_variants(image, output_dir, page_number, extra_formats, tile_size))
+                image.close()
+                if progress_callback:
+                    progress_callback(page_number, page_count)
+            del images
+        write_page_manifest(output_dir, pages)
+        return page_count  # Return page count instead of image_files
     except Exception as e:
         raise Exception(f"Error converting PDF: {str(e)}")
 